@@ -1,16 +1,28 @@
 import json
 import os
+import sqlite3
+import threading
 import time
-from typing import List, Dict, Any, Set, Union
+from typing import List, Dict, Any, Set, Union, Callable
 from datetime import datetime
 
 # 导入时间戳函数
 from schema import get_timestamp
+from contact_index import get_contact_index
+from locks import get_lock_manager
+
+# 服务器端通讯录的存储后端: 'json' 为每个用户一个 data/directory/<user>.json 文件，
+# 'sqlite' 为所有用户共用的 data/contacts.db（WAL 模式），见 open_contact_manager()
+CONTACT_BACKEND = 'json'
+CONTACT_DB_PATH = os.path.join('data', 'contacts.db')
 
 class ContactManager:
     """
     管理单个用户的通讯录和消息记录。
     每个用户都有一个独立的JSON文件来存储其联系人和消息。
+    多个线程可能同时为同一用户创建 ContactManager：修改操作在该用户的条带锁内
+    重新加载文件后再修改并写回，写回通过临时文件原子替换，因此不会丢失更新，
+    读取方也不会读到写了一半的文件。
     """
     def __init__(self, username: str):
         self.username = username
@@ -41,8 +53,10 @@ class ContactManager:
             "messages": self.messages
         }
         
-        with open(self.filepath, 'w', encoding='utf-8') as f:
+        tmp_path = f"{self.filepath}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
             json.dump(data_to_save, f, indent=4, ensure_ascii=False)
+        os.replace(tmp_path, self.filepath)
 
     def get_contact_by_name(self, name: str) -> Union[Dict[str, Any], None]:
         """通过名称查找联系人"""
@@ -56,29 +70,35 @@ class ContactManager:
         更新或添加一个联系人。
         (此函数逻辑不变, 但现在调用的是已更新的 _save_data)
         """
-        found = False
-        current_time = get_timestamp()
-        
-        for contact in self.contacts:
-            if contact.get("name") == name:
-                contact["address"] = address
-                contact["preview"] = preview
-                contact["time"] = current_time
-                found = True
-                break
-        
+        with get_lock_manager().locked(self.username):
+            # 其他线程可能已经修改了文件，先重新加载再修改
+            self._load_data()
+            found = False
+            current_time = get_timestamp()
+
+            for contact in self.contacts:
+                if contact.get("name") == name:
+                    contact["address"] = address
+                    contact["preview"] = preview
+                    contact["time"] = current_time
+                    found = True
+                    break
+
+            if not found:
+                new_contact = {
+                    "id": -1,
+                    "name": name,
+                    "status": "offline",
+                    "preview": preview,
+                    "time": current_time,
+                    "address": address
+                }
+                self.contacts.append(new_contact)
+
+            self._save_data() # 调用已更新的保存函数
         if not found:
-            new_contact = {
-                "id": -1,
-                "name": name,
-                "status": "offline",
-                "preview": preview,
-                "time": current_time,
-                "address": address
-            }
-            self.contacts.append(new_contact)
-            
-        self._save_data() # 调用已更新的保存函数
+            # 同步反向索引，状态变化时才能找到需要更新的好友
+            get_contact_index().add(self.username, name)
         print(f"[通讯录日志] 用户 {self.username} 的通讯录已更新，联系人: {name}")
         
     def add_message(self, friend_username: str, sender_type: str, content: str):
@@ -97,26 +117,199 @@ class ContactManager:
             "time": int(time.time())
         }
 
-        # 如果之前没有和这位好友的聊天记录，则创建一个新列表
-        if friend_username not in self.messages:
-            self.messages[friend_username] = []
-        
-        # 将新消息追加到对应好友的聊天记录中
-        self.messages[friend_username].append(new_message)
-        
-        # 保存更新后的数据
-        self._save_data()
+        with get_lock_manager().locked(self.username):
+            self._load_data()
+            # 如果之前没有和这位好友的聊天记录，则创建一个新列表
+            if friend_username not in self.messages:
+                self.messages[friend_username] = []
+
+            # 将新消息追加到对应好友的聊天记录中
+            self.messages[friend_username].append(new_message)
+
+            # 保存更新后的数据
+            self._save_data()
         print(f"[消息记录] 已为用户 {self.username} 添加与 {friend_username} 的新消息。")
     # --- 新增结束 ---
 
-    def get_contacts_with_status(self, online_users_set: Set[str]) -> List[Dict[str, Any]]:
+    def get_contacts_with_status(self, online_users_set: Set[str],
+                                 address_of: Callable[[str], str] = None) -> List[Dict[str, Any]]:
         """
-        获取通讯录列表，并根据在线用户集合实时更新联系人状态。
+        获取通讯录列表，并根据在线用户集合实时合并联系人状态（以及地址）。
+        返回的是副本，临时的在线状态不会被写回通讯录文件。
         """
+        merged = []
         for contact in self.contacts:
+            contact = dict(contact)
             if contact.get("name") in online_users_set:
                 contact["status"] = "online"
             else:
                 contact["status"] = "offline"
-        return self.contacts
+            if address_of is not None:
+                contact["address"] = address_of(contact.get("name")) if contact["status"] == "online" else ""
+            merged.append(contact)
+        return merged
+
+
+class SqliteContactManager(ContactManager):
+    """
+    ContactManager 的 SQLite 存储后端，公开方法与 JSON 版本相同。
+
+    所有用户共用一个 WAL 模式的数据库，新增联系人或消息只写入一行，
+    不再随着聊天记录的增长重写整个文件。contacts / messages 属性按需从数据库读取，
+    联系人的 id 与 JSON 版本一致，按 time 倒序编号。
+    某个用户第一次使用时，会把已有的 data/directory/<user>.json 导入数据库。
+    """
+    _local = threading.local()
+
+    def __init__(self, username: str, db_path: str = None):
+        self.username = username
+        self.db_path = db_path or CONTACT_DB_PATH
+        self.filepath = os.path.join('data', 'directory', f"{self.username}.json")
+        self._ensure_owner()
+
+    # --- 连接与建表 ---
+
+    def _connect(self) -> sqlite3.Connection:
+        """每个线程每个数据库一个连接。"""
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        conn = connections.get(self.db_path)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                conn.executescript("""
+                    CREATE TABLE IF NOT EXISTS owners (
+                        owner TEXT PRIMARY KEY
+                    );
+                    CREATE TABLE IF NOT EXISTS contacts (
+                        owner   TEXT NOT NULL,
+                        name    TEXT NOT NULL,
+                        status  TEXT NOT NULL DEFAULT 'offline',
+                        preview TEXT,
+                        time    INTEGER,
+                        address TEXT,
+                        PRIMARY KEY (owner, name)
+                    );
+                    CREATE INDEX IF NOT EXISTS contacts_owner_time ON contacts (owner, time);
+                    CREATE TABLE IF NOT EXISTS messages (
+                        id      INTEGER PRIMARY KEY AUTOINCREMENT,
+                        owner   TEXT NOT NULL,
+                        peer    TEXT NOT NULL,
+                        sender  TEXT,
+                        content TEXT,
+                        time    INTEGER
+                    );
+                    CREATE INDEX IF NOT EXISTS messages_owner_peer_time ON messages (owner, peer, time);
+                """)
+            connections[self.db_path] = conn
+        return conn
+
+    def _ensure_owner(self):
+        """第一次使用时登记该用户，并导入已有的 JSON 通讯录。"""
+        conn = self._connect()
+        if conn.execute("SELECT 1 FROM owners WHERE owner = ?", (self.username,)).fetchone():
+            return
+        with get_lock_manager().locked(self.username):
+            with conn:
+                if conn.execute("SELECT 1 FROM owners WHERE owner = ?", (self.username,)).fetchone():
+                    return
+                try:
+                    with open(self.filepath, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                except (FileNotFoundError, json.JSONDecodeError):
+                    data = {}
+                conn.executemany(
+                    "INSERT OR REPLACE INTO contacts (owner, name, status, preview, time, address) "
+                    "VALUES (?, ?, 'offline', ?, ?, ?)",
+                    [(self.username, c.get("name"), c.get("preview"), c.get("time"), c.get("address"))
+                     for c in data.get("contacts", []) if c.get("name")])
+                conn.executemany(
+                    "INSERT INTO messages (owner, peer, sender, content, time) VALUES (?, ?, ?, ?, ?)",
+                    [(self.username, peer, m.get("sender"), m.get("content"), m.get("time"))
+                     for peer, history in data.get("messages", {}).items() for m in history])
+                conn.execute("INSERT INTO owners (owner) VALUES (?)", (self.username,))
+
+    # --- 与 JSON 版本相同的接口 ---
+
+    def _load_data(self):
+        """数据按需从数据库读取，无需预先加载。"""
+
+    def _save_data(self):
+        """每次修改都已立即提交，无需整体写回。"""
+
+    @staticmethod
+    def _row_to_contact(contact_id: int, row) -> Dict[str, Any]:
+        name, status, preview, contact_time, address = row
+        return {
+            "id": contact_id,
+            "name": name,
+            "status": status,
+            "preview": preview,
+            "time": contact_time,
+            "address": address
+        }
+
+    @property
+    def contacts(self) -> List[Dict[str, Any]]:
+        rows = self._connect().execute(
+            "SELECT name, status, preview, time, address FROM contacts "
+            "WHERE owner = ? ORDER BY time DESC, rowid DESC", (self.username,))
+        return [self._row_to_contact(i + 1, row) for i, row in enumerate(rows)]
+
+    @property
+    def messages(self) -> Dict[str, List[Dict[str, Any]]]:
+        messages: Dict[str, List[Dict[str, Any]]] = {}
+        rows = self._connect().execute(
+            "SELECT peer, sender, content, time FROM messages WHERE owner = ? ORDER BY id", (self.username,))
+        for peer, sender, content, message_time in rows:
+            messages.setdefault(peer, []).append({"sender": sender, "content": content, "time": message_time})
+        return messages
+
+    def get_contact_by_name(self, name: str) -> Union[Dict[str, Any], None]:
+        """通过名称查找联系人"""
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT name, status, preview, time, address, rowid FROM contacts WHERE owner = ? AND name = ?",
+            (self.username, name)).fetchone()
+        if row is None:
+            return None
+        # 编号与 contacts 的排序一致：time 相同的按 rowid 倒序
+        newer = conn.execute(
+            "SELECT COUNT(*) FROM contacts WHERE owner = ? AND (time > ? OR (time = ? AND rowid > ?))",
+            (self.username, row[3], row[3], row[5])).fetchone()[0]
+        return self._row_to_contact(newer + 1, row[:5])
+
+    def update_or_add_contact(self, name: str, address: str, preview: str):
+        """更新或添加一个联系人，只写入一行。"""
+        conn = self._connect()
+        with get_lock_manager().locked(self.username):
+            with conn:
+                found = conn.execute("SELECT 1 FROM contacts WHERE owner = ? AND name = ?",
+                                     (self.username, name)).fetchone() is not None
+                conn.execute(
+                    "INSERT INTO contacts (owner, name, status, preview, time, address) "
+                    "VALUES (?, ?, 'offline', ?, ?, ?) "
+                    "ON CONFLICT (owner, name) DO UPDATE SET "
+                    "preview = excluded.preview, time = excluded.time, address = excluded.address",
+                    (self.username, name, preview, get_timestamp(), address))
+        if not found:
+            get_contact_index().add(self.username, name)
+        print(f"[通讯录日志] 用户 {self.username} 的通讯录已更新，联系人: {name}")
+
+    def add_message(self, friend_username: str, sender_type: str, content: str):
+        """添加一条消息到记录中，只插入一行。"""
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT INTO messages (owner, peer, sender, content, time) VALUES (?, ?, ?, ?, ?)",
+                         (self.username, friend_username, sender_type, content, int(time.time())))
+        print(f"[消息记录] 已为用户 {self.username} 添加与 {friend_username} 的新消息。")
 
+def open_contact_manager(username: str) -> ContactManager:
+    """按 CONTACT_BACKEND 的配置返回对应存储后端的 ContactManager。"""
+    if CONTACT_BACKEND == 'sqlite':
+        return SqliteContactManager(username)
+    return ContactManager(username)
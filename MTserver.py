@@ -1,4 +1,14 @@
 # --- START OF FILE server.py (Modified for Multithreading) ---
+"""
+多线程 / asyncio 聊天服务器。
+
+线程模式下每个处理线程在客户端的整个会话期间都被占用（TLS 握手也在处理线程中进行）。
+处理线程全忙时新连接进入有界的接入队列，排队的连接还没有握手、也收不到任何回复：
+- 排队超过 ACCEPT_MAX_WAIT 秒仍没有处理线程空出来时，该连接被拒绝；
+- 队列已满时新连接立即被拒绝。
+拒绝由专门的拒绝线程池完成 TLS 握手并发送 server_busy 的 FailLoginMsg（最多等待 REJECT_TIMEOUT 秒），
+拒绝线程池也满时不握手直接关闭连接；accept 线程本身从不阻塞在握手上。
+"""
 from sys import setswitchinterval
 import schema as S
 import datetime as dt
@@ -8,52 +18,61 @@ import json
 import ssl
 import uuid
 import Transaction_Server as T
-from serializer import serialize, deserialize
+import Contacts as C
+from serializer import serialize, deserialize, decode_frame, note_peer_codec
 import threading
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from sessions import ClientSession
+from framing import FrameTooLargeError, check_frame_length, frame_limit, set_frame_role
+from dispatch import dispatch, RequestContext, get_handler_stats
+from flow import set_ack_reader, take_deferred, timed_reader
+from compression import get_compression_stats
+from worker_pool import WorkerPool, start_stats_reporter, WORKER_COUNT, ACCEPT_QUEUE_SIZE, ACCEPT_MAX_WAIT
 
 # 服务器IP和端口保持不变
 ip_port = ("10.122.233.244", 47474)
 
+# asyncio 模式下处理函数所用线程池的大小（处理函数中的文件读写会在这里执行）
+ASYNC_EXECUTOR_WORKERS = 32
+# asyncio 模式下的监听队列长度与 TLS 握手超时
+ASYNC_BACKLOG = 1024
+ASYNC_HANDSHAKE_TIMEOUT = 10
+
+# 线程模式下拒绝连接时，TLS 握手与发送拒绝消息的超时（秒）
+REJECT_TIMEOUT = 2
+# 线程模式下专门发送拒绝消息的线程数与排队上限；这里也满了就不握手直接关闭连接
+REJECT_WORKERS = 4
+REJECT_QUEUE_SIZE = 256
+
+def create_ssl_context():
+    """创建服务器端 SSLContext（线程模式与 asyncio 模式共用）。"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile="server.crt", keyfile="server_rsa_private.pem.unsecure")
+    context.load_verify_locations("ca.crt")
+    context.verify_mode = ssl.CERT_REQUIRED
+    return context
+
+def process_request(received_msg, ssl_connect_sock, user_ip, user_port):
+    """
+    通过共享的处理表 (dispatch.HANDLERS) 调用 Transaction_Server 中对应的处理函数。
+    ssl_connect_sock 只需提供 sendall / getpeercert，asyncio 模式下传入的是适配器。
+    """
+    return dispatch(received_msg, RequestContext(ssl_connect_sock, user_ip, user_port))
+
 def msg_process(ssl_connect_sock):
     try:
         user_ip, user_port = ssl_connect_sock.getpeername()
         print("user_ip", user_ip)
         print("user_port", user_port)
-        received_msg = T.recv_msg(ssl_connect_sock)
+        # 上一次传输等待确认时读到的其他请求先处理
+        received_msg = take_deferred(ssl_connect_sock) or T.recv_msg(ssl_connect_sock)
         if received_msg is None:
             print("客户端已断开连接。")
             return None
 
-        if received_msg.tag.name == "Login":
-            T.handle_login(received_msg, user_ip, user_port, ssl_connect_sock)        
-        
-        elif received_msg.tag.name == "Register":
-            reply_msg = T.handle_register(received_msg, ssl_connect_sock)           
-            ssl_connect_sock.sendall(serialize(reply_msg))
-
-        elif received_msg.tag.name == "Logout":
-            reply_msg = T.handle_logout(received_msg)   
-            ssl_connect_sock.sendall(serialize(reply_msg))
-
-        elif received_msg.tag.name == "GetDirectory":
-            T.handle_send_directory(received_msg, ssl_connect_sock)
-
-        # elif received_msg.tag.name == "GetHistory":
-        #     reply_msg = T.handle_get_history(received_msg)
-        #     ssl_connect_sock.sendall(serialize(reply_msg))
-
-        elif received_msg.tag.name == "GetPublicKey":
-            T.handle_get_public_key(received_msg, ssl_connect_sock)
-
-        # elif received_msg.tag.name == "Alive":
-        #     reply_msg = T.handle_alive(received_msg)
-        #     ssl_connect_sock.sendall(serialize(reply_msg))
-
-        # elif received_msg.tag.name == "BackUp":
-        #     reply_msg = T.handle_backup(received_msg)
-        #     ssl_connect_sock.sendall(serialize(reply_msg))
-
-        return True
+        return process_request(received_msg, ssl_connect_sock, user_ip, user_port)
 
     except ConnectionResetError:
         print("客户端连接被重置。")
@@ -72,11 +91,18 @@ def client_handler(connect_sock, address, context):
         # 使用 'with' 语句进行SSL握手并自动管理资源
         with context.wrap_socket(connect_sock, server_side=True) as ssl_connect_sock:
             print(f"线程 {threading.get_ident()}: 与 {address} 的SSL握手成功。")
-            
+            session = ClientSession(ssl_connect_sock)
+            set_frame_role(session, 'server')
+            # 处理请求时没有其他线程读取这个连接，传输等待确认时由处理线程自己读取
+            set_ack_reader(session, timed_reader(T.recv_msg))
+
             # 循环处理来自这个特定客户端的消息
-            while True:
-                if msg_process(ssl_connect_sock) is None:
-                    break  # 客户端断开连接或发生错误，退出循环
+            try:
+                while True:
+                    if msg_process(session) is None:
+                        break  # 客户端断开连接或发生错误，退出循环
+            finally:
+                T.handle_disconnect(session)
 
     except ssl.SSLError as e:
         print(f"线程 {threading.get_ident()}: 来自 {address} 的SSL错误: {e}")
@@ -86,34 +112,201 @@ def client_handler(connect_sock, address, context):
         print(f"线程 {threading.get_ident()}: 与 {address} 的连接已关闭。")
 
 
+# =================================================================
+#               asyncio 模式：一个协程对应一个客户端会话
+# =================================================================
+
+class AsyncSocketAdapter:
+    """
+    把 asyncio 的 StreamWriter 包装成 Transaction_Server 处理函数所需的 socket 接口。
+    处理函数运行在线程池中，sendall 会把写操作交回事件循环执行并等待 drain，
+    因此大文件传输同样受到背压控制。
+    """
+    def __init__(self, writer: asyncio.StreamWriter, loop: asyncio.AbstractEventLoop):
+        self._writer = writer
+        self._loop = loop
+
+    async def _write(self, data: bytes):
+        self._writer.write(data)
+        await self._writer.drain()
+
+    def sendall(self, data: bytes):
+        asyncio.run_coroutine_threadsafe(self._write(data), self._loop).result()
+
+    def getpeercert(self, binary_form: bool = False):
+        ssl_object = self._writer.get_extra_info('ssl_object')
+        if ssl_object is None:
+            return None
+        return ssl_object.getpeercert(binary_form)
+
+    def getpeername(self):
+        return self._writer.get_extra_info('peername')
+
+    def shutdown(self, how=None):
+        self._loop.call_soon_threadsafe(self._writer.close)
+
+async def async_recv_msg(reader: asyncio.StreamReader, session=None):
+    """asyncio 版本的 recv_msg：读取 [4字节长度前缀 + 负载] 并解码。"""
+    try:
+        header_bytes = await reader.readexactly(4)
+        datalength = int.from_bytes(header_bytes, byteorder='big')
+        # 在 readexactly 缓冲负载之前检查长度，超长的帧直接断开连接
+        check_frame_length(datalength, frame_limit('server'))
+        json_bytes = await reader.readexactly(datalength)
+    except asyncio.IncompleteReadError:
+        return None
+    except FrameTooLargeError as e:
+        print(f"[服务器日志] 拒绝超长的帧: {e}")
+        return None
+
+    if session is not None:
+        note_peer_codec(session, json_bytes)
+    return decode_frame(json_bytes)
+
+async def async_client_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """asyncio 模式下单个客户端的完整生命周期，空闲时只占用一个协程。"""
+    loop = asyncio.get_running_loop()
+    address = writer.get_extra_info('peername')
+    user_ip, user_port = address[0], address[1]
+    session = ClientSession(AsyncSocketAdapter(writer, loop))
+    # 处理函数运行期间协程在等待它，传输等待确认时由处理线程把读取交回事件循环执行
+    set_ack_reader(session, lambda s, timeout: asyncio.run_coroutine_threadsafe(
+        asyncio.wait_for(async_recv_msg(reader, s), timeout), loop).result())
+    print(f"[asyncio] 与 {address} 的SSL握手成功。")
+    try:
+        while True:
+            received_msg = take_deferred(session) or await async_recv_msg(reader, session)
+            if received_msg is None:
+                print(f"[asyncio] 客户端 {address} 已断开连接。")
+                break
+            # 处理函数包含阻塞的文件读写，放到线程池中执行，避免阻塞事件循环
+            result = await loop.run_in_executor(
+                None, process_request, received_msg, session, user_ip, user_port)
+            if result is None:
+                break
+    except (ConnectionResetError, BrokenPipeError):
+        print(f"[asyncio] 客户端 {address} 连接被重置。")
+    except Exception as e:
+        print(f"[asyncio] 处理客户端 {address} 时发生意外错误: {e}")
+    finally:
+        await loop.run_in_executor(None, T.handle_disconnect, session)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+        print(f"[asyncio] 与 {address} 的连接已关闭。")
+
+def raise_open_file_limit():
+    """尽量把进程可打开的文件描述符上限提高到硬上限，以容纳大量空闲连接。"""
+    try:
+        import resource
+    except ImportError:
+        return  # Windows 上没有 resource 模块
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as e:
+            print(f"[asyncio] 无法提高文件描述符上限: {e}")
+
+async def async_main(context: ssl.SSLContext):
+    """asyncio 模式的服务器主循环。"""
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=ASYNC_EXECUTOR_WORKERS))
+
+    server = await asyncio.start_server(
+        async_client_handler,
+        host=ip_port[0] or None,
+        port=ip_port[1],
+        ssl=context,
+        backlog=ASYNC_BACKLOG,
+        ssl_handshake_timeout=ASYNC_HANDSHAKE_TIMEOUT,
+    )
+    print(f'服务器(asyncio 模式)已在 {ip_port} 启动，等待客户端连接...')
+    async with server:
+        await server.serve_forever()
+
+def reject_connection(connect_sock, address, context):
+    """
+    线程池已满时快速拒绝连接：完成 TLS 握手后发送 server_busy 的失败消息并立即关闭，
+    客户端可以据此提示用户稍后重试，而不是一直挂起。
+    在专门的拒绝线程池中执行，握手再慢也不会拖住 accept 线程。
+    """
+    try:
+        connect_sock.settimeout(REJECT_TIMEOUT)
+        with context.wrap_socket(connect_sock, server_side=True) as ssl_connect_sock:
+            reply_msg = S.FailLoginMsg(error_type="server_busy", username="")
+            ssl_connect_sock.sendall(serialize(reply_msg))
+    except (ssl.SSLError, OSError) as e:
+        print(f"[服务器繁忙] 向 {address} 发送拒绝消息失败: {e}")
+    finally:
+        connect_sock.close()
+
+def run_threaded_server(context: ssl.SSLContext, workers: int = WORKER_COUNT,
+                        queue_size: int = ACCEPT_QUEUE_SIZE, stats_interval: float = 0,
+                        max_wait: float = ACCEPT_MAX_WAIT):
+    """线程模式：固定数量的处理线程 + 有界接入队列，排队超过 max_wait 秒的连接被拒绝。"""
+    reject_pool = WorkerPool(reject_connection, workers=REJECT_WORKERS, queue_size=REJECT_QUEUE_SIZE)
+    reject_pool.start()
+
+    def turn_away(connect_sock, address, context, reason: str):
+        print(f"[服务器繁忙] {reason}，拒绝来自 {address} 的连接。")
+        # 拒绝线程池也满时不再握手，直接关闭
+        if not reject_pool.submit(connect_sock, address, context):
+            connect_sock.close()
+
+    pool = WorkerPool(client_handler, workers=workers, queue_size=queue_size, max_wait=max_wait,
+                      on_expire=lambda *args: turn_away(*args, f"在接入队列中等待超过 {max_wait:g} 秒"))
+    pool.start()
+    if stats_interval > 0:
+        start_stats_reporter(stats_interval, {"线程池": pool.stats, "拒绝": reject_pool.stats,
+                                             "请求处理": get_handler_stats, "压缩": get_compression_stats})
+
+    with skt.socket(skt.AF_INET, skt.SOCK_STREAM) as sk:
+        sk.bind(ip_port)
+        sk.listen(queue_size)
+        print(f'服务器已在 {ip_port} 启动 ({workers} 个处理线程, 接入队列 {queue_size}, 最长排队 {max_wait:g} 秒)，等待客户端连接...')
+
+        # 3. 主线程的无限循环，只负责接受连接并交给线程池
+        while True:
+            # 阻塞等待新连接
+            connect_sock, address = sk.accept()
+
+            # 队列已满时立即拒绝，避免在重连风暴中无限堆积
+            if not pool.submit(connect_sock, address, context):
+                turn_away(connect_sock, address, context, "接入队列已满")
+
 def main():
     """
     服务器主函数
     """
+    parser = argparse.ArgumentParser(description="多线程 / asyncio 聊天服务器")
+    parser.add_argument("--mode", choices=["thread", "asyncio"], default="thread",
+                        help="连接处理模式: thread(固定线程池) 或 asyncio(协程)")
+    parser.add_argument("--workers", type=int, default=WORKER_COUNT,
+                        help="thread 模式下的处理线程数量")
+    parser.add_argument("--queue-size", type=int, default=ACCEPT_QUEUE_SIZE,
+                        help="thread 模式下等待处理的连接队列容量，已满时拒绝新连接")
+    parser.add_argument("--max-wait", type=float, default=ACCEPT_MAX_WAIT,
+                        help="thread 模式下连接在接入队列中最多等待的秒数，超时后拒绝")
+    parser.add_argument("--stats-interval", type=float, default=0,
+                        help="每隔多少秒打印一次线程池与各消息类型的处理统计 (0 表示不打印)")
+    parser.add_argument("--contact-backend", choices=["json", "sqlite"], default=C.CONTACT_BACKEND,
+                        help="通讯录存储后端: json(每个用户一个文件) 或 sqlite(data/contacts.db, WAL 模式)")
+    args = parser.parse_args()
+    C.CONTACT_BACKEND = args.contact_backend
+
     try:
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        context.load_cert_chain(certfile="server.crt", keyfile="server_rsa_private.pem.unsecure")
-        context.load_verify_locations("ca.crt")
-        context.verify_mode = ssl.CERT_REQUIRED
-
-        with skt.socket(skt.AF_INET, skt.SOCK_STREAM) as sk:
-            sk.bind(ip_port)
-            sk.listen(10)  # 增加监听队列大小
-            print(f'服务器已在 {ip_port} 启动，等待客户端连接...')
-
-            # 3. 主线程的无限循环，只负责接受连接并创建新线程
-            while True:
-                # 阻塞等待新连接
-                connect_sock, address = sk.accept()
-                
-                # 创建一个新的线程来处理客户端连接
-                client_thread = threading.Thread(
-                    target=client_handler,
-                    args=(connect_sock, address, context) # 将需要的参数传给线程
-                )
-                # 设置为守护线程，这样主程序退出时子线程也会被强制退出
-                client_thread.daemon = True 
-                client_thread.start() # 启动线程
+        context = create_ssl_context()
+
+        if args.mode == "asyncio":
+            raise_open_file_limit()
+            if args.stats_interval > 0:
+                start_stats_reporter(args.stats_interval, {"请求处理": get_handler_stats, "压缩": get_compression_stats})
+            asyncio.run(async_main(context))
+        else:
+            run_threaded_server(context, args.workers, args.queue_size, args.stats_interval, args.max_wait)
 
     except FileNotFoundError as e:
         print(f"\n错误: 找不到证书文件 '{e.filename}'。")
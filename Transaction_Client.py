@@ -9,18 +9,27 @@ import pprint
 import threading
 import base64
 import binascii
-from serializer import serialize, deserialize
+from serializer import serialize, deserialize, decode_frame, send_msg
+from framing import read_frame
+from transfer import ChunkSpool, chunk_data, resume_request, send_file
+from capabilities import get_capabilities, handle_hello_ack
+import resume
+from flow import AckSender, deliver_ack
+from demux import ResponseDemux
 import Contacts as C
 from typing import Dict, Any, Union
 import Transaction_Server as T
 import uuid
-CHUNK_SIZE = 4096
+import weakref
 active_transfers = {} # 用于存储当前正在接收的文件传输信息
 
 
-def send_large_data_p2p(p2p_sock: ssl.SSLSocket, current_user: str, file_type: str, file_name: str):
+def send_large_data_p2p(p2p_sock: ssl.SSLSocket, current_user: str, file_type: str, file_name: str,
+                        receiver_name: str = '', connect=None):
     """
     (客户端P2P版本) 将本地文件分块发送给对端客户端。
+    大文件登记在 user/{current_user}/outgoing_transfers.json 中，对端 receiver_name 断开后可以续传。
+    connect 新建到对端的连接时，大文件分段经多条连接并行发送（见 p2p.stripe_connector）。
     """
     filepath = ""
     try:
@@ -35,8 +44,9 @@ def send_large_data_p2p(p2p_sock: ssl.SSLSocket, current_user: str, file_type: s
             print(f"[P2P 发送错误] 不支持的文件类型: {file_type}")
             return False
 
-        with open(filepath, 'rb') as f:
-            data_bytes = f.read()
+        # 只检查文件是否存在，内容在发送时流式读取
+        if not os.path.isfile(filepath):
+            raise FileNotFoundError(filepath)
 
     except FileNotFoundError:
         print(f"[P2P 发送错误] 文件未找到: {filepath}")
@@ -47,29 +57,10 @@ def send_large_data_p2p(p2p_sock: ssl.SSLSocket, current_user: str, file_type: s
 
     transfer_id = str(uuid.uuid4())
     try:
-        total_size = len(data_bytes)
-        total_chunks = (total_size + CHUNK_SIZE - 1) // CHUNK_SIZE
-
-        start_msg = S.StartTransferMsg(
-            transfer_id=transfer_id, file_type=file_type, file_name=file_name,
-            total_size=total_size, total_chunks=total_chunks, chunk_size=CHUNK_SIZE
-        )
-        p2p_sock.sendall(serialize(start_msg))
         print(f"[P2P 发送] 开始传输 '{file_name}'...")
-
-        for i in range(total_chunks):
-            start = i * CHUNK_SIZE
-            end = start + CHUNK_SIZE
-            data_chunk = data_bytes[start:end]
-            encoded_chunk_str = base64.b64encode(data_chunk).decode('ascii')
-            
-            chunk_msg = S.DataChunkMsg(
-                transfer_id=transfer_id, chunk_index=i, data=encoded_chunk_str
-            )
-            p2p_sock.sendall(serialize(chunk_msg))
-        
-        end_msg = S.EndTransferMsg(transfer_id=transfer_id, status='success')
-        p2p_sock.sendall(serialize(end_msg))
+        send_file(p2p_sock, transfer_id, file_type, file_name, filepath, sender_name=current_user,
+                  receiver_name=receiver_name, outgoing=outgoing_transfers(current_user),
+                  progress=print_send_progress(file_name), connect=connect)
         print(f"[P2P 发送] 传输 '{file_name}' 完成。")
         return True
 
@@ -80,41 +71,283 @@ def send_large_data_p2p(p2p_sock: ssl.SSLSocket, current_user: str, file_type: s
         print(f"\n[P2P 发送错误] 传输 '{file_name}' 失败: {e}")
         return False
 
+def print_send_progress(file_name):
+    """发送进度：对端支持流量控制时按对端确认收到的字节数显示，而不是已经写入 socket 的字节数。"""
+    def progress(acked, total):
+        print(f"\r  > '{file_name}' 对端已确认 {acked}/{total} 字节 ({acked * 100 // max(total, 1)}%)", end="", flush=True)
+    return progress
+
 # --- P2P Message Sending Handlers ---
 
-def recv_msg(ssl_connect_sock):
+def _recv_one_msg(ssl_connect_sock):
     try:
-        client_data_bytes = ssl_connect_sock.recv(4)
-        if not client_data_bytes:
+        json_bytes = read_frame(ssl_connect_sock)
+        if json_bytes is None:
             return None
 
-        datalength = int.from_bytes(client_data_bytes, byteorder='big')
-        json_bytes = ssl_connect_sock.recv(datalength)
-        if not json_bytes:
-            return None
-
-        msg_dict = json.loads(json_bytes.decode("UTF-8"))
-        received_msg = deserialize(msg_dict)
+        received_msg = decode_frame(json_bytes)
         return received_msg
-    except (ConnectionResetError, BrokenPipeError):
+    except (ConnectionError, BrokenPipeError):
         print("与服务器的连接已断开。")
         return None
     except Exception as e:
         print(f"接收服务器消息时出错: {e}")
         return None
 
-def recv_large_data(ssl_connect_sock, id, current_user):
+def recv_msg(ssl_connect_sock):
+    """
+    接收下一条服务器消息。服务器推送 (PresenceEventMsg / ContactEventMsg)
+    可能夹在任何回复之间到达，这里会先处理掉推送，只把普通回复返回给调用者。
+    """
+    while True:
+        received_msg = _recv_one_msg(ssl_connect_sock)
+        if isinstance(received_msg, PUSH_EVENT_TYPES):
+            handle_push_event(received_msg)
+            continue
+        if isinstance(received_msg, S.HelloAckMsg):
+            # 能力协商超时后才到达的 HelloAck，此时应用仍然有效
+            handle_hello_ack(ssl_connect_sock, received_msg)
+            continue
+        return received_msg
+
+def recv_push_events(ssl_connect_sock):
+    """
+    (空闲时由后台线程调用) 接收一条消息并作为推送处理。
+    返回 None 表示连接已断开。
+    """
+    received_msg = _recv_one_msg(ssl_connect_sock)
+    if received_msg is None:
+        return None
+    if isinstance(received_msg, PUSH_EVENT_TYPES):
+        handle_push_event(received_msg)
+        return True
+    if isinstance(received_msg, S.HelloAckMsg):
+        handle_hello_ack(ssl_connect_sock, received_msg)
+        return True
+    print(f"[推送] 空闲时收到意外的服务器消息 {received_msg.tag.name}，已忽略。")
+    return False
+
+# --- Request pipelining ---
+
+# 服务器支持 request_id 时，每个连接由一个 ResponseDemux 线程独占读取，
+# 各个请求通过 begin_request 发出并只接收属于自己的回复，不再需要全局锁
+_demuxes: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+def start_demux(ssl_connect_sock) -> ResponseDemux:
+    """启动 ssl_connect_sock 的回复分发线程。此后不能再由其他线程直接读取该连接。"""
+    def on_other(msg):
+        if isinstance(msg, PUSH_EVENT_TYPES):
+            handle_push_event(msg)
+        elif isinstance(msg, S.HelloAckMsg):
+            handle_hello_ack(ssl_connect_sock, msg)
+        elif isinstance(msg, S.TransferAckMsg):
+            deliver_ack(ssl_connect_sock, msg)
+        else:
+            print(f"[请求分发] 收到不属于任何请求的服务器消息 {msg.tag.name}，已忽略。")
+
+    demux = _demuxes[ssl_connect_sock] = ResponseDemux(ssl_connect_sock, _recv_one_msg, on_other).start()
+    return demux
+
+def get_demux(ssl_connect_sock):
+    """返回连接的回复分发器；没有启动（旧服务器）时返回 None。"""
+    return _demuxes.get(ssl_connect_sock)
+
+class _SequentialRequest:
+    """没有回复分发线程时的请求：调用者需持有连接的锁，下一条非推送消息就是回复。"""
+    def __init__(self, ssl_connect_sock, msg):
+        self._sock = ssl_connect_sock
+        send_request(ssl_connect_sock, msg)
+
+    def recv(self, timeout=None):
+        return recv_msg(self._sock)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+def begin_request(ssl_connect_sock, msg):
+    """
+    发出一个请求并返回等待其回复的对象：with begin_request(sock, msg) as call: reply = call.recv()。
+    有回复分发线程时按 request_id 接收回复，多个请求可以同时进行。
+    """
+    demux = _demuxes.get(ssl_connect_sock)
+    if demux is not None:
+        return demux.request(msg, send_request)
+    return _SequentialRequest(ssl_connect_sock, msg)
+
+# --- Heartbeat ---
+
+# 服务器在 HEARTBEAT_TIMEOUT 秒内收不到任何消息就会判定会话过期；
+# 每次发送请求都记录时间，只有空闲超过间隔时才需要额外发送 AliveMsg
+last_request_time = time.monotonic()
+
+def send_request(ssl_connect_sock, msg):
+    """向服务器发送一条请求，并记录发送时间（任何请求都能起到心跳的作用）。"""
+    global last_request_time
+    send_msg(ssl_connect_sock, msg)
+    last_request_time = time.monotonic()
+
+def heartbeat_due(interval: float) -> bool:
+    """距离上一次向服务器发送请求是否已超过 interval 秒。"""
+    return time.monotonic() - last_request_time >= interval
+
+# --- Server Push ---
+
+PUSH_EVENT_TYPES = (S.PresenceEventMsg, S.ContactEventMsg)
+push_user = None      # 已订阅推送的当前用户
+push_listeners = []   # 推送处理完成后的回调 fn(msg)，供界面刷新使用
+
+def subscribe_push(ssl_connect_sock, current_user):
+    """登录成功后订阅好友在线状态与通讯录变化的推送。"""
+    global push_user
+    push_user = current_user
+    send_request(ssl_connect_sock, S.SubscribeMsg(username=current_user))
+
+def handle_push_event(msg):
+    """把推送事件合并进本地通讯录 user/{username}/data.json，并通知回调。"""
+    if push_user:
+        filepath = os.path.join('user', push_user, 'data.json')
+        with file_write_lock:
+            try:
+                with open(filepath, 'r', encoding='utf-8') as f:
+                    data: Dict[str, Any] = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                data = {"contacts": [], "messages": {}}
+
+            contacts = data.setdefault('contacts', [])
+            name = msg.username if isinstance(msg, S.PresenceEventMsg) else msg.contact_name
+            contact = next((c for c in contacts if c.get('name') == name), None)
+            if contact is None and isinstance(msg, S.ContactEventMsg) and msg.action == 'added':
+                contact = {"id": len(contacts) + 1, "name": name, "preview": "", "time": msg.time}
+                contacts.append(contact)
+
+            if contact is not None:
+                contact['status'] = msg.status
+                contact['address'] = msg.address
+                os.makedirs(os.path.dirname(filepath), exist_ok=True)
+                with open(filepath, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, indent=4, ensure_ascii=False)
+
+    for listener in list(push_listeners):
+        try:
+            listener(msg)
+        except Exception as e:
+            print(f"[推送] 回调处理 {msg.tag.name} 时出错: {e}")
+
+EMPTY_DIRECTORY = {"contacts": [], "messages": {}}
+
+def received_file_path(current_user, file_type, file_name):
+    """
+    根据 file_type 确定收到的文件的保存路径：通讯录保存为 data.json，其余按类型放在用户目录下。
+    文件名只取最后一段，对端不能用 '../' 把文件写到用户目录之外。
+    """
+    if file_type == 'directory':
+        return os.path.join('user', current_user, 'data.json')
+    file_name = os.path.basename(file_name.replace('\\', '/')) or str(uuid.uuid4())
+    if file_type in ('image', 'audio', 'file', 'publickey'):
+        return os.path.join('user', current_user, file_type, file_name)
+    print(f"[客户端] 未知的 file_type '{file_type}'，将保存到 'downloads' 目录。")
+    return os.path.join('user', current_user, 'downloads', file_name)
+
+def partial_directories(current_user):
+    """可能留有未完成传输（续传用的临时文件和位图）的目录，与 received_file_path 的保存位置对应。"""
+    base = os.path.join('user', current_user)
+    return [base] + [os.path.join(base, d) for d in ('image', 'audio', 'file', 'publickey', 'downloads')]
+
+def outgoing_transfers(current_user):
+    """本用户作为发送端登记的可续传传输（P2P 发送的大文件）。"""
+    return resume.get_outgoing_transfers(os.path.join('user', current_user, 'outgoing_transfers.json'))
+
+def resume_server_transfers(ssl_connect_sock, current_user):
+    """
+    登录后续传上次没有收完的服务器传输：为每个未完成的传输发送 ResumeTransfer，
+    服务器只重发缺少的数据块；服务器无法续传时删除未完成的文件。
+    """
+    if not get_capabilities(ssl_connect_sock).supports('resume'):
+        return
+    for state in resume.find_partials(partial_directories(current_user), 'server'):
+        print(f"[续传] 继续接收 '{state.get('file_name')}' (ID: {state['transfer_id']})...")
+        with begin_request(ssl_connect_sock, resume_request(state, current_user)) as call:
+            reply = call.recv()
+            if isinstance(reply, S.StartTransferMsg):
+                recv_large_data(ssl_connect_sock, reply.transfer_id, current_user, start_msg=reply, call=call)
+            elif isinstance(reply, S.EndTransferMsg):
+                print(f"[续传] 服务器无法续传 '{state.get('file_name')}' (状态: {reply.status})，已删除未完成的文件。")
+                resume.discard_partial(state['state_path'])
+
+def check_directory_file(path):
+    """通讯录写入前的检查：必须是合法的 JSON，空内容按空通讯录保存。"""
+    with open(path, 'r+', encoding='utf-8') as f:
+        content = f.read()
+        if not content:
+            json.dump(EMPTY_DIRECTORY, f, indent=4, ensure_ascii=False)
+        else:
+            json.loads(content)
+
+def save_received_data(current_user, file_type, file_name, full_data):
+    """保存服务器内联在回复中的数据（分块传输的数据由 ChunkSpool 直接写入文件）。"""
+    save_path = received_file_path(current_user, file_type, file_name)
+    try:
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        if file_type == 'directory':
+            # 解码为JSON字典并保存
+            directory_dict = json.loads(full_data.decode('utf-8')) if full_data else EMPTY_DIRECTORY
+            with open(save_path, 'w', encoding='utf-8') as f:
+                json.dump(directory_dict, f, indent=4, ensure_ascii=False)
+            print(f"[客户端] 通讯录已更新并保存至: {save_path}")
+        else:
+            # 以二进制模式写入文件
+            with open(save_path, 'wb') as f:
+                f.write(full_data)
+            print(f"[客户端] 文件 '{file_name}' 已保存至: {save_path}")
+
+    except json.JSONDecodeError as e:
+        print(f"[客户端] 处理通讯录数据失败：无效的JSON格式。 {e}")
+    except Exception as e:
+        print(f"[客户端] 保存文件时发生错误: {e}")
+
+def save_inline_reply(msg, current_user) -> bool:
+    """
+    保存服务器内联在一条回复中的小负载：DirectoryMsg、PublicKeyMsg，
+    以及 transfer_id 为空（通讯录在 directory 字段中）的 SuccessLoginMsg。不是内联回复时返回 False。
+    """
+    if isinstance(msg, S.DirectoryMsg):
+        save_received_data(current_user, 'directory', f"{msg.username}.json", msg.data.encode('utf-8'))
+    elif isinstance(msg, S.PublicKeyMsg):
+        save_received_data(current_user, 'publickey', f"{msg.target_name}_cert.pem", msg.public_key.encode('ascii'))
+    elif isinstance(msg, S.SuccessLoginMsg) and not msg.transfer_id:
+        save_received_data(current_user, 'directory', f"{msg.username}.json", msg.directory.encode('utf-8'))
+    else:
+        return False
+    return True
+
+def recv_large_data(ssl_connect_sock, id, current_user, start_msg=None, call=None):
     """
     循环接收一个完整的文件传输事务（Start -> Chunks -> End）。
     根据 StartTransferMsg 中的 file_type 决定保存路径。
+    如果调用者已经读到了 StartTransferMsg，可以通过 start_msg 传入；
+    传输属于 begin_request 发出的请求时通过 call 传入，从该请求的回复中读取。
+    数据块直接写入目标目录下预分配的临时文件（见 transfer.ChunkSpool），可以乱序到达，
+    成功结束后原子地改名为目标文件，接收大文件不再占用与文件大小相当的内存。
     """
+    pending_msg = start_msg
     while True:
-        received_msg = recv_msg(ssl_connect_sock)
+        if pending_msg is not None:
+            received_msg, pending_msg = pending_msg, None
+        elif call is not None:
+            received_msg = call.recv()
+        else:
+            received_msg = recv_msg(ssl_connect_sock)
         if received_msg is None:
             print("[文件接收] 接收过程中连接中断。")
-            # 如果有进行中的传输，标记为失败
+            # 如果有进行中的传输，标记为失败（可以续传的保留已收到的数据块）
             if id in active_transfers:
-                del active_transfers[id]
+                active_transfers.pop(id)["spool"].release()
             return
 
         tag_name = received_msg.tag.name
@@ -123,12 +356,27 @@ def recv_large_data(ssl_connect_sock, id, current_user):
         if tag_name == "StartTransfer" and received_msg.transfer_id == id:
             transfer_id = received_msg.transfer_id
             print(f"\n[文件接收] 开始接收 '{received_msg.file_name}' (类型: {received_msg.file_type}, 大小: {received_msg.total_size} bytes)...")
+            try:
+                spool = ChunkSpool(
+                    received_file_path(current_user, received_msg.file_type, received_msg.file_name),
+                    received_msg.total_size, received_msg.chunk_size, received_msg.total_chunks,
+                    transfer_id, received_msg.content_hash, 'server',
+                    get_capabilities(ssl_connect_sock).chunk_size)
+            except (OSError, ValueError) as e:
+                print(f"[文件接收] 无法创建临时文件: {e}")
+                try:
+                    send_msg(ssl_connect_sock, S.EndTransferMsg(transfer_id=transfer_id, status='cancelled'))
+                except OSError:
+                    pass
+                return
+            if spool.resumed_chunks:
+                print(f"[文件接收] 续传: 已有 {spool.resumed_chunks}/{spool.total_chunks} 块。")
             active_transfers[transfer_id] = {
                 "file_name": received_msg.file_name,
                 "file_type": received_msg.file_type, # 存储文件类型
-                "total_chunks": received_msg.total_chunks,
-                "data": bytearray(),
-                "chunks_received": 0
+                "spool": spool,
+                # 服务器要求确认时（流量控制），每收到一定字节数回复 TransferAck
+                "acks": AckSender(ssl_connect_sock, received_msg, spool, send_msg),
             }
 
         # 2. 处理 DataChunk 消息
@@ -137,85 +385,46 @@ def recv_large_data(ssl_connect_sock, id, current_user):
             if transfer_id in active_transfers:
                 transfer = active_transfers[transfer_id]
                 try:
-                    decoded_data = base64.b64decode(received_msg.data)
-                    transfer["data"].extend(decoded_data)
+                    data = chunk_data(received_msg)
+                    transfer["spool"].write_chunk(received_msg.chunk_index, data)
+                    transfer["acks"].on_chunk(len(data))
                 except (binascii.Error, TypeError) as e:
                     print(f"\n[文件接收] Base64解码失败: {e}")
-                    del active_transfers[transfer_id]
+                    active_transfers.pop(transfer_id)["spool"].abort()
+                    return
+                except (OSError, ValueError) as e:
+                    print(f"\n[文件接收] 写入数据块 {received_msg.chunk_index} 失败: {e}")
+                    active_transfers.pop(transfer_id)["spool"].abort()
                     return
-                transfer["chunks_received"] += 1
 
         # 3. 处理 EndTransfer 消息
         elif tag_name == "EndTransfer":
             transfer_id = received_msg.transfer_id
             if transfer_id in active_transfers:
-                transfer_info = active_transfers[transfer_id]
+                transfer_info = active_transfers.pop(transfer_id)
                 file_name = transfer_info['file_name']
                 file_type = transfer_info['file_type']
-                full_data = transfer_info["data"]
+                spool = transfer_info["spool"]
+
+                if received_msg.status != 'success':
+                    print(f"\n[文件接收] 服务器取消了 '{file_name}' 的传输 (状态: {received_msg.status})。")
+                    spool.release(received_msg.status)
+                    return
 
                 print(f"\n[文件接收] '{file_name}' 接收完成!")
-                
-                # 根据 file_type 确定保存路径和处理方式
                 try:
-                    save_dir = ""
+                    save_path = spool.commit(check_directory_file if file_type == 'directory' else None)
                     if file_type == 'directory':
-                        # 通讯录直接保存为 data.json
-                        save_path = os.path.join('user', current_user, 'data.json')
-                        
-                        # 确保目录存在
-                        os.makedirs(os.path.dirname(save_path), exist_ok=True)
-                        
-                        # 解码为JSON字典并保存
-                        if not full_data:
-                            directory_dict = {"contacts": [], "messages": {}}
-                        else:
-                            directory_dict = json.loads(full_data.decode('utf-8'))
-                        
-                        with open(save_path, 'w', encoding='utf-8') as f:
-                            json.dump(directory_dict, f, indent=4, ensure_ascii=False)
                         print(f"[客户端] 通讯录已更新并保存至: {save_path}")
-
                     else:
-                        # 处理图片、语音和通用文件
-                        if file_type == 'image':
-                            save_dir = os.path.join('user', current_user, 'image')
-                        elif file_type == 'audio':
-                            save_dir = os.path.join('user', current_user, 'audio')
-                        elif file_type == 'file':
-                            save_dir = os.path.join('user', current_user, 'file')
-                        elif file_type == 'publickey':
-                            save_dir = os.path.join('user', current_user, 'publickey')
-                            os.makedirs(save_dir, exist_ok=True)
-                            save_path = os.path.join(save_dir, file_name)
-
-                            with open(save_path, 'wb') as f:
-                                f.write(full_data)
-                            print(f"[客户端] 公钥已保存至: {save_path}")
-
-                        else:
-                            print(f"[客户端] 未知的 file_type '{file_type}'，将保存到 'downloads' 目录。")
-                            save_dir = os.path.join('user', current_user, 'downloads')
-
-                        # 创建目标目录
-                        os.makedirs(save_dir, exist_ok=True)
-                        save_path = os.path.join(save_dir, file_name)
-                        
-                        # 以二进制模式写入文件
-                        with open(save_path, 'wb') as f:
-                            f.write(full_data)
                         print(f"[客户端] 文件 '{file_name}' 已保存至: {save_path}")
-                
                 except json.JSONDecodeError as e:
                     print(f"[客户端] 处理通讯录数据失败：无效的JSON格式。 {e}")
                 except Exception as e:
                     print(f"[客户端] 保存文件时发生错误: {e}")
-                
-                # 清理并结束函数
-                del active_transfers[transfer_id]
                 return
             
-        elif received_msg.transfer_id == id:
+        elif getattr(received_msg, 'transfer_id', None) == id:
             print(f"[文件接收] 收到意外消息 {tag_name}，传输ID为 {id}。")
 
 # --- END OF MODIFICATION ---
@@ -317,10 +526,10 @@ def handle_register(ssl_connect_sock):
     if not register_msg:
         return None
 
-    ssl_connect_sock.sendall(serialize(register_msg))
     print("I'm in register")
-    # 等待服务器回复
-    received_msg = recv_msg(ssl_connect_sock)
+    # 发送请求并等待服务器回复
+    with begin_request(ssl_connect_sock, register_msg) as call:
+        received_msg = call.recv()
     if received_msg is None:
         print("客户端已断开连接。")
         return None
@@ -341,6 +550,10 @@ def handle_register(ssl_connect_sock):
         print(f"注册失败: {received_msg}")
         return None
 
+    if received_msg.tag.name == "FailLogin" and received_msg.error_type == "server_busy":
+        print("服务器繁忙，连接已被拒绝，请稍后重试。")
+        return None
+
     return None
 
 
@@ -359,37 +572,43 @@ def handle_login(ssl_connect_sock, my_p2p_port):
     if not login_msg:
         return None, None
 
-    ssl_connect_sock.sendall(serialize(login_msg))
     print("I'm in login")
 
-    received_msg = recv_msg(ssl_connect_sock)
-    if received_msg is None:
-        print("客户端已断开连接。")
-        return None, None
-
-    if received_msg.tag.name == "SuccessLogin" and received_msg.username == inp_username:
-        print(f"登录成功: {received_msg}")
-        ''' 
-        建立监听接口，等待联系人连接
-        如果接收到到消息且接收者为本人
-        则将消息根据发送id保存到历史记录，等ui显示  
-        '''
-        recv_large_data(ssl_connect_sock, received_msg.transfer_id, inp_username)
-
-        return received_msg.username, received_msg.user_id
+    with begin_request(ssl_connect_sock, login_msg) as call:
+        received_msg = call.recv()
+        if received_msg is None:
+            print("客户端已断开连接。")
+            return None, None
+
+        if received_msg.tag.name == "SuccessLogin" and received_msg.username == inp_username:
+            print(f"登录成功: {received_msg}")
+            ''' 
+            建立监听接口，等待联系人连接
+            如果接收到到消息且接收者为本人
+            则将消息根据发送id保存到历史记录，等ui显示  
+            '''
+            # 通讯录较小时已内联在登录回复中，否则随后作为文件传输到达
+            if not save_inline_reply(received_msg, inp_username):
+                recv_large_data(ssl_connect_sock, received_msg.transfer_id, inp_username, call=call)
+
+            return received_msg.username, received_msg.user_id
     
     if received_msg.tag.name == "FailLogin" and received_msg.username == inp_username:
         print(f"登录失败: {received_msg}")
         return None, None
 
+    if received_msg.tag.name == "FailLogin" and received_msg.error_type == "server_busy":
+        print("服务器繁忙，连接已被拒绝，请稍后重试。")
+        return None, None
+
     return None, None
 
 # User to Client to Server
 def handle_logout(ssl_connect_sock, current_user):
     logout_msg = S.LogoutMsg(username=current_user, time=int(time.time()))
-    ssl_connect_sock.sendall(serialize(logout_msg))
     print("I'm in logout")
-    received_msg = recv_msg(ssl_connect_sock)
+    with begin_request(ssl_connect_sock, logout_msg) as call:
+        received_msg = call.recv()
     if received_msg is None:
         print("服务器端已断开连接。")
         return None
@@ -409,17 +628,18 @@ def handle_get_directory(ssl_connect_sock, current_user):
     try:
         # 1. 发送请求
         get_dir_msg = S.GetDirectoryMsg(username=current_user)
-        ssl_connect_sock.sendall(serialize(get_dir_msg))
-        
-        # 2. 等待服务器的 StartTransferMsg
-        response = recv_msg(ssl_connect_sock)
-        if isinstance(response, S.StartTransferMsg) and response.file_type == 'directory':
-            # 3. 如果是正确的开始信号，调用 recv_large_data 处理后续传输
-            recv_large_data(ssl_connect_sock, response.transfer_id, current_user)
-            return True
-        else:
-            print(f"[错误] 请求通讯录后收到意外的服务器响应: {type(response)}")
-            return False
+        with begin_request(ssl_connect_sock, get_dir_msg) as call:
+            # 2. 等待服务器的 StartTransferMsg（通讯录较小时是一条 DirectoryMsg）
+            response = call.recv()
+            if isinstance(response, S.DirectoryMsg):
+                return save_inline_reply(response, current_user)
+            if isinstance(response, S.StartTransferMsg) and response.file_type == 'directory':
+                # 3. 如果是正确的开始信号，调用 recv_large_data 处理后续传输
+                recv_large_data(ssl_connect_sock, response.transfer_id, current_user, start_msg=response, call=call)
+                return True
+            else:
+                print(f"[错误] 请求通讯录后收到意外的服务器响应: {type(response)}")
+                return False
             
     except Exception as e:
         print(f"获取通讯录时出错: {e}")
@@ -471,20 +691,26 @@ def handle_get_public_key(ssl_connect_sock, current_user_id, current_username):
         time=int(time.time())
     )
     
-    # 发送请求
-    # 注意：响应将作为文件传输异步到达，并由主监听循环处理，
-    # 而不是作为此函数的直接返回值。
+    # 发送请求，证书作为文件传输随后到达，接收后自动保存
     try:
-        ssl_connect_sock.sendall(serialize(request_msg))
-        print("请求已发送。证书将在片刻后接收并自动保存。")
+        with begin_request(ssl_connect_sock, request_msg) as call:
+            print("请求已发送，正在接收证书...")
+            response = call.recv()
+            if isinstance(response, S.PublicKeyMsg):
+                save_inline_reply(response, current_username)
+            elif isinstance(response, S.StartTransferMsg):
+                recv_large_data(ssl_connect_sock, response.transfer_id, current_username, start_msg=response, call=call)
+            else:
+                print(f"[错误] 未能获取 '{dest_username}' 的公钥: {response}")
     except Exception as e:
         print(f"发送请求失败: {e}")    
 
     print("I'm in get public key")
 
 # User to Client to Server: when the user is online and is leisure
-def handle_alive(ssl_connect_sock):
-    print("I'm in send alive")
+def handle_alive(ssl_connect_sock, user_id):
+    """发送心跳包，服务器不回复。"""
+    send_request(ssl_connect_sock, S.AliveMsg(user_id=user_id))
 
 # User to Client to Server: when close the chat window
 def handle_backup(ssl_connect_sock):
@@ -495,10 +721,8 @@ def handle_backup(ssl_connect_sock):
 '''
 def handle_send_message(ssl_connect_sock, msg: S.MessageMsg):
     try:
-        # The `serialize` function already creates the full payload with the length prefix.
-        # We just need to send its output directly. This fixes the "double prefix" bug.
-        payload = serialize(msg)
-        ssl_connect_sock.sendall(payload)
+        # 按该 P2P 连接协商出的编码发送
+        send_msg(ssl_connect_sock, msg)
         print("==== I'm in send message ====")
         return True
     except (BrokenPipeError, ConnectionResetError):
@@ -506,27 +730,27 @@ def handle_send_message(ssl_connect_sock, msg: S.MessageMsg):
         return False
 
 # *** 修正 #6: 重写P2P文件发送处理函数，使其正确且独立 ***
-def handle_send_voice(p2p_sock, current_user, file_name):
+def handle_send_voice(p2p_sock, current_user, file_name, receiver_name='', connect=None):
     """(P2P) 处理发送语音文件的请求，使用分块传输协议。"""
     if not file_name:
         print("文件名不能为空。")
         return False
     print("==== 准备发送语音... ====")
     # 调用新的P2P专用发送函数
-    return send_large_data_p2p(p2p_sock, current_user, 'audio', file_name)
+    return send_large_data_p2p(p2p_sock, current_user, 'audio', file_name, receiver_name, connect)
 
-def handle_send_file(p2p_sock, current_user, file_name):
+def handle_send_file(p2p_sock, current_user, file_name, receiver_name='', connect=None):
     """(P2P) 处理发送通用文件的请求。"""
     if not file_name:
         print("文件名不能为空。")
         return False
     print("==== 准备发送文件... ====")
-    return send_large_data_p2p(p2p_sock, current_user, 'file', file_name)
+    return send_large_data_p2p(p2p_sock, current_user, 'file', file_name, receiver_name, connect)
 
-def handle_send_image(p2p_sock, current_user, file_name):
+def handle_send_image(p2p_sock, current_user, file_name, receiver_name='', connect=None):
     """(P2P) 处理发送图片文件的请求。"""
     if not file_name:
         print("文件名不能为空。")
         return False
     print("==== 准备发送图片... ====")
-    return send_large_data_p2p(p2p_sock, current_user, 'image', file_name)
\ No newline at end of file
+    return send_large_data_p2p(p2p_sock, current_user, 'image', file_name, receiver_name, connect)
\ No newline at end of file
@@ -9,11 +9,23 @@ import os
 import pprint
 import math
 import base64
-from serializer import serialize, deserialize
+from serializer import serialize, deserialize, decode_frame, send_msg, note_peer_codec
 from dataclasses import asdict
-from typing import Any, Dict, List, Set
+from typing import Any, Dict, List, Optional, Set
 import hashlib
 import Contacts as C
+import threading
+from user_registry import UserRegistry, load_users_from_json, save_users_to_json
+from presence import get_presence_table
+from contact_index import get_contact_index, add_contact_listener
+from sessions import get_session_registry, SessionMonitor
+from locks import get_lock_manager
+from framing import FrameTooLargeError, read_frame
+from transfer import fits_inline, register_outgoing, resume_transfer, send_file_transfer, send_transfer
+from resume import STATUS_RESUME_UNAVAILABLE, get_outgoing_transfers
+from flow import deliver_ack
+from dispatch import register_handler, add_request_hook
+from capabilities import answer_hello
 
 # In Transaction_Server.py
 
@@ -55,8 +67,14 @@ def save_client_certificate(ssl_connect_sock: ssl.SSLSocket, username: str):
         save_dir = os.path.join('data', 'publickey', username)
         os.makedirs(save_dir, exist_ok=True) # 如果目录不存在，则创建它
 
-        # 4. 写入文件
+        # 4. 写入文件（证书未变化时跳过，登录不再产生重复的磁盘写入）
         file_path = os.path.join(save_dir, f"{username}_cert.pem")
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                if f.read() == pem_cert:
+                    return
+        except FileNotFoundError:
+            pass
         with open(file_path, 'w', encoding='utf-8') as f:
             f.write(pem_cert)
         
@@ -75,70 +93,49 @@ def verify_password(provided_password: str, stored_hash: str) -> bool:
     """验证提供的密码是否与存储的哈希值匹配。"""
     return hash_password(provided_password) == stored_hash
 
-def load_users_from_json(filename: str) -> List[Dict[str, Any]]:
-    """
-    从JSON文件加载用户列表。
-    如果文件不存在，则返回一个空列表。
-    """
-    try:
-        # 确保目录存在
-        db_dir = os.path.dirname(filename)
-        if db_dir and not os.path.exists(db_dir):
-            os.makedirs(db_dir)
-            
-        with open(filename, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        # 更新：如果文件不存在或为空返回空列表
-        print(f"[服务器日志] 未找到或无法解析 {filename}。将使用空的用户列表启动。")
-        return []
-
-def save_users_to_json(filename: str, users: List[Dict[str, Any]]) -> None:
-    """将用户列表保存到JSON文件。"""
-    with open(filename, 'w', encoding='utf-8') as f:
-        json.dump(users, f, indent=4, ensure_ascii=False)
-    print(f"[服务器日志] 用户数据已保存到 {filename}。")
+# 用户表常驻内存，按需在首次使用时加载（路径相对于服务器工作目录）
+_user_registry = None
+_user_registry_lock = threading.Lock()
+
+def get_user_registry() -> UserRegistry:
+    """返回进程内共享的用户表。"""
+    global _user_registry
+    if _user_registry is None:
+        with _user_registry_lock:
+            if _user_registry is None:
+                _user_registry = UserRegistry("data/users.json")
+    return _user_registry
 
 def recv_msg(ssl_connect_sock):
     try:
-        header_bytes = ssl_connect_sock.recv(4) # 先接收4个字节，表示数据长度
-        if not header_bytes:
+        # 通过该连接共用的缓冲读取器读取完整的一帧，TLS 的短读不会导致数据错位
+        json_bytes = read_frame(ssl_connect_sock)
+        if json_bytes is None:
             print("客户端可能已断开连接 (header is empty)。")
             return None
+        # 客户端使用二进制编码时，回复该连接也使用二进制编码
+        note_peer_codec(ssl_connect_sock, json_bytes)
 
-        datalength = int.from_bytes(header_bytes, byteorder='big')
-        
-        # 分块接收数据，确保接收完整
-        json_bytes_list = []
-        bytes_received = 0
-        while bytes_received < datalength:
-            chunk = ssl_connect_sock.recv(min(datalength - bytes_received, 4096))
-            if not chunk:
-                raise ConnectionError("客户端在传输数据时断开连接。")
-            json_bytes_list.append(chunk)
-            bytes_received += len(chunk)
-        
-        json_bytes = b''.join(json_bytes_list)
-
-        # 解码并反序列化为 dataclass 对象
-        msg_dict = json.loads(json_bytes.decode("UTF-8"))
-        received_msg = deserialize(msg_dict)
+        # 解码为 dataclass 对象（JSON 消息或二进制数据块）
+        received_msg = decode_frame(json_bytes)
         return received_msg
+    except FrameTooLargeError as e:
+        print(f"[服务器日志] 拒绝超长的帧，断开连接: {e}")
+        return None
     except (ConnectionError, ConnectionResetError):
         print("客户端连接中断。")
         return None
-    except json.JSONDecodeError as e:
-        print(f"JSON 解码错误: {e}")
+    except ValueError as e:
+        print(f"消息解码错误: {e}")
         return None
 
 # subpackage
-# 定义一个常量
-CHUNK_SIZE = 4096 # 每次发送 4KB，这是一个常用的大小
-
-def send_large_data(ssl_connect_sock, username: str, file_type: str, file_name: str, id: str):
+def send_large_data(ssl_connect_sock, username: str, file_type: str, file_name: str, id: str,
+                    data_bytes: Optional[bytes] = None):
     """
     将大的二进制数据分块发送给指定的socket。
     这个函数会处理整个 Start -> Chunk -> End 的流程，并根据 file_type 决定文件路径 -> data_bytes。 
+    调用者已经读取（或生成）了数据时通过 data_bytes 传入，不再重复读取。
 
     Args:
         ssl_connect_sock: 目标socket连接。
@@ -147,11 +144,14 @@ def send_large_data(ssl_connect_sock, username: str, file_type: str, file_name:
         file_name (str): 要传输的文件名。
         transfer_id (str): 本次传输的唯一ID。
     """
+    if data_bytes is not None:
+        return _transfer_data(ssl_connect_sock, file_type, file_name, id, data_bytes)
+
     filepath = ""
     # 1. 根据文件类型确定文件路径
     # 注意：这里的路径是服务器端的存储结构
     if file_type == 'directory':
-        # 通讯录文件直接在 'data/directory' 目录下，以用户名命名
+        # 通讯录在发送时生成，合并了好友的实时在线状态
         filepath = f'data/directory/{username}.json'
     elif file_type == 'publickey':
         filepath = f'data/publickey/{username}/{username}_cert.pem'
@@ -165,21 +165,23 @@ def send_large_data(ssl_connect_sock, username: str, file_type: str, file_name:
         print(f"[服务器错误] 不支持的文件类型: {file_type}")
         return False
 
-    # 2. 读取文件内容
+    # 2. 读取文件内容（磁盘上的文件只检查大小，发送时流式读取，不整体读入内存）
     try:
         # 确保目录存在（对于未来可能的上传功能有好处）
         server_storage_dir = os.path.dirname(filepath)
         if not os.path.exists(server_storage_dir):
             os.makedirs(server_storage_dir)
 
-        with open(filepath, 'rb') as f:
-            data_bytes = f.read()
+        if file_type == 'directory':
+            data_bytes = build_directory_bytes(username)
+        elif not os.path.isfile(filepath):
+            raise FileNotFoundError(filepath)
     except FileNotFoundError:
         print(f"[服务器错误] 传输失败: 文件 '{filepath}' 未找到。")
         # （可选）可以发送一个 'cancelled' 状态的 EndTransferMsg
         try:
             end_msg = S.EndTransferMsg(transfer_id = id, status='cancelled_not_found')
-            ssl_connect_sock.sendall(serialize(end_msg))
+            send_msg(ssl_connect_sock, end_msg)
         except Exception:
             pass
         return False
@@ -187,88 +189,132 @@ def send_large_data(ssl_connect_sock, username: str, file_type: str, file_name:
         print(f"[服务器错误] 读取文件 '{filepath}' 时出错: {e}")
         return False  
     
-    # 3. 开始传输流程
-    try:
-        # 3.1 准备元数据
-        total_size = len(data_bytes)
-        total_chunks = math.ceil(total_size / CHUNK_SIZE)
-
-        # 3.2 发送 StartTransferMsg (包含新的 file_type 字段)
-        start_msg = S.StartTransferMsg(
-            transfer_id = id,
-            file_type = file_type,
-            file_name = file_name,
-            total_size = total_size,
-            total_chunks = total_chunks,
-            chunk_size = CHUNK_SIZE
-        )
-        ssl_connect_sock.sendall(serialize(start_msg))
-        print(f"[服务器日志] 开始传输 '{file_name}' (类型: {file_type}, ID: {id}), 共 {total_chunks} 块。")
-
-        # 3.3 循环发送 DataChunkMsg
-        for i in range(total_chunks):
-            start = i * CHUNK_SIZE
-            end = start + CHUNK_SIZE
-            data_chunk = data_bytes[start:end]
-            encoded_chunk_str = base64.b64encode(data_chunk).decode('ascii')
-            
-            chunk_msg = S.DataChunkMsg(
-                transfer_id = id,
-                chunk_index = i,
-                data = encoded_chunk_str
-            )
-            ssl_connect_sock.sendall(serialize(chunk_msg))
+    return _transfer_data(ssl_connect_sock, file_type, file_name, id, data_bytes, filepath)
+
+# 服务器作为发送端登记的可续传传输（磁盘上的大文件），重启后仍然有效
+OUTGOING_TRANSFERS_FILE = os.path.join('data', 'outgoing_transfers.json')
 
-        # 3.4 发送 EndTransferMsg
-        end_msg = S.EndTransferMsg(transfer_id = id, status = 'success')
-        ssl_connect_sock.sendall(serialize(end_msg))
-        print(f"[服务器日志] 传输 '{file_name}' (ID: {id}) 完成。")
+def _transfer_data(ssl_connect_sock, file_type: str, file_name: str, id: str,
+                   data_bytes: Optional[bytes], filepath: str = "") -> bool:
+    # 3. 开始传输流程（Start -> 二进制数据块 -> End）；没有 data_bytes 时从 filepath 流式发送
+    try:
+        # 块大小取决于与该客户端的能力协商结果（旧客户端仍为 4KB）
+        size = len(data_bytes) if data_bytes is not None else os.path.getsize(filepath)
+        print(f"[服务器日志] 开始传输 '{file_name}' (类型: {file_type}, ID: {id}), {size} 字节。")
+        if data_bytes is not None:
+            total_chunks = send_transfer(ssl_connect_sock, id, file_type, file_name, data_bytes)
+        else:
+            content_hash = register_outgoing(ssl_connect_sock, get_outgoing_transfers(OUTGOING_TRANSFERS_FILE), id,
+                                             file_type, file_name, filepath,
+                                             getattr(ssl_connect_sock, 'username', None) or '')
+            total_chunks = send_file_transfer(ssl_connect_sock, id, file_type, file_name, filepath,
+                                              content_hash=content_hash)
+        print(f"[服务器日志] 传输 '{file_name}' (ID: {id}) 完成，共 {total_chunks} 块。")
         return True
 
     except Exception as e:
         print(f"[服务器错误] 传输 '{file_name}' 失败: {e}")
         try:
             end_msg = S.EndTransferMsg(transfer_id = id, status = 'cancelled')
-            ssl_connect_sock.sendall(serialize(end_msg))
+            send_msg(ssl_connect_sock, end_msg)
         except Exception:
             pass
         return False
 
 # --- END OF MODIFICATION ---
-def update_friends_contact_status(username: str, status: str, new_address: str):
+def read_public_key(username: str) -> Optional[bytes]:
+    """读取用户登录时保存的证书；不存在或读取失败时返回 None。"""
+    try:
+        with open(f'data/publickey/{username}/{username}_cert.pem', 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def build_directory_bytes(username: str) -> bytes:
     """
-    更新所有好友通讯录中关于指定用户的状态和地址。
-    
-    Args:
-        username (str): 状态和地址发生改变的用户的名字。
-        status (str): 新的状态 ('online' or 'offline')。
-        new_address (str): 新的地址 (e.g., "127.0.0.1:11000") 或空字符串。
+    生成发送给客户端的通讯录内容。
+    联系人的在线状态和地址来自内存中的在线状态表，在发送时才合并进去。
     """
-    directory_path = 'data/directory'
-    for user_file in os.listdir(directory_path):
-        if not user_file.endswith('.json'):
-            continue
-        filepath = os.path.join(directory_path, user_file)
-        try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                # 加载整个通讯录文件数据
-                data = json.load(f)
-            
-            contacts = data.get('contacts', [])
-            updated = False
-            for contact in contacts:
-                if contact.get('name') == username:
-                    contact['status'] = status
-                    contact['address'] = new_address # 更新地址
-                    updated = True
-                    break # 找到后即可退出内循环
-            
-            if updated:
-                # 保存整个修改后的 data 对象，以保留 messages 等其他数据
-                with open(filepath, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, indent=4, ensure_ascii=False)
-        except Exception as e:
-            print(f"[通讯录同步错误] 更新 {filepath} 时出错: {e}")
+    presence = get_presence_table()
+    contact_manager = C.open_contact_manager(username)
+    directory = {
+        "contacts": contact_manager.get_contacts_with_status(presence, address_of=presence.address_of),
+        "messages": contact_manager.messages
+    }
+    return json.dumps(directory, indent=4, ensure_ascii=False).encode('utf-8')
+
+def push_to_user(username: str, msg: Any) -> bool:
+    """
+    把一条推送交给已订阅推送的在线用户的会话，返回是否已放入其推送队列。
+    推送由该会话自己的推送线程发送（见 ClientSession.push），好友的连接卡住不会阻塞调用者。
+    """
+    session = get_session_registry().get(username)
+    if session is None or not session.subscribed:
+        return False
+    if not session.push(msg, send_msg):
+        print(f"[推送] '{username}' 的推送积压过多，已丢弃 {msg.tag.name} 并关闭连接。")
+        return False
+    return True
+
+def notify_presence_change(username: str, status: str, address: str):
+    """把 username 的上线/下线事件推送给通讯录中包含他的在线好友。"""
+    event = S.PresenceEventMsg(username=username, status=status, address=address)
+    pushed = 0
+    for friend_name in get_contact_index().followers(username):
+        if push_to_user(friend_name, event):
+            pushed += 1
+    if pushed:
+        print(f"[推送] 已向 {pushed} 位在线好友推送 '{username}' 的状态: {status}")
+
+def notify_contact_added(owner: str, contact_name: str):
+    """owner 的通讯录新增联系人时，向 owner 推送通讯录变化。"""
+    presence = get_presence_table()
+    event = S.ContactEventMsg(
+        owner = owner,
+        contact_name = contact_name,
+        action = 'added',
+        status = 'online' if presence.is_online(contact_name) else 'offline',
+        address = presence.address_of(contact_name)
+    )
+    push_to_user(owner, event)
+
+add_contact_listener(notify_contact_added)
+
+# --- 心跳与会话过期 ---
+
+_session_monitor = None
+_session_monitor_lock = threading.Lock()
+
+def get_session_monitor() -> SessionMonitor:
+    """返回进程内共享的心跳监视器（首次使用时启动后台线程）。"""
+    global _session_monitor
+    if _session_monitor is None:
+        with _session_monitor_lock:
+            if _session_monitor is None:
+                _session_monitor = SessionMonitor(on_expire=expire_session)
+    return _session_monitor
+
+def note_session_activity(msg: Any, ctx: Any):
+    """收到已登录用户的任何消息都视为一次心跳。"""
+    username = getattr(ctx.sock, 'username', None)
+    if username:
+        get_session_monitor().touch(username)
+        get_presence_table().touch(username)
+
+def expire_session(username: str):
+    """心跳超时：把用户标记为下线，通知好友，并关闭其连接。"""
+    with get_lock_manager().locked(username):
+        session = get_session_registry().get(username)
+        if session is None or not get_session_registry().unregister(username, session):
+            return
+        session.username = None
+        session.subscribed = False
+        get_presence_table().set_offline(username)
+    notify_presence_change(username, 'offline', '')
+    print(f"[心跳] 用户 '{username}' 超过 {get_session_monitor().timeout} 秒无响应，已标记为下线。")
+    session.close_connection()
+
+add_request_hook(note_session_activity)
 
 # --- MODIFICATION END ---
 
@@ -278,10 +324,9 @@ def update_friends_contact_status(username: str, status: str, new_address: str):
 '''
 def handle_register(msg: S.RegisterMsg, ssl_connect_sock: ssl.SSLSocket):
     print("I'm in register")         
-    # 启动时加载用户数据
-    USER_LIST = load_users_from_json("data/users.json")
+    registry = get_user_registry()
 
-    if any(user.get('username') == msg.username for user in USER_LIST):
+    if msg.username in registry:
         response = S.FailRegisterMsg(error_type="username_exists", username=msg.username)
         return response
 
@@ -298,15 +343,17 @@ def handle_register(msg: S.RegisterMsg, ssl_connect_sock: ssl.SSLSocket):
         "created_at" : int(time.time()),
         "address"    : None
     }
-    USER_LIST.append(new_user_record)
-    
-    # 将更新后的用户列表保存到文件
-    save_users_to_json("data/users.json", USER_LIST)
-    
-    user_dic = C.ContactManager(msg.username)
-    user_dic._save_data()
 
-    save_client_certificate(ssl_connect_sock, msg.username)
+    with get_lock_manager().locked(msg.username):
+        # 写入内存用户表并追加一条日志；并发注册同名用户时只有一个会成功
+        if not registry.add(new_user_record):
+            response = S.FailRegisterMsg(error_type="username_exists", username=msg.username)
+            return response
+
+        user_dic = C.open_contact_manager(msg.username)
+        user_dic._save_data()
+
+        save_client_certificate(ssl_connect_sock, msg.username)
     
     print(f"[服务器日志] 用户 '{msg.username}' 创建成功, user_id: {new_user_id}。\n") # 应该查看使用否有对应的通讯录文件
     response = S.SuccessRegisterMsg(
@@ -322,16 +369,9 @@ def handle_login(msg: S.LoginMsg, user_ip, user_port, ssl_connect_sock):
     '''读取json
     6. 更新用户在线状态，保存监听端口信息
     '''
-    USER_LIST = load_users_from_json("data/users.json")
-
-    user_record = None
+    user_record = get_user_registry().get_by_name(msg.username)
     login_identifier = msg.username # or msg.user_id
 
-    for record in USER_LIST:
-        if (msg.username and record.get('username') == msg.username):
-            user_record = record
-            break
-    
     if not user_record:
         print(f"[服务器日志] 校验失败: 提供的标识符 '{login_identifier}' 未找到对应用户。\n")
         response = S.FailLoginMsg(error_type="user_not_found", username=msg.username, time=int(time.time()))
@@ -345,18 +385,18 @@ def handle_login(msg: S.LoginMsg, user_ip, user_port, ssl_connect_sock):
         # 更新：检查 user_id
         if found_username and 'user_id' in user_record:
 
-            save_client_certificate(ssl_connect_sock, found_username)
-
             port = msg.port
-            user_record['address'] = f"{user_ip}:{port}"
-            save_users_to_json("data/users.json", USER_LIST) 
-            # 更新用户列表 这一步也应该更新该用户好友的通讯录
-            '''
-            1. 根据该用户通讯录中的好友，查找好友的通讯录（无则跳过）
-            2. 在好友的通讯录中，更新当前用户的状态
-            3. 调用通讯录更新函数，向好友发送当前用户的状态
-            '''
-            update_friends_contact_status(found_username, 'online', user_record['address'])
+            address = f"{user_ip}:{port}"
+            # 同一用户的登录/注销/断开在该用户的条带锁内完成，不同用户互不阻塞
+            with get_lock_manager().locked(found_username):
+                save_client_certificate(ssl_connect_sock, found_username)
+                # 在线状态与地址只保存在内存中，好友请求通讯录时再合并
+                get_presence_table().set_online(found_username, address)
+                # 记录该连接上登录的用户，断开连接时据此下线
+                ssl_connect_sock.username = found_username
+                get_session_registry().register(found_username, ssl_connect_sock)
+                get_session_monitor().touch(found_username)
+            notify_presence_change(found_username, 'online', address)
             
             print(f"[服务器日志] 用户 '{found_username}' 验证成功。\n")
 
@@ -367,21 +407,27 @@ def handle_login(msg: S.LoginMsg, user_ip, user_port, ssl_connect_sock):
                 user_id = user_record['user_id'], 
                 directory = "directory.json") 
             # 需要传送通讯录数据
-
-            ssl_connect_sock.sendall(serialize(response))
             
             try:
                 # with open('data/directory/'+found_username+'.json', 'rb') as f: # 以二进制模式读取 , 文件名！！！！
                 #     directory_bytes = f.read()
-                
-                # 调用分包发送函数
-                send_large_data(
-                    ssl_connect_sock = ssl_connect_sock,
-                    username = found_username,
-                    file_type = "directory",
-                    file_name = f"{found_username}.json",
-                    id = transfer_id
-                )
+                directory_bytes = build_directory_bytes(found_username)
+                if fits_inline(ssl_connect_sock, len(directory_bytes)):
+                    # 通讯录很小：直接放在 SuccessLoginMsg 中，一帧完成登录
+                    response.transfer_id = ""
+                    response.directory = directory_bytes.decode('utf-8')
+                    send_msg(ssl_connect_sock, response)
+                else:
+                    send_msg(ssl_connect_sock, response)
+                    # 调用分包发送函数
+                    send_large_data(
+                        ssl_connect_sock = ssl_connect_sock,
+                        username = found_username,
+                        file_type = "directory",
+                        file_name = f"{found_username}.json",
+                        id = transfer_id,
+                        data_bytes = directory_bytes
+                    )
 
             except FileNotFoundError:
                 print(f"[服务器错误] 未找到通讯录文件。")
@@ -393,27 +439,32 @@ def handle_login(msg: S.LoginMsg, user_ip, user_port, ssl_connect_sock):
         else:
             print(f"[服务器错误] 数据库记录不完整，无法为用户 '{login_identifier}' 创建成功登录响应。\n")
             response = S.FailLoginMsg(username = found_username, error_type="server_error", time=int(time.time()))
-            ssl_connect_sock.sendall(serialize(response))
+            send_msg(ssl_connect_sock, response)
 
     else:
         print(f"[服务器日志] 校验失败: 用户 '{found_username or login_identifier}' 的密码不正确。\n")
         response = S.FailLoginMsg( username=found_username, error_type="incorrect_secret", time=int(time.time()))
-        ssl_connect_sock.sendall(serialize(response))
+        send_msg(ssl_connect_sock, response)
 
-def handle_logout(msg: S.LogoutMsg):
+def handle_logout(msg: S.LogoutMsg, ssl_connect_sock):
     print("I'm in logout")
-    USER_LIST = load_users_from_json("data/users.json")
-    user_record = None
-    for record in USER_LIST:
-        if record.get('username') == msg.username:
-            user_record = record
-            break
+    # 与订阅相同：只允许注销本连接上登录的用户，否则任何连接都能让别人“下线”
+    if getattr(ssl_connect_sock, 'username', None) != msg.username:
+        print(f"[服务器日志] 拒绝注销: '{msg.username}' 未在此连接上登录。\n")
+        return None
+    user_record = get_user_registry().get_by_name(msg.username)
     if not user_record:
         print(f"[服务器日志] 注销失败: 用户 '{msg.username}' 未找到。\n")
         return None
-    user_record['address'] = ""
-    save_users_to_json("data/users.json", USER_LIST)
-    update_friends_contact_status(msg.username, 'offline', '')
+    with get_lock_manager().locked(msg.username):
+        get_presence_table().set_offline(msg.username)
+        get_session_monitor().remove(msg.username)
+        session = get_session_registry().get(msg.username)
+        if session is not None:
+            get_session_registry().unregister(msg.username, session)
+            session.username = None
+            session.subscribed = False
+    notify_presence_change(msg.username, 'offline', '')
 
     print(f"[服务器日志] 用户 '{msg.username}' 注销成功。\n")
     response = S.SuccessLogoutMsg(username=msg.username, user_id=user_record['user_id'], time=int(time.time()))
@@ -431,14 +482,22 @@ def handle_send_directory(msg: S.GetDirectoryMsg, ssl_connect_sock):
         transfer_id = str(uuid.uuid4())
         directory_filename = f"{username}.json"
 
-        # 直接调用 send_large_data 发送通讯录
-        success = send_large_data(
-            ssl_connect_sock = ssl_connect_sock,
-            username = msg.username,
-            file_type = "directory",
-            file_name = directory_filename,
-            id = transfer_id
-        )
+        directory_bytes = build_directory_bytes(username)
+        if fits_inline(ssl_connect_sock, len(directory_bytes)):
+            # 通讯录很小：用一条 DirectoryMsg 回复，不走分块传输
+            send_msg(ssl_connect_sock, S.DirectoryMsg(
+                transfer_id=transfer_id, data=directory_bytes.decode('utf-8'), username=username))
+            success = True
+        else:
+            # 直接调用 send_large_data 发送通讯录
+            success = send_large_data(
+                ssl_connect_sock = ssl_connect_sock,
+                username = msg.username,
+                file_type = "directory",
+                file_name = directory_filename,
+                id = transfer_id,
+                data_bytes = directory_bytes
+            )
         print("I'm in send directory")
         if success:
             print(f"[服务器日志] 已为 '{username}' 启动通讯录传输。")
@@ -467,14 +526,23 @@ def handle_get_public_key(msg: S.GetPublicKeyMsg, ssl_connect_sock: ssl.SSLSocke
         transfer_id = str(uuid.uuid4())
         cert_filename = f"{target_name}_cert.pem"
         
-        # 直接调用 send_large_data 开始传输
-        success = send_large_data(
-            ssl_connect_sock = ssl_connect_sock,
-            username = target_name, # 公钥属于 target_name
-            file_type = "publickey",
-            file_name = cert_filename,
-            id = transfer_id
-        )
+        cert_bytes = read_public_key(target_name)
+        if cert_bytes is not None and fits_inline(ssl_connect_sock, len(cert_bytes)):
+            # 证书只有 1~2KB：用一条 PublicKeyMsg 回复，不走分块传输
+            send_msg(ssl_connect_sock, S.PublicKeyMsg(
+                request_name=requester_name, target_name=target_name,
+                transfer_id=transfer_id, public_key=cert_bytes.decode('ascii')))
+            success = True
+        else:
+            # 直接调用 send_large_data 开始传输（证书不存在时由它发送取消的 EndTransferMsg）
+            success = send_large_data(
+                ssl_connect_sock = ssl_connect_sock,
+                username = target_name, # 公钥属于 target_name
+                file_type = "publickey",
+                file_name = cert_filename,
+                id = transfer_id,
+                data_bytes = cert_bytes
+            )
         if success:
             print(f"[服务器日志] 已成功为 '{requester_name}' 启动 '{target_name}' 的公钥传输。")
         else:
@@ -486,3 +554,100 @@ def handle_get_public_key(msg: S.GetPublicKeyMsg, ssl_connect_sock: ssl.SSLSocke
     # 该函数自己处理发送，返回 None
     return None
 
+def handle_resume_transfer(msg: S.ResumeTransferMsg, ssl_connect_sock):
+    """
+    续传请求：客户端重新连接并登录后，为上次没有收完的传输发来 ResumeTransfer，
+    只重发它缺少的数据块。只接受本连接上登录的用户对发给他自己的传输的请求。
+    """
+    username = getattr(ssl_connect_sock, 'username', None)
+    if not username:
+        return S.EndTransferMsg(transfer_id=msg.transfer_id, status=STATUS_RESUME_UNAVAILABLE)
+    try:
+        sent = resume_transfer(ssl_connect_sock, msg, get_outgoing_transfers(OUTGOING_TRANSFERS_FILE), username)
+        if sent:
+            print(f"[服务器日志] 续传 (ID: {msg.transfer_id}) 完成，补发 {sent} 块。")
+        else:
+            print(f"[服务器日志] 无法续传 (ID: {msg.transfer_id})，已通知用户 '{username}'。")
+    except Exception as e:
+        print(f"[服务器错误] 续传 (ID: {msg.transfer_id}) 失败: {e}")
+        try:
+            send_msg(ssl_connect_sock, S.EndTransferMsg(transfer_id=msg.transfer_id, status='cancelled'))
+        except Exception:
+            pass
+    return None
+
+def handle_transfer_ack(msg: S.TransferAckMsg, ssl_connect_sock):
+    """
+    传输确认：发送端等待确认时会自己读取连接并把确认交给窗口（见 flow.set_ack_reader），
+    走到这里的是窗口不需要等待时到达的确认，交给仍在进行的传输，传输已结束时忽略。不回复。
+    """
+    deliver_ack(ssl_connect_sock, msg)
+    return None
+
+def handle_subscribe(msg: S.SubscribeMsg, ssl_connect_sock):
+    """
+    处理推送订阅请求：此后该连接会收到好友上下线 (PresenceEventMsg)
+    和通讯录变化 (ContactEventMsg) 的推送。只允许订阅本连接上登录的用户。
+    """
+    username = getattr(ssl_connect_sock, 'username', None)
+    if username is None or username != msg.username:
+        print(f"[推送] 拒绝订阅: '{msg.username}' 未在此连接上登录。")
+        return None
+    ssl_connect_sock.subscribed = True
+    print(f"[推送] 用户 '{username}' 已订阅在线状态推送。")
+    return None
+
+def handle_alive(msg: S.AliveMsg):
+    """
+    心跳包：续期已在 note_session_activity 中完成（任何消息都会续期），
+    这里不回复，保持空闲客户端的开销最小。
+    """
+    return None
+
+def handle_hello(msg: S.HelloMsg, ssl_connect_sock):
+    """
+    能力协商：客户端在 TLS 握手后立即发送 Hello，服务器用 JSON 回复 HelloAck，
+    之后该连接改用双方都支持的编码和块大小。没有发送 Hello 的旧客户端保持原来的行为。
+    服务器发送的通讯录和证书都不大，也不接受客户端加入分条传输的连接，并行连接数协商为 1。
+    """
+    caps = answer_hello(ssl_connect_sock, msg, max_streams=1)
+    print(f"[服务器日志] 能力协商完成: 编码 {caps.codec}, 数据块 {caps.chunk_size} 字节, "
+          f"特性 {caps.features}")
+    return None
+
+def handle_disconnect(ssl_connect_sock):
+    """
+    连接关闭时调用：如果该连接上的用户没有注销就断开了，
+    把他标记为下线并通知在线好友。
+    """
+    username = getattr(ssl_connect_sock, 'username', None)
+    if not username:
+        return
+    ssl_connect_sock.username = None
+    # 同一用户已在其他连接上重新登录时，旧连接断开不影响在线状态
+    with get_lock_manager().locked(username):
+        went_offline = get_session_registry().unregister(username, ssl_connect_sock)
+        if went_offline:
+            get_session_monitor().remove(username)
+            get_presence_table().set_offline(username)
+    if went_offline:
+        notify_presence_change(username, 'offline', '')
+        print(f"[服务器日志] 用户 '{username}' 的连接已断开，已标记为下线。")
+
+# =================================================================
+#           请求处理表（MTserver.py 与 server.py 共用）
+# =================================================================
+# 处理函数签名统一为 fn(msg, ctx)，返回值不为 None 时由 dispatch 发送给客户端。
+# 新的消息类型只需在这里注册，例如：
+#   register_handler(S.MsgTag.GetHistory, lambda msg, ctx: handle_get_history(msg))
+
+register_handler(S.MsgTag.Login,        lambda msg, ctx: handle_login(msg, ctx.user_ip, ctx.user_port, ctx.sock))
+register_handler(S.MsgTag.Register,     lambda msg, ctx: handle_register(msg, ctx.sock))
+register_handler(S.MsgTag.Logout,       lambda msg, ctx: handle_logout(msg, ctx.sock))
+register_handler(S.MsgTag.GetDirectory, lambda msg, ctx: handle_send_directory(msg, ctx.sock))
+register_handler(S.MsgTag.GetPublicKey, lambda msg, ctx: handle_get_public_key(msg, ctx.sock))
+register_handler(S.MsgTag.Subscribe,    lambda msg, ctx: handle_subscribe(msg, ctx.sock))
+register_handler(S.MsgTag.Alive,        lambda msg, ctx: handle_alive(msg))
+register_handler(S.MsgTag.Hello,        lambda msg, ctx: handle_hello(msg, ctx.sock))
+register_handler(S.MsgTag.ResumeTransfer, lambda msg, ctx: handle_resume_transfer(msg, ctx.sock))
+register_handler(S.MsgTag.TransferAck,  lambda msg, ctx: handle_transfer_ack(msg, ctx.sock))
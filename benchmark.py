@@ -0,0 +1,662 @@
+"""
+服务器端性能基准测试。
+
+    python benchmark.py contacts [--contacts 10000] [--messages 1000000] [--ops 5]
+    python benchmark.py frames [--megabytes 64]
+    python benchmark.py chunks [--megabytes 16]
+    python benchmark.py messages [--iterations 20000]
+    python benchmark.py writes [--megabytes 32] [--certs .]
+    python benchmark.py stream [--megabytes 256]
+    python benchmark.py stripes [--megabytes 128] [--streams 1,2,4,8] [--per-stream-mbps 25] [--certs .]
+
+所有测试都在临时目录中运行，不会改动仓库里的 data/ 目录。
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+@contextlib.contextmanager
+def temp_workdir():
+    """切换到临时目录运行，结束后删除。"""
+    old_cwd = os.getcwd()
+    path = tempfile.mkdtemp(prefix="chat-bench-")
+    os.chdir(path)
+    try:
+        yield path
+    finally:
+        os.chdir(old_cwd)
+        shutil.rmtree(path, ignore_errors=True)
+
+def timed(fn, repeat: int) -> float:
+    """执行 fn repeat 次，返回平均耗时（毫秒）；屏蔽被测代码的日志输出。"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for i in range(repeat):
+            fn(i)
+        elapsed = time.perf_counter() - start
+    return elapsed / repeat * 1000
+
+def print_table(title: str, rows):
+    print(f"\n== {title} ==")
+    width = max(len(name) for name, _ in rows)
+    for name, value in rows:
+        print(f"  {name.ljust(width)}  {value}")
+
+# --- 通讯录存储后端 ---
+
+def make_directory(contact_count: int, message_count: int):
+    """生成 contact_count 个联系人、共 message_count 条消息（平均分给各联系人）的通讯录。"""
+    now = int(time.time())
+    contacts = [{
+        "id": i + 1,
+        "name": f"friend-{i}",
+        "status": "offline",
+        "preview": "hello",
+        "time": now - i,
+        "address": ""
+    } for i in range(contact_count)]
+    messages = {}
+    for i in range(message_count):
+        messages.setdefault(f"friend-{i % contact_count}", []).append(
+            {"sender": "user" if i % 2 else "contact", "content": f"message {i}", "time": now - message_count + i})
+    return contacts, messages
+
+def bench_contacts(args):
+    import Contacts as C
+
+    print(f"生成 {args.contacts} 个联系人、{args.messages} 条消息...")
+    contacts, messages = make_directory(args.contacts, args.messages)
+    owner = "bench"
+    results = {}
+
+    with temp_workdir():
+        os.makedirs(os.path.join('data', 'directory'))
+
+        # JSON 后端：直接写出通讯录文件
+        filepath = os.path.join('data', 'directory', f"{owner}.json")
+        start = time.perf_counter()
+        with open(filepath, 'w', encoding='utf-8') as f:
+            json.dump({"contacts": contacts, "messages": messages}, f, indent=4, ensure_ascii=False)
+        print(f"JSON 文件写入完成: {os.path.getsize(filepath) / 1e6:.1f} MB, {time.perf_counter() - start:.1f} s")
+
+        json_manager = C.ContactManager(owner)
+        results["json"] = [
+            ("读取联系人列表", timed(lambda i: C.ContactManager(owner).contacts, args.ops)),
+            ("读取完整通讯录", timed(lambda i: (lambda m: (m.contacts, m.messages))(C.ContactManager(owner)), args.ops)),
+            ("更新已有联系人", timed(lambda i: json_manager.update_or_add_contact(f"friend-{i}", "", "hi"), args.ops)),
+            ("新增联系人", timed(lambda i: json_manager.update_or_add_contact(f"new-{i}", "", "hi"), args.ops)),
+            ("追加消息", timed(lambda i: json_manager.add_message(f"friend-{i}", "user", "hi"), args.ops)),
+            ("按名称查找联系人", timed(lambda i: json_manager.get_contact_by_name(f"friend-{i}"), args.ops)),
+        ]
+
+        # SQLite 后端：首次打开时从同一个 JSON 文件导入
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            sqlite_manager = C.SqliteContactManager(owner)
+        print(f"SQLite 导入完成: {time.perf_counter() - start:.1f} s")
+        results["sqlite"] = [
+            ("读取联系人列表", timed(lambda i: C.SqliteContactManager(owner).contacts, args.ops)),
+            ("读取完整通讯录", timed(lambda i: (lambda m: (m.contacts, m.messages))(C.SqliteContactManager(owner)), args.ops)),
+            ("更新已有联系人", timed(lambda i: sqlite_manager.update_or_add_contact(f"friend-{i}", "", "hi"), args.ops)),
+            ("新增联系人", timed(lambda i: sqlite_manager.update_or_add_contact(f"new-{i}", "", "hi"), args.ops)),
+            ("追加消息", timed(lambda i: sqlite_manager.add_message(f"friend-{i}", "user", "hi"), args.ops)),
+            ("按名称查找联系人", timed(lambda i: sqlite_manager.get_contact_by_name(f"friend-{i}"), args.ops)),
+        ]
+
+    rows = []
+    for (name, json_ms), (_, sqlite_ms) in zip(results["json"], results["sqlite"]):
+        rows.append((name, f"json {json_ms:10.3f} ms   sqlite {sqlite_ms:8.3f} ms   "
+                           f"x{json_ms / sqlite_ms if sqlite_ms else float('inf'):.1f}"))
+    print_table(f"通讯录存储后端 ({args.contacts} 联系人 / {args.messages} 消息，每项 {args.ops} 次取平均)", rows)
+
+# --- 帧读取 ---
+
+def legacy_read_frame(sock):
+    """改造前服务器端的读取方式：recv(4)，再按 4KB 分块 recv 后 join。"""
+    header_bytes = sock.recv(4)
+    if not header_bytes:
+        return None
+    datalength = int.from_bytes(header_bytes, byteorder='big')
+    chunks = []
+    received = 0
+    while received < datalength:
+        chunk = sock.recv(min(datalength - received, 4096))
+        if not chunk:
+            raise ConnectionError
+        chunks.append(chunk)
+        received += len(chunk)
+    return b''.join(chunks)
+
+def frame_throughput(read_frame, frame_size: int, frame_count: int) -> float:
+    """通过本地 socketpair 发送 frame_count 个帧，返回接收端每秒读取的帧数。"""
+    from framing import FRAME_HEADER
+
+    frame = FRAME_HEADER.pack(frame_size) + os.urandom(frame_size)
+    batch = frame * max(1, 65536 // len(frame))
+    per_batch = len(batch) // len(frame)
+    sender, receiver = socket.socketpair()
+
+    def send_all():
+        sent = 0
+        while sent < frame_count:
+            count = min(per_batch, frame_count - sent)
+            sender.sendall(batch if count == per_batch else frame * count)
+            sent += count
+        sender.close()
+
+    t = threading.Thread(target=send_all, daemon=True)
+    start = time.perf_counter()
+    t.start()
+    received = 0
+    while read_frame(receiver) is not None:
+        received += 1
+    elapsed = time.perf_counter() - start
+    t.join()
+    receiver.close()
+    assert received == frame_count, (received, frame_count)
+    return frame_count / elapsed
+
+def bench_frames(args):
+    from framing import get_frame_reader
+
+    rows = []
+    for frame_size in (64, 1024, 16 * 1024, 256 * 1024, 4 * 1024 * 1024):
+        frame_count = max(10, args.megabytes * 1024 * 1024 // frame_size)
+        frame_count = min(frame_count, 500000)
+        legacy = frame_throughput(legacy_read_frame, frame_size, frame_count)
+        buffered = frame_throughput(lambda sock: get_frame_reader(sock).read_frame(), frame_size, frame_count)
+        rows.append((f"{frame_size} B x {frame_count}",
+                     f"旧实现 {legacy:10.0f} 帧/s {legacy * frame_size / 1e6:8.1f} MB/s   "
+                     f"FrameReader {buffered:10.0f} 帧/s {buffered * frame_size / 1e6:8.1f} MB/s   "
+                     f"x{buffered / legacy:.1f}"))
+    print_table("长度前缀帧读取吞吐量 (本地 socketpair)", rows)
+
+# --- 数据块编码 ---
+
+def bench_chunks(args):
+    import base64
+    import json
+    import uuid
+    import schema as S
+    from serializer import serialize, deserialize, serialize_chunk, decode_frame
+    from transfer import CHUNK_SIZE, chunk_data
+
+    data = os.urandom(args.megabytes * 1024 * 1024)
+    view = memoryview(data)
+    transfer_id = str(uuid.uuid4())
+    chunk_count = (len(data) + CHUNK_SIZE - 1) // CHUNK_SIZE
+    chunks = [view[i * CHUNK_SIZE:(i + 1) * CHUNK_SIZE] for i in range(chunk_count)]
+
+    def legacy_encode():
+        return [serialize(S.DataChunkMsg(transfer_id=transfer_id, chunk_index=i,
+                                         data=base64.b64encode(chunk).decode('ascii')))
+                for i, chunk in enumerate(chunks)]
+
+    def legacy_decode(frames):
+        return b''.join(base64.b64decode(deserialize(json.loads(frame[4:].decode("UTF-8"))).data)
+                        for frame in frames)
+
+    def binary_encode():
+        return [serialize_chunk(transfer_id, i, chunk) for i, chunk in enumerate(chunks)]
+
+    def binary_decode(frames):
+        return b''.join(chunk_data(decode_frame(memoryview(frame)[4:])) for frame in frames)
+
+    rows = []
+    results = {}
+    for name, encode, decode in (("JSON + base64", legacy_encode, legacy_decode),
+                                 ("二进制块帧", binary_encode, binary_decode)):
+        start = time.perf_counter()
+        frames = encode()
+        encode_s = time.perf_counter() - start
+        start = time.perf_counter()
+        assert decode(frames) == data
+        decode_s = time.perf_counter() - start
+        wire = sum(len(frame) for frame in frames)
+        results[name] = (wire, encode_s + decode_s)
+        rows.append((name, f"线上 {wire / 1e6:8.2f} MB (负载的 {wire / len(data) * 100:5.1f}%)   "
+                           f"编码 {encode_s * 1000:8.1f} ms   解码 {decode_s * 1000:8.1f} ms"))
+    (legacy_wire, legacy_cpu), (binary_wire, binary_cpu) = results.values()
+    rows.append(("节省", f"字节 {(1 - binary_wire / legacy_wire) * 100:.1f}%   CPU x{legacy_cpu / binary_cpu:.1f}"))
+    print_table(f"数据块编码 ({args.megabytes} MB, {chunk_count} 块 x {CHUNK_SIZE} B)", rows)
+
+# --- 消息编码 ---
+
+def sample_fields(msg_class) -> dict:
+    """按字段类型为消息类构造示例参数（bytes 字段用字符串，JSON 无法直接编码 bytes）。"""
+    import dataclasses
+    import typing
+
+    values = {}
+    hints = typing.get_type_hints(msg_class)
+    for f in dataclasses.fields(msg_class):
+        if not f.init or f.default is not dataclasses.MISSING or f.default_factory is not dataclasses.MISSING:
+            continue
+        hint = hints[f.name]
+        if hint is int:
+            values[f.name] = 12345
+        elif typing.get_origin(hint) is list:
+            values[f.name] = []
+        elif typing.get_origin(hint) is dict:
+            values[f.name] = {}
+        else:
+            values[f.name] = f"{f.name}-sample"
+    return values
+
+def make_legacy_serialize():
+    """改造前的序列化方式：CustomEncoder.default -> inspect.isclass + dataclasses.asdict。"""
+    import dataclasses
+    import inspect
+    import schema as S
+
+    class LegacyEncoder(json.JSONEncoder):
+        def default(self, o):
+            if dataclasses.is_dataclass(o) and not inspect.isclass(o):
+                return dataclasses.asdict(o)
+            if isinstance(o, S.MsgTag):
+                return o.value
+            return super().default(o)
+
+    def legacy_serialize(msg_obj) -> bytes:
+        json_bytes = json.dumps(msg_obj, cls=LegacyEncoder).encode('utf-8')
+        return len(json_bytes).to_bytes(4, 'big') + json_bytes
+
+    return legacy_serialize
+
+def bench_messages(args):
+    import schema as S
+    from serializer import MESSAGE_CLASSES, serialize
+
+    legacy_serialize = make_legacy_serialize()
+    n = args.iterations
+    rows = []
+    total_legacy = total_new = 0.0
+    for tag in S.MsgTag:
+        msg_class = MESSAGE_CLASSES[tag]
+        kwargs = sample_fields(msg_class)
+        msg = msg_class(**kwargs)
+        assert legacy_serialize(msg) == serialize(msg), tag
+        create = timed(lambda i: msg_class(**kwargs), n) * 1000
+        legacy = timed(lambda i: legacy_serialize(msg), n) * 1000
+        new = timed(lambda i: serialize(msg), n) * 1000
+        total_legacy += legacy
+        total_new += new
+        rows.append((tag.name, f"构造 {create:5.2f} us   旧序列化 {legacy:6.2f} us   "
+                               f"新序列化 {new:5.2f} us   x{legacy / new:4.1f}"))
+    rows.append(("合计", f"旧序列化 {total_legacy:7.2f} us   新序列化 {total_new:6.2f} us   "
+                        f"x{total_legacy / total_new:4.1f}"))
+    print_table(f"各消息类型的构造与序列化耗时 (每种 {n} 次取平均)", rows)
+
+    # JSON 与 binary_codec 的帧大小和编解码耗时
+    from serializer import decode_frame
+    rows = []
+    for tag in S.MsgTag:
+        msg = MESSAGE_CLASSES[tag](**sample_fields(MESSAGE_CLASSES[tag]))
+        json_frame, binary_frame = serialize(msg), serialize(msg, 'binary')
+        if binary_frame[4] == 0x7B:
+            rows.append((tag.name, "含 bytes 字段，示例数据无法用二进制编码，已退回 JSON"))
+            continue
+        json_us = timed(lambda i: decode_frame(serialize(msg)[4:]), n) * 1000
+        binary_us = timed(lambda i: decode_frame(serialize(msg, 'binary')[4:]), n) * 1000
+        rows.append((tag.name, f"JSON {len(json_frame):4d} B {json_us:6.2f} us   "
+                               f"二进制 {len(binary_frame):4d} B {binary_us:6.2f} us   "
+                               f"大小 {len(binary_frame) / len(json_frame) * 100:3.0f}%  x{json_us / binary_us:3.1f}"))
+    print_table(f"JSON 与二进制编码：帧大小与编码+解码耗时 (每种 {n} 次取平均)", rows)
+
+# --- 合并写出 ---
+
+class CountingSocket(socket.socket):
+    """记录 sendall / sendmsg 调用次数的 socket（每次调用至少一次写系统调用）。"""
+    calls = 0
+
+    def sendall(self, data, *args):
+        self.calls += 1
+        return super().sendall(data, *args)
+
+    def sendmsg(self, buffers, *args):
+        self.calls += 1
+        return super().sendmsg(buffers, *args)
+
+def counting_socketpair():
+    a, b = socket.socketpair()
+    return CountingSocket(a.family, a.type, a.proto, fileno=a.detach()), b
+
+def make_tls_pair(certs: str):
+    """在 socketpair 上建立 TLS 连接，发送端每次 sendall 被计数（对应一次 SSL_write）。"""
+    import ssl
+
+    class CountingSSLSocket(ssl.SSLSocket):
+        calls = 0
+
+        def sendall(self, data, flags=0):
+            self.calls += 1
+            return super().sendall(data, flags)
+
+    server_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_ctx.load_cert_chain(os.path.join(certs, "server.crt"),
+                               os.path.join(certs, "server_rsa_private.pem.unsecure"))
+    client_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    client_ctx.check_hostname = False
+    client_ctx.verify_mode = ssl.CERT_NONE  # 只测吞吐量，不校验证书
+    client_ctx.sslsocket_class = CountingSSLSocket
+
+    a, b = socket.socketpair()
+    accepted = {}
+    t = threading.Thread(target=lambda: accepted.setdefault("sock", server_ctx.wrap_socket(b, server_side=True)))
+    t.start()
+    client = client_ctx.wrap_socket(a)
+    t.join()
+    return client, accepted["sock"]
+
+def bench_writes(args):
+    import uuid
+    from framing import FrameReader, batched, write_frame
+    from serializer import chunk_parts, serialize_chunk
+
+    data = os.urandom(args.megabytes * 1024 * 1024)
+    view = memoryview(data)
+    transfer_id = str(uuid.uuid4())
+
+    def per_frame(sock, chunks):
+        for i, chunk in enumerate(chunks):
+            sock.sendall(serialize_chunk(transfer_id, i, chunk))
+
+    def coalesced(sock, chunks):
+        with batched(sock):
+            for i, chunk in enumerate(chunks):
+                write_frame(sock, *chunk_parts(transfer_id, i, chunk))
+
+    def run(make_pair, send, chunk_size):
+        chunks = [view[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+        sender, receiver = make_pair()
+        received = []
+
+        def drain():
+            reader = FrameReader(receiver)
+            for _ in chunks:
+                received.append(len(reader.read_frame()))
+
+        t = threading.Thread(target=drain)
+        t.start()
+        start = time.perf_counter()
+        send(sender, chunks)
+        t.join()
+        elapsed = time.perf_counter() - start
+        assert len(received) == len(chunks)
+        calls = sender.calls
+        sender.close()
+        receiver.close()
+        return calls, elapsed
+
+    transports = [("socketpair", counting_socketpair)]
+    if os.path.exists(os.path.join(args.certs, "server.crt")):
+        transports.append(("TLS", lambda: make_tls_pair(args.certs)))
+    else:
+        print(f"[跳过 TLS] 在 {args.certs} 中找不到 server.crt / server_rsa_private.pem.unsecure")
+
+    megabytes = len(data) / (1024 * 1024)
+    for transport, make_pair in transports:
+        rows = []
+        for chunk_size in (4096, 65536):
+            results = {}
+            for name, send in (("逐帧 sendall", per_frame), ("FrameWriter", coalesced)):
+                calls, elapsed = run(make_pair, send, chunk_size)
+                results[name] = elapsed
+                rows.append((f"{chunk_size // 1024:2d} KB 块  {name}",
+                             f"写调用 {calls / megabytes:7.1f} 次/MB   {megabytes / elapsed:8.1f} MB/s"))
+            before, after = results.values()
+            rows.append((f"{chunk_size // 1024:2d} KB 块  提升", f"x{before / after:.2f}"))
+        print_table(f"{transport}: 发送 {args.megabytes} MB 数据块", rows)
+
+def bench_stream(args):
+    import tracemalloc
+    import uuid
+    from capabilities import Capabilities, apply_capabilities
+    from framing import FrameReader
+    from transfer import send_file_transfer, send_transfer
+
+    def whole_file(sock, transfer_id, path):
+        with open(path, 'rb') as f:
+            return send_transfer(sock, transfer_id, 'file', 'bench.bin', f.read())
+
+    def streaming(sock, transfer_id, path):
+        return send_file_transfer(sock, transfer_id, 'file', 'bench.bin', path)
+
+    def run(send, path, trace):
+        sender, receiver = socket.socketpair()
+        # 二进制数据块、64KB 分块、不压缩：只比较读盘与发送方式的差别
+        apply_capabilities(sender, Capabilities(codec='binary', features=['binary_chunks'],
+                                                chunk_size=65536, negotiated=True))
+        received = [0]
+
+        def drain():
+            reader = FrameReader(receiver)
+            while True:
+                payload = reader.read_frame()
+                if payload is None:
+                    return
+                received[0] += len(payload)
+
+        t = threading.Thread(target=drain)
+        t.start()
+        if trace:
+            tracemalloc.start()
+        start = time.perf_counter()
+        send(sender, str(uuid.uuid4()), path)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if trace else 0
+        if trace:
+            tracemalloc.stop()
+        sender.close()
+        t.join()
+        receiver.close()
+        assert received[0] >= os.path.getsize(path)
+        return elapsed, peak
+
+    with temp_workdir():
+        path = "bench.bin"
+        with open(path, 'wb') as f:
+            for _ in range(args.megabytes):
+                f.write(os.urandom(1024 * 1024))
+        rows = []
+        for name, send in (("f.read() + send_transfer", whole_file), ("send_file_transfer (流式)", streaming)):
+            elapsed, _ = run(send, path, trace=False)
+            _, peak = run(send, path, trace=True)
+            rows.append((name, f"{args.megabytes / elapsed:8.1f} MB/s   峰值内存 {peak / (1024 * 1024):8.1f} MB"))
+        print_table(f"发送 {args.megabytes} MB 文件", rows)
+
+def bench_stripes(args):
+    import hashlib
+    import ssl
+    import uuid
+    import capabilities
+    import flow
+    import schema as S
+    import stripe
+    from capabilities import server_hello, client_hello
+    from framing import read_frame
+    from serializer import decode_frame, send_msg
+    from transfer import ChunkSpool, chunk_data, send_file_transfer
+
+    server_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_ctx.load_cert_chain(os.path.join(args.certs, "server.crt"),
+                               os.path.join(args.certs, "server_rsa_private.pem.unsecure"))
+    client_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    client_ctx.check_hostname = False
+    client_ctx.verify_mode = ssl.CERT_NONE  # 只测吞吐量，不校验证书
+    # 随机数据、不压缩：只比较连接数的差别
+    capabilities.SUPPORTED_COMPRESSION = []
+    stream_counts = [int(n) for n in args.streams.split(",")]
+
+    def make_recv(rate: float):
+        """接收一条消息；rate > 0 时每条连接的接收速率不超过 rate 字节/秒（模拟单个 TCP 流的带宽上限）。"""
+        started = {}
+
+        def recv(sock):
+            payload = read_frame(sock)
+            if payload is None:
+                return None
+            msg = decode_frame(payload)
+            if rate and isinstance(msg, S.DataChunkMsg):
+                state = started.setdefault(id(sock), [time.perf_counter(), 0])
+                state[1] += len(msg.data)
+                delay = state[0] + state[1] / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            return msg
+        return recv
+
+    def receive_main(sock, start, recv, done):
+        """与 p2p.handle_p2p_file_reception 相同的接收流程，只是不打印进度。"""
+        spool = ChunkSpool("received.bin", start.total_size, start.chunk_size, start.total_chunks,
+                           negotiated_chunk_size=capabilities.get_capabilities(sock).chunk_size)
+        reception = stripe.expect_stripes(start, spool)
+        acks = flow.AckSender(sock, start, spool, send_msg, reception.ranges[0] if reception else None)
+        while True:
+            msg = recv(sock)
+            if isinstance(msg, S.DataChunkMsg):
+                data = chunk_data(msg)
+                spool.write_chunk(msg.chunk_index, data)
+                acks.on_chunk(len(data))
+            elif msg is None or isinstance(msg, S.EndTransferMsg):
+                break
+        ok = msg is not None and msg.status == 'success' and (reception is None or reception.wait())
+        stripe.forget(reception)
+        if ok:
+            spool.commit()
+        else:
+            spool.abort()
+        done.put(ok)
+
+    def serve(listener, recv, done):
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            def route(conn=conn):
+                tls = server_ctx.wrap_socket(conn, server_side=True)
+                server_hello(tls)
+                payload = read_frame(tls)
+                msg = decode_frame(payload)
+                if isinstance(msg, S.StripeJoinMsg):
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        stripe.serve_stripe(tls, msg, recv, send_msg)
+                elif isinstance(msg, S.StartTransferMsg):
+                    receive_main(tls, msg, recv, done)
+                    while read_frame(tls) is not None:
+                        pass
+                    tls.close()
+            threading.Thread(target=route, daemon=True).start()
+
+    def run(path, streams, rate):
+        import queue
+
+        capabilities.MAX_STREAMS = streams
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        done = queue.Queue()
+        threading.Thread(target=serve, args=(listener, make_recv(rate), done), daemon=True).start()
+
+        def connect():
+            tls = client_ctx.wrap_socket(socket.create_connection(listener.getsockname()))
+            client_hello(tls)
+            return tls
+
+        main_sock = connect()
+
+        def deliver_acks():
+            while True:
+                payload = read_frame(main_sock)
+                if payload is None:
+                    flow.close_windows(main_sock)
+                    return
+                flow.deliver_ack(main_sock, decode_frame(payload))
+
+        threading.Thread(target=deliver_acks, daemon=True).start()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            send_file_transfer(main_sock, str(uuid.uuid4()), 'file', 'bench.bin', path, connect=connect)
+            ok = done.get(timeout=300)
+        elapsed = time.perf_counter() - start
+        main_sock.close()
+        listener.close()
+        return ok, elapsed
+
+    with temp_workdir():
+        path = "bench.bin"
+        digest = hashlib.sha256()
+        with open(path, 'wb') as f:
+            for _ in range(args.megabytes):
+                block = os.urandom(1024 * 1024)
+                digest.update(block)
+                f.write(block)
+        print(f"CPU 核数: {os.cpu_count()}（分条传输的 TLS 加解密按连接分到多个核上，单核机器上多条连接没有加速）")
+        rates = [0.0] + ([args.per_stream_mbps * 1024 * 1024] if args.per_stream_mbps > 0 else [])
+        for rate in rates:
+            rows = []
+            baseline = None
+            for streams in stream_counts:
+                ok, elapsed = run(path, streams, rate)
+                with open("received.bin", 'rb') as f:
+                    intact = ok and hashlib.sha256(f.read()).digest() == digest.digest()
+                throughput = args.megabytes / elapsed
+                baseline = baseline or throughput
+                rows.append((f"{streams} 条连接", f"{throughput:8.1f} MB/s   x{throughput / baseline:.2f}"
+                                                 f"{'' if intact else '   接收的文件不完整!'}"))
+            title = f"每条连接限速 {args.per_stream_mbps} MB/s" if rate else "不限速"
+            print_table(f"回环 TLS 分条发送 {args.megabytes} MB 文件（{title}）", rows)
+
+def main():
+    parser = argparse.ArgumentParser(description="服务器端性能基准测试")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("contacts", help="通讯录 JSON 后端与 SQLite(WAL) 后端对比")
+    p.add_argument("--contacts", type=int, default=10000)
+    p.add_argument("--messages", type=int, default=1000000)
+    p.add_argument("--ops", type=int, default=5)
+    p.set_defaults(func=bench_contacts)
+
+    p = sub.add_parser("frames", help="旧的分块 recv + join 与 FrameReader 的帧读取吞吐量对比")
+    p.add_argument("--megabytes", type=int, default=64, help="每种帧大小发送的数据量 (MB)")
+    p.set_defaults(func=bench_frames)
+
+    p = sub.add_parser("chunks", help="JSON+base64 数据块与二进制块帧的线上字节数与 CPU 开销对比")
+    p.add_argument("--megabytes", type=int, default=16)
+    p.set_defaults(func=bench_chunks)
+
+    p = sub.add_parser("messages", help="逐个 MsgTag 对比旧的 asdict 序列化、预生成编码函数与二进制编码")
+    p.add_argument("--iterations", type=int, default=20000)
+    p.set_defaults(func=bench_messages)
+
+    p = sub.add_parser("writes", help="逐帧 sendall 与 FrameWriter 合并写出的写调用次数和吞吐量对比")
+    p.add_argument("--megabytes", type=int, default=32)
+    p.add_argument("--certs", default=".", help="TLS 测试使用的 server.crt / server_rsa_private.pem.unsecure 所在目录")
+    p.set_defaults(func=bench_writes)
+
+    p = sub.add_parser("stream", help="整体读入文件与流式发送流水线的吞吐量和峰值内存对比")
+    p.add_argument("--megabytes", type=int, default=256)
+    p.set_defaults(func=bench_stream)
+
+    p = sub.add_parser("stripes", help="在回环 TLS 连接上按不同的并行连接数分条发送大文件的吞吐量")
+    p.add_argument("--megabytes", type=int, default=128)
+    p.add_argument("--streams", default="1,2,4,8", help="逗号分隔的并行连接数")
+    p.add_argument("--per-stream-mbps", type=float, default=25.0,
+                   help="另测一组每条连接限速（MB/s）的结果，模拟单个 TCP 流跑不满链路的情况；0 表示不测")
+    p.add_argument("--certs", default=".", help="TLS 使用的 server.crt / server_rsa_private.pem.unsecure 所在目录")
+    p.set_defaults(func=bench_stripes)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
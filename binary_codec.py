@@ -0,0 +1,160 @@
+import json
+import typing
+from dataclasses import MISSING, fields, is_dataclass
+from typing import Any, Callable, Dict, Tuple, Union
+
+import schema as S
+
+# 以 BINARY_FRAME_MARKER 开头的负载是二进制编码的消息：
+# [1字节标记][1字节 MsgTag][按 dataclass 字段顺序排列的各字段]
+#   int   -> zigzag varint
+#   str   -> varint 长度 + UTF-8
+#   bytes -> varint 长度 + 原始字节
+#   其他类型 (Union / list / dict ...) -> 1字节类型 + 对应编码，列表和字典用 JSON 文本
+# 字段名不再出现在每一帧中，适合在线状态推送、心跳、聊天消息这类小而频繁的控制消息
+BINARY_FRAME_MARKER = 0x02
+
+_ANY_NONE, _ANY_INT, _ANY_STR, _ANY_BYTES, _ANY_JSON = range(5)
+
+# --- 基本类型的读写 ---
+
+def _write_varint(out: bytearray, value: int):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _read_varint(buf: memoryview, pos: int) -> Tuple[int, int]:
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+def _write_int(out: bytearray, value: int):
+    _write_varint(out, (value << 1) if value >= 0 else ((-value << 1) - 1))
+
+def _read_int(buf: memoryview, pos: int) -> Tuple[int, int]:
+    value, pos = _read_varint(buf, pos)
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1), pos
+
+def _write_bytes(out: bytearray, value: bytes):
+    _write_varint(out, len(value))
+    out += value
+
+def _read_bytes(buf: memoryview, pos: int) -> Tuple[bytes, int]:
+    length, pos = _read_varint(buf, pos)
+    end = pos + length
+    if end > len(buf):
+        raise ValueError("二进制消息被截断")
+    return bytes(buf[pos:end]), end
+
+def _write_str(out: bytearray, value: str):
+    _write_bytes(out, value.encode('utf-8'))
+
+def _read_str(buf: memoryview, pos: int) -> Tuple[str, int]:
+    length, pos = _read_varint(buf, pos)
+    end = pos + length
+    if end > len(buf):
+        raise ValueError("二进制消息被截断")
+    return str(buf[pos:end], 'utf-8'), end
+
+def _write_any(out: bytearray, value: Any):
+    if value is None:
+        out.append(_ANY_NONE)
+    elif isinstance(value, int) and not isinstance(value, bool):
+        out.append(_ANY_INT)
+        _write_int(out, value)
+    elif isinstance(value, str):
+        out.append(_ANY_STR)
+        _write_str(out, value)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        out.append(_ANY_BYTES)
+        _write_bytes(out, value)
+    else:
+        out.append(_ANY_JSON)
+        _write_str(out, json.dumps(value, ensure_ascii=False))
+
+def _read_any(buf: memoryview, pos: int) -> Tuple[Any, int]:
+    kind = buf[pos]
+    pos += 1
+    if kind == _ANY_NONE:
+        return None, pos
+    if kind == _ANY_INT:
+        return _read_int(buf, pos)
+    if kind == _ANY_STR:
+        return _read_str(buf, pos)
+    if kind == _ANY_BYTES:
+        return _read_bytes(buf, pos)
+    if kind == _ANY_JSON:
+        text, pos = _read_str(buf, pos)
+        return json.loads(text), pos
+    raise ValueError(f"未知的字段类型: {kind}")
+
+_CODECS_BY_TYPE = {
+    int: ('_write_int', '_read_int'),
+    str: ('_write_str', '_read_str'),
+    bytes: ('_write_bytes', '_read_bytes'),
+}
+
+# --- 按 dataclass 定义生成的编解码函数 ---
+
+def _compile(msg_class: type) -> Tuple[Callable[[Any], bytes], Callable[[memoryview], Any]]:
+    """
+    为一个消息类生成编码/解码函数，例如 AliveMsg 生成：
+        def encode_AliveMsg(o):
+            out = bytearray(b'\\x02\\x07'); _write_any(out, o.user_id); _write_int(out, o.time); return out
+    """
+    hints = typing.get_type_hints(msg_class)
+    tag = msg_class.__dataclass_fields__['tag'].default
+    msg_fields = [f for f in fields(msg_class) if f.init]
+
+    encode_lines = [f"    out = bytearray({bytes((BINARY_FRAME_MARKER, tag.value))!r})"]
+    decode_lines = ["    pos = 2"]
+    for i, f in enumerate(msg_fields):
+        writer, reader = _CODECS_BY_TYPE.get(hints[f.name], ('_write_any', '_read_any'))
+        encode_lines.append(f"    {writer}(out, o.{f.name})")
+        decode_lines.append(f"    v{i}, pos = {reader}(buf, pos)")
+    encode_lines.append("    return out")
+    decode_lines.append("    if pos != len(buf):")
+    decode_lines.append("        raise ValueError('二进制消息长度与字段不一致')")
+    decode_lines.append("    return msg_class(" + ", ".join(f"{f.name}=v{i}" for i, f in enumerate(msg_fields)) + ")")
+
+    name = msg_class.__name__
+    source = (f"def encode_{name}(o):\n" + "\n".join(encode_lines) + "\n\n"
+              f"def decode_{name}(buf):\n" + "\n".join(decode_lines) + "\n")
+    namespace = dict(globals(), msg_class=msg_class)
+    exec(source, namespace)
+    return namespace[f"encode_{name}"], namespace[f"decode_{name}"]
+
+def _message_classes():
+    for obj in vars(S).values():
+        if is_dataclass(obj) and isinstance(obj, type):
+            tag_field = obj.__dataclass_fields__.get('tag')
+            if tag_field is not None and tag_field.default is not MISSING:
+                yield obj
+
+_ENCODERS: Dict[type, Callable[[Any], bytes]] = {}
+_DECODERS: Dict[int, Callable[[memoryview], Any]] = {}
+for _msg_class in _message_classes():
+    _encode, _decode = _compile(_msg_class)
+    _ENCODERS[_msg_class] = _encode
+    _DECODERS[_msg_class.__dataclass_fields__['tag'].default.value] = _decode
+
+def encode(msg_obj: Any) -> bytearray:
+    """把消息编码为二进制负载（不含长度前缀）。字段值与类型不符时抛出 TypeError / AttributeError。"""
+    return _ENCODERS[type(msg_obj)](msg_obj)
+
+def decode(payload: Union[bytes, bytearray, memoryview]) -> Any:
+    """解码以 BINARY_FRAME_MARKER 开头的负载。"""
+    buf = memoryview(payload)
+    decoder = _DECODERS.get(buf[1])
+    if decoder is None:
+        raise ValueError(f"未知的消息类型 tag: {buf[1]}")
+    try:
+        return decoder(buf)
+    except IndexError:
+        raise ValueError("二进制消息被截断")
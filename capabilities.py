@@ -0,0 +1,191 @@
+import socket as skt
+import weakref
+from dataclasses import dataclass, field
+from typing import Any, List, Optional
+
+import compression
+import schema as S
+from framing import read_frame, unread_frame
+from serializer import MAX_CHUNK_SIZE, decode_frame, send_msg, set_codec
+
+# 协议版本：HelloMsg / HelloAckMsg 中携带，用于以后不兼容的改动
+PROTOCOL_VERSION = 1
+
+# 本端支持的能力，codecs / compression 按优先级从高到低排列
+SUPPORTED_CODECS = ['binary', 'json']
+SUPPORTED_COMPRESSION = list(compression.ALGORITHMS)
+SUPPORTED_FEATURES = ['binary_chunks', 'request_ids', 'inline_payloads', 'resume', 'flow_control']
+# 本端愿意接收的最大帧；最大数据块 MAX_CHUNK_SIZE 定义在 serializer 中（解压时按它检查块头）
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# 支持 'inline_payloads' 时，不超过这个大小（且放得进一个数据块）的通讯录、公钥和 P2P 小文件
+# 直接放在一条回复中发送，不再走 Start -> Chunks -> End 的传输流程
+INLINE_MAX_SIZE = 16 * 1024
+
+# 一次传输最多使用的并行连接数（含原连接），双方取较小值；设为 1 关闭分条传输（见 transfer.send_file_transfer）。
+# 单个 TLS 连接的加解密只能用一个核，高带宽时延积的链路上单个 TCP 连接也常常跑不满带宽
+MAX_STREAMS = 4
+
+# 没有进行协商（对端是旧版本）时文件传输使用的数据块大小，与原来的 CHUNK_SIZE 一致
+LEGACY_CHUNK_SIZE = 4096
+# 等待对端 Hello / HelloAck 的时间（秒）
+HELLO_TIMEOUT = 3.0
+
+@dataclass
+class Capabilities:
+    """一个连接上协商得到的参数；默认值即旧版本的行为（JSON、base64 数据块、4KB 分块）。"""
+    codec: str = 'json'
+    compression: List[str] = field(default_factory=list)
+    features: List[str] = field(default_factory=list)
+    max_frame_size: int = MAX_FRAME_SIZE
+    chunk_size: int = LEGACY_CHUNK_SIZE
+    negotiated: bool = False
+    streams: int = 1
+
+    def supports(self, feature: str) -> bool:
+        return feature in self.features
+
+    @property
+    def inline_limit(self) -> int:
+        """可以内联发送的最大负载（字节）；对端不支持内联时为 0。"""
+        if not self.supports('inline_payloads'):
+            return 0
+        return min(INLINE_MAX_SIZE, self.chunk_size)
+
+LEGACY_CAPABILITIES = Capabilities()
+
+_connection_capabilities: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+def get_capabilities(sock: Any) -> Capabilities:
+    """返回 sock 上协商得到的参数；没有协商过的连接按旧版本处理。"""
+    return _connection_capabilities.get(sock, LEGACY_CAPABILITIES)
+
+def apply_capabilities(sock: Any, caps: Capabilities):
+    """记录 sock 的协商结果，并切换此后发送消息使用的编码。"""
+    _connection_capabilities[sock] = caps
+    set_codec(sock, caps.codec)
+
+def make_hello() -> S.HelloMsg:
+    return S.HelloMsg(
+        version=PROTOCOL_VERSION,
+        codecs=list(SUPPORTED_CODECS),
+        compression=list(SUPPORTED_COMPRESSION),
+        features=list(SUPPORTED_FEATURES),
+        max_frame_size=MAX_FRAME_SIZE,
+        max_chunk_size=MAX_CHUNK_SIZE,
+        max_streams=MAX_STREAMS,
+    )
+
+def _shared(ours: List[str], theirs: List[str]) -> List[str]:
+    """双方都支持的项，保持本端的优先级顺序。"""
+    return [item for item in ours if item in theirs]
+
+def choose_capabilities(hello: S.HelloMsg, max_streams: Optional[int] = None) -> Capabilities:
+    """
+    根据对端的 Hello 选出双方都支持的最优参数；没有共同的编码时退回 JSON。
+    max_streams 是本端在这个连接上接受的并行连接数，默认为 MAX_STREAMS（不接受分条传输的一方传 1）。
+    """
+    if max_streams is None:
+        max_streams = MAX_STREAMS
+    codecs = _shared(SUPPORTED_CODECS, hello.codecs or [])
+    max_frame_size = min(MAX_FRAME_SIZE, hello.max_frame_size)
+    return Capabilities(
+        codec=codecs[0] if codecs else 'json',
+        compression=_shared(SUPPORTED_COMPRESSION, hello.compression or []),
+        features=_shared(SUPPORTED_FEATURES, hello.features or []),
+        max_frame_size=max_frame_size,
+        # 数据块加上块头必须能放进一帧
+        chunk_size=max(1, min(MAX_CHUNK_SIZE, hello.max_chunk_size, max_frame_size - 64)),
+        negotiated=True,
+        streams=max(1, min(max_streams, hello.max_streams)),
+    )
+
+def _from_ack(ack: S.HelloAckMsg) -> Capabilities:
+    return Capabilities(
+        codec=ack.codec if ack.codec in SUPPORTED_CODECS else 'json',
+        compression=_shared(SUPPORTED_COMPRESSION, ack.compression or []),
+        features=_shared(SUPPORTED_FEATURES, ack.features or []),
+        max_frame_size=min(MAX_FRAME_SIZE, ack.max_frame_size),
+        chunk_size=min(MAX_CHUNK_SIZE, ack.chunk_size),
+        negotiated=True,
+        streams=max(1, min(MAX_STREAMS, ack.streams)),
+    )
+
+def answer_hello(sock: Any, hello: S.HelloMsg, max_streams: Optional[int] = None) -> Capabilities:
+    """
+    (接受连接的一方) 回复 HelloAck 并应用协商结果。
+    HelloAck 本身总是用 JSON 发送，之后的消息才切换到协商出的编码。
+    """
+    caps = choose_capabilities(hello, max_streams)
+    send_msg(sock, S.HelloAckMsg(
+        version=PROTOCOL_VERSION,
+        codec=caps.codec,
+        compression=caps.compression,
+        features=caps.features,
+        max_frame_size=caps.max_frame_size,
+        chunk_size=caps.chunk_size,
+        streams=caps.streams,
+    ))
+    apply_capabilities(sock, caps)
+    return caps
+
+def handle_hello_ack(sock: Any, ack: S.HelloAckMsg) -> Capabilities:
+    """(发起连接的一方) 应用对端在 HelloAck 中选定的参数。"""
+    caps = _from_ack(ack)
+    apply_capabilities(sock, caps)
+    return caps
+
+def _read_first_frame(sock: Any, timeout: float) -> Optional[Any]:
+    """在 timeout 秒内读取一帧，超时返回 None，连接已关闭时抛出 ConnectionError。"""
+    old_timeout = sock.gettimeout()
+    sock.settimeout(timeout)
+    try:
+        payload = read_frame(sock)
+    except (skt.timeout, TimeoutError):
+        return None
+    finally:
+        sock.settimeout(old_timeout)
+    if payload is None:
+        raise ConnectionError("对端在能力协商时断开连接。")
+    return payload
+
+def client_hello(sock: Any, timeout: float = HELLO_TIMEOUT) -> Capabilities:
+    """
+    (发起连接的一方) TLS 握手后发送 Hello 并等待 HelloAck。
+    对端是旧版本、没有在 timeout 内回复时按旧版本的方式通信；
+    对端收到 Hello 后直接断开连接时抛出 ConnectionError，调用者可以重连后不再握手。
+    """
+    send_msg(sock, make_hello())
+    payload = _read_first_frame(sock, timeout)
+    if payload is None:
+        return LEGACY_CAPABILITIES
+    try:
+        msg = decode_frame(payload)
+    except ValueError:
+        msg = None
+    if isinstance(msg, S.HelloAckMsg):
+        return handle_hello_ack(sock, msg)
+    # 不是 HelloAck（例如旧服务器的推送），留给后续的 recv 处理
+    unread_frame(sock, payload)
+    return LEGACY_CAPABILITIES
+
+def server_hello(sock: Any, timeout: float = HELLO_TIMEOUT) -> Capabilities:
+    """
+    (接受连接的一方) 等待对端的 Hello 并回复 HelloAck。
+    对端在 timeout 内先发来其他消息或没有发送任何消息时，说明它是旧版本，
+    读到的消息会退回读取器，由后续的 recv 正常处理。
+    """
+    try:
+        payload = _read_first_frame(sock, timeout)
+    except ConnectionError:
+        return LEGACY_CAPABILITIES
+    if payload is None:
+        return LEGACY_CAPABILITIES
+    try:
+        msg = decode_frame(payload)
+    except ValueError:
+        msg = None
+    if isinstance(msg, S.HelloMsg):
+        return answer_hello(sock, msg)
+    unread_frame(sock, payload)
+    return LEGACY_CAPABILITIES
@@ -11,15 +11,18 @@ import threading
 import p2p as P
 import Transaction_Client as T
 from serializer import serialize, deserialize
+from framing import buffered_bytes
+from capabilities import get_capabilities
 import queue
+import contextlib
 import sys
 # --- 修改处: 增加 os 模块用于判断操作系统 ---
 import os
 
 # --- 修改处: 根据操作系统选择不同的模块导入 ---
 IS_WINDOWS = os.name == 'nt'
-if not IS_WINDOWS:
-    import select
+# select 在 Windows 上只能用于 socket（不能用于 sys.stdin），推送监听线程只对 socket 使用它
+import select
 
 CA_FILE = "ca.crt"
 SERVER_HOSTNAME = 'SERVER' 
@@ -30,8 +33,20 @@ current_user = None
 user_id = None
 directory_update_event = threading.Event()
 DIRECTORY_UPDATE_INTERVAL = 30
+# 服务器会主动推送好友上下线；只有设为 True 时才额外启动定时拉取通讯录的后备线程
+DIRECTORY_POLL_FALLBACK = False
+PUSH_POLL_TIMEOUT = 1.0
+# 空闲超过这么多秒就发送一次 AliveMsg（需小于服务器的 HEARTBEAT_TIMEOUT）
+HEARTBEAT_INTERVAL = 30
 server_socket_lock = threading.Lock()
 
+def server_lock(ssl_sock):
+    """
+    发送请求并等待回复时需要持有的锁。服务器支持 request_id 时由回复分发线程按编号分发回复，
+    多个请求可以同时进行，不需要加锁；旧服务器上仍用 server_socket_lock 串行化。
+    """
+    return contextlib.nullcontext() if T.get_demux(ssl_sock) else server_socket_lock
+
 # --- 修改处: 重写此函数以兼容 Windows ---
 def get_user_input(prompt):
     """
@@ -71,7 +86,7 @@ def periodic_directory_updater(ssl_sock, stop_event: threading.Event):
             break 
         try:
             if current_user:
-                with server_socket_lock:
+                with server_lock(ssl_sock):
                     print(f"\n[后台同步] 正在为 '{current_user}' 请求通讯录更新...")
                     success = T.handle_get_directory(ssl_sock, current_user)
                     if success:
@@ -86,6 +101,57 @@ def periodic_directory_updater(ssl_sock, stop_event: threading.Event):
             print(f"[后台同步] 线程发生错误: {e}")
     print("[后台同步] 通讯录自动更新线程已停止。")
 
+def _server_readable(ssl_sock, timeout):
+    """帧读取器或 SSL 层已缓冲数据，或底层 socket 在 timeout 内变为可读。"""
+    if buffered_bytes(ssl_sock) > 0 or ssl_sock.pending() > 0:
+        return True
+    readable, _, _ = select.select([ssl_sock], [], [], timeout)
+    return bool(readable)
+
+def push_event_listener(ssl_sock, stop_event: threading.Event):
+    """
+    空闲时接收服务器推送的后台线程。
+    其他线程发送请求时持有 server_socket_lock，回复之间夹带的推送由 T.recv_msg 处理；
+    这里只在没有请求进行时读取推送，并在空闲超过 HEARTBEAT_INTERVAL 时发送心跳。
+    连接上启用了回复分发线程时，推送由分发线程处理，这里只发送心跳。
+    """
+    print("[推送] 好友状态推送监听线程已启动。")
+    while not stop_event.is_set():
+        try:
+            if T.heartbeat_due(HEARTBEAT_INTERVAL):
+                with server_lock(ssl_sock):
+                    T.handle_alive(ssl_sock, user_id)
+            if T.get_demux(ssl_sock):
+                # 推送由回复分发线程处理，这里只负责心跳
+                stop_event.wait(PUSH_POLL_TIMEOUT)
+                continue
+            if not _server_readable(ssl_sock, PUSH_POLL_TIMEOUT):
+                continue
+            with server_socket_lock:
+                # 等锁期间数据可能已被其他线程读走
+                if not _server_readable(ssl_sock, 0):
+                    continue
+                if T.recv_push_events(ssl_sock) is None:
+                    print("[推送] 与服务器的连接已断开，监听线程退出。")
+                    break
+        except (OSError, ValueError) as e:
+            print(f"[推送] 监听线程发生错误: {e}")
+            break
+    print("[推送] 好友状态推送监听线程已停止。")
+
+def on_push_event(msg):
+    """推送到达后同步内存中的联系人表，并提示用户。"""
+    if isinstance(msg, S.PresenceEventMsg):
+        if msg.username in P.contacts_map:
+            P.contacts_map[msg.username]['status'] = msg.status
+            P.contacts_map[msg.username]['address'] = msg.address
+        print(f"\n[推送] 好友 {msg.username} 已{'上线' if msg.status == 'online' else '下线'}。")
+    elif isinstance(msg, S.ContactEventMsg):
+        P.contacts_map.setdefault(msg.contact_name, {"name": msg.contact_name})
+        P.contacts_map[msg.contact_name].update(status=msg.status, address=msg.address)
+        print(f"\n[推送] 通讯录新增联系人: {msg.contact_name}")
+    print("\rwhich friend do you want to send message to: ", end="", flush=True)
+
 def User_evnets_process(ssl_connect_sock, current_user, user_id, chat_queue):
     P.init_directory(current_user)
     prompt_text = "which friend do you want to send message to: "
@@ -106,13 +172,13 @@ def User_evnets_process(ssl_connect_sock, current_user, user_id, chat_queue):
                     return "exit"
 
                 if choice == "logout":
-                    with server_socket_lock:
+                    with server_lock(ssl_connect_sock):
                         T.handle_logout(ssl_connect_sock, current_user)
                     return "logout"
 
                 if choice == "refresh":
                     print("正在手动刷新好友列表...")
-                    with server_socket_lock:
+                    with server_lock(ssl_connect_sock):
                         T.handle_get_directory(ssl_connect_sock, current_user)
                     P.init_directory(current_user)
                     continue
@@ -125,12 +191,12 @@ def login_screen(ssl_connect_sock, my_p2p_port):
     for _ in range(10):
         opt = input("plesse input login / register / exit: ")
         if opt == "login":
-            with server_socket_lock:
+            with server_lock(ssl_connect_sock):
                 current_user, user_id = T.handle_login(ssl_connect_sock, my_p2p_port)
             if current_user and user_id: 
                 return current_user, user_id
         elif opt == "register":
-            with server_socket_lock:
+            with server_lock(ssl_connect_sock):
                 T.handle_register(ssl_connect_sock) 
         elif opt == "exit":
             return None, None
@@ -156,6 +222,9 @@ def boot():
             peer_hostname=SERVER_HOSTNAME
         )
         if not ssl_connect_sock: return
+        if get_capabilities(ssl_connect_sock).supports('request_ids'):
+            # 服务器支持请求编号：由分发线程接收所有回复和推送，请求之间不再互相阻塞
+            T.start_demux(ssl_connect_sock)
         
         listening_thread = threading.Thread(target=P.p2p_listener, args=(p2p_server_sock, incoming_chat_queue), daemon=True)
         listening_thread.start()
@@ -170,8 +239,17 @@ def boot():
                     
                     print("登录成功，正在启动后台服务...")
                     stop_updater_event.clear()
+                    with server_lock(ssl_connect_sock):
+                        T.subscribe_push(ssl_connect_sock, current_user)
+                    # 上次中断的服务器传输只补发缺少的数据块
+                    with server_lock(ssl_connect_sock):
+                        T.resume_server_transfers(ssl_connect_sock, current_user)
+                    if on_push_event not in T.push_listeners:
+                        T.push_listeners.append(on_push_event)
+                    # 默认依靠服务器推送；定时拉取只作为可选的后备方式
+                    updater_target = periodic_directory_updater if DIRECTORY_POLL_FALLBACK else push_event_listener
                     updater_thread = threading.Thread(
-                        target=periodic_directory_updater,
+                        target=updater_target,
                         args=(ssl_connect_sock, stop_updater_event),
                         daemon=True
                     )
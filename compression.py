@@ -0,0 +1,179 @@
+import lzma
+import os
+import threading
+import time
+import zlib
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+# 支持的压缩算法（按优先级排列，能力协商时通告给对端）及其在二进制帧中的编号
+ALGORITHMS = ['zlib', 'lzma']
+ALGORITHM_IDS = {'zlib': 1, 'lzma': 2}
+ALGORITHM_NAMES = {v: k for k, v in ALGORITHM_IDS.items()}
+
+# 按文件类型选择的算法和压缩级别：通讯录等文本压缩率高，值得用更高的级别；
+# 图片和音频大多已经压缩过，只用最快的级别试一试
+COMPRESSION_POLICY: Dict[str, Tuple[str, int]] = {
+    'directory': ('lzma', 6),
+    'publickey': ('zlib', 6),
+    'file': ('zlib', 6),
+    'image': ('zlib', 1),
+    'audio': ('zlib', 1),
+}
+DEFAULT_POLICY = ('zlib', 6)
+
+# 压缩后至少要省下这么多，否则按原样发送；更小的块直接发送（压缩头的开销比省下的还多）
+MIN_SAVING = 0.05
+MIN_COMPRESS_SIZE = 256
+# 连续这么多个块都不值得压缩时，本次传输的剩余部分不再尝试
+MAX_MISSES = 4
+
+# 常见的已压缩格式的文件头与扩展名
+COMPRESSED_SIGNATURES = (
+    b'\x89PNG', b'\xff\xd8\xff', b'GIF8', b'PK\x03\x04', b'\x1f\x8b', b'BZh', b'\xfd7zXZ',
+    b'7z\xbc\xaf', b'Rar!', b'OggS', b'fLaC', b'ID3', b'\xff\xfb', b'\xff\xf3', b'\xff\xf2',
+)
+COMPRESSED_EXTENSIONS = {
+    '.png', '.jpg', '.jpeg', '.gif', '.webp', '.heic', '.mp3', '.aac', '.m4a', '.ogg', '.opus',
+    '.flac', '.mp4', '.mkv', '.webm', '.zip', '.gz', '.bz2', '.xz', '.7z', '.rar', '.docx', '.xlsx',
+}
+
+def looks_compressed(file_name: str, head: bytes) -> bool:
+    """根据扩展名和文件头判断内容是否已经是压缩格式。"""
+    if os.path.splitext(file_name)[1].lower() in COMPRESSED_EXTENSIONS:
+        return True
+    if head.startswith(COMPRESSED_SIGNATURES):
+        return True
+    # RIFF 容器 (WAV 未压缩，WEBP/AVI 已压缩) 与 MP4 系列
+    if head[:4] == b'RIFF' and head[8:12] != b'WAVE':
+        return True
+    return head[4:8] == b'ftyp'
+
+def choose_compression(file_type: str, file_name: str, head: bytes,
+                       available: List[str]) -> Optional[Tuple[str, int]]:
+    """
+    为一次传输选择 (算法, 级别)；连接没有协商出压缩算法或内容已经压缩过时返回 None。
+    首选算法不可用时退回双方都支持的另一个算法的默认级别。
+    """
+    if not available or looks_compressed(file_name, head):
+        return None
+    algorithm, level = COMPRESSION_POLICY.get(file_type, DEFAULT_POLICY)
+    if algorithm in available:
+        return algorithm, level
+    for fallback in ALGORITHMS:
+        if fallback in available:
+            return fallback, DEFAULT_POLICY[1]
+    return None
+
+def compress(algorithm: str, data: Any, level: int) -> bytes:
+    if algorithm == 'zlib':
+        return zlib.compress(data, level)
+    if algorithm == 'lzma':
+        return lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_NONE, preset=level)
+    raise ValueError(f"未知的压缩算法: {algorithm}")
+
+def decompress(algorithm_id: int, data: Any, raw_length: int) -> bytes:
+    """解压一个数据块；解压后的长度必须等于 raw_length（也防止构造的数据解压出超大内容）。"""
+    if algorithm_id == ALGORITHM_IDS['zlib']:
+        decompressor = zlib.decompressobj()
+        raw = decompressor.decompress(data, raw_length)
+        complete = decompressor.eof
+    elif algorithm_id == ALGORITHM_IDS['lzma']:
+        decompressor = lzma.LZMADecompressor()
+        raw = decompressor.decompress(data, raw_length)
+        complete = decompressor.eof
+    else:
+        raise ValueError(f"未知的压缩算法编号: {algorithm_id}")
+    if len(raw) != raw_length or not complete:
+        raise ValueError("压缩数据块解压后的长度与块头不一致")
+    return raw
+
+class ChunkCompressor:
+    """
+    一次传输的逐块压缩器。每个块独立压缩（接收端可以逐帧解压，不需要保存流状态），
+    压缩后不够小的块按原样发送；连续 MAX_MISSES 个块都不值得压缩时停止尝试，
+    避免在看不出格式的随机数据上浪费 CPU。
+    """
+    def __init__(self, algorithm: str, level: int):
+        self.algorithm = algorithm
+        self.algorithm_id = ALGORITHM_IDS[algorithm]
+        self.level = level
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.cpu_time = 0.0
+        self.compressed_chunks = 0
+        self._misses = 0
+
+    def compress(self, chunk: Any) -> Optional[bytes]:
+        """返回压缩后的块；不值得压缩时返回 None（调用者发送原始块）。"""
+        self.raw_bytes += len(chunk)
+        if self._misses >= MAX_MISSES or len(chunk) < MIN_COMPRESS_SIZE:
+            self.wire_bytes += len(chunk)
+            return None
+        # 只计本线程的 CPU 时间：同一进程中其他连接的压缩、加密不算进这次传输
+        start = time.thread_time()
+        packed = compress(self.algorithm, chunk, self.level)
+        self.cpu_time += time.thread_time() - start
+        if len(packed) > len(chunk) * (1 - MIN_SAVING):
+            self._misses += 1
+            self.wire_bytes += len(chunk)
+            return None
+        self._misses = 0
+        self.compressed_chunks += 1
+        self.wire_bytes += len(packed)
+        return packed
+
+# --- 统计 ---
+
+class CompressionStats:
+    """按文件类型汇总的压缩效果，以及最近若干次传输的明细。"""
+    def __init__(self, recent: int = 100):
+        self._lock = threading.Lock()
+        self._totals: Dict[str, Dict[str, Any]] = {}
+        self.recent: Deque[Dict[str, Any]] = deque(maxlen=recent)
+
+    def record(self, transfer_id: str, file_type: str, algorithm: str, raw_bytes: int,
+               wire_bytes: int, cpu_time: float) -> Dict[str, Any]:
+        entry = {
+            "transfer_id": transfer_id,
+            "file_type": file_type,
+            "algorithm": algorithm,
+            "raw_bytes": raw_bytes,
+            "wire_bytes": wire_bytes,
+            "ratio": round(wire_bytes / raw_bytes, 3) if raw_bytes else 1.0,
+            "cpu_ms": round(cpu_time * 1000, 3),
+        }
+        with self._lock:
+            self.recent.append(entry)
+            total = self._totals.setdefault(file_type, {"transfers": 0, "raw_bytes": 0, "wire_bytes": 0, "cpu_time": 0.0})
+            total["transfers"] += 1
+            total["raw_bytes"] += raw_bytes
+            total["wire_bytes"] += wire_bytes
+            total["cpu_time"] += cpu_time
+        return entry
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {
+                file_type: {
+                    "transfers": t["transfers"],
+                    "raw_bytes": t["raw_bytes"],
+                    "wire_bytes": t["wire_bytes"],
+                    "ratio": round(t["wire_bytes"] / t["raw_bytes"], 3) if t["raw_bytes"] else 1.0,
+                    "cpu_ms": round(t["cpu_time"] * 1000, 3),
+                }
+                for file_type, t in self._totals.items()
+            }
+
+_compression_stats = CompressionStats()
+
+def record_transfer(transfer_id: str, file_type: str, algorithm: str, raw_bytes: int,
+                    wire_bytes: int, cpu_time: float):
+    """记录一次传输的压缩率和压缩耗费的 CPU 时间，并打印一行日志。"""
+    entry = _compression_stats.record(transfer_id, file_type, algorithm, raw_bytes, wire_bytes, cpu_time)
+    print(f"[压缩] {file_type} ({algorithm}) {raw_bytes} -> {wire_bytes} 字节, "
+          f"压缩率 {entry['ratio']:.1%}, CPU {entry['cpu_ms']:.1f} ms")
+
+def get_compression_stats() -> Dict[str, Dict[str, Any]]:
+    """按文件类型返回累计的原始字节数、线上字节数、压缩率与 CPU 时间。"""
+    return _compression_stats.snapshot()
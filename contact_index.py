@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+from typing import Callable, Dict, List, Set
+
+INDEX_PATH = os.path.join('data', 'contact_index.jsonl')
+DIRECTORY_PATH = os.path.join('data', 'directory')
+
+# 新增联系人时的回调 fn(owner, contact_name)，服务器用它推送通讯录变化
+_contact_listeners: List[Callable[[str, str], None]] = []
+
+def add_contact_listener(listener: Callable[[str, str], None]):
+    """注册一个在索引新增 [owner, contact] 边时调用的回调。"""
+    if listener not in _contact_listeners:
+        _contact_listeners.append(listener)
+
+class ReverseContactIndex:
+    """
+    反向联系人索引：username -> 通讯录中包含该用户的所有用户。
+
+    在线状态变化时只需要通知/更新索引中列出的好友，而不必扫描整个 data/directory。
+    索引以追加写的方式持久化，每行是一条 [owner, contact] 边；
+    索引文件不存在时会扫描 data/directory 重建一次。
+    """
+    def __init__(self, path: str = INDEX_PATH, directory_path: str = DIRECTORY_PATH):
+        self.path = path
+        self.directory_path = directory_path
+        self._lock = threading.Lock()
+        self._followers: Dict[str, Set[str]] = {}
+
+        if os.path.exists(self.path):
+            self._load()
+        else:
+            self.rebuild()
+
+    def _add_edge(self, owner: str, contact_name: str) -> bool:
+        owners = self._followers.setdefault(contact_name, set())
+        if owner in owners:
+            return False
+        owners.add(owner)
+        return True
+
+    def _load(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    owner, contact_name = json.loads(line)
+                except (json.JSONDecodeError, ValueError):
+                    print(f"[联系人索引] 跳过 {self.path} 中无法解析的行。")
+                    continue
+                self._add_edge(owner, contact_name)
+
+    def rebuild(self):
+        """扫描全部通讯录文件重建索引，并重写索引文件。"""
+        followers: Dict[str, Set[str]] = {}
+        if os.path.isdir(self.directory_path):
+            for user_file in os.listdir(self.directory_path):
+                if not user_file.endswith('.json'):
+                    continue
+                owner = user_file[:-len('.json')]
+                try:
+                    with open(os.path.join(self.directory_path, user_file), 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                except (OSError, json.JSONDecodeError) as e:
+                    print(f"[联系人索引] 读取 {user_file} 时出错，已跳过: {e}")
+                    continue
+                for contact in data.get('contacts', []):
+                    name = contact.get('name')
+                    if name:
+                        followers.setdefault(name, set()).add(owner)
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for contact_name, owners in followers.items():
+                for owner in sorted(owners):
+                    f.write(json.dumps([owner, contact_name], ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+
+        with self._lock:
+            self._followers = followers
+        print(f"[联系人索引] 已从 {self.directory_path} 重建索引，共 {len(followers)} 个用户。")
+
+    def add(self, owner: str, contact_name: str):
+        """记录 owner 的通讯录中加入了 contact_name。"""
+        with self._lock:
+            if not self._add_edge(owner, contact_name):
+                return
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps([owner, contact_name], ensure_ascii=False) + "\n")
+        for listener in list(_contact_listeners):
+            try:
+                listener(owner, contact_name)
+            except Exception as e:
+                print(f"[联系人索引] 通知新增联系人时出错: {e}")
+
+    def followers(self, username: str) -> List[str]:
+        """返回通讯录中包含 username 的所有用户。"""
+        with self._lock:
+            return sorted(self._followers.get(username, ()))
+
+_contact_index = None
+_contact_index_lock = threading.Lock()
+
+def get_contact_index() -> ReverseContactIndex:
+    """返回进程内共享的反向联系人索引（首次使用时加载）。"""
+    global _contact_index
+    if _contact_index is None:
+        with _contact_index_lock:
+            if _contact_index is None:
+                _contact_index = ReverseContactIndex()
+    return _contact_index
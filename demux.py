@@ -0,0 +1,124 @@
+import itertools
+import queue
+import threading
+from typing import Any, Callable, Dict, Optional
+
+import schema as S
+
+# 等待回复的默认超时（秒）；None 表示一直等待
+REPLY_TIMEOUT: Optional[float] = None
+
+_CLOSED = object()
+
+class PendingRequest:
+    """一个已发出、正在等待回复的请求。回复以及随后的传输帧按到达顺序放入它的队列。"""
+    def __init__(self, demux: "ResponseDemux", request_id: int):
+        self._demux = demux
+        self.request_id = request_id
+        self._queue: "queue.Queue[Any]" = queue.Queue()
+
+    def recv(self, timeout: Optional[float] = REPLY_TIMEOUT) -> Any:
+        """取出下一条属于该请求的消息；连接断开或超时返回 None。"""
+        try:
+            msg = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if msg is _CLOSED:
+            self._queue.put(_CLOSED)  # 之后的 recv 同样返回 None
+            return None
+        return msg
+
+    def close(self):
+        self._demux._finish(self.request_id)
+
+    def __enter__(self) -> "PendingRequest":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ResponseDemux:
+    """
+    客户端与服务器连接上的回复分发线程。
+
+    原来所有请求共用一把 server_socket_lock，发出请求后假设下一帧就是回复，
+    刷新通讯录、获取公钥、注销等请求只能一个接一个地进行。这里由一个线程独占读取连接，
+    按 request_id 把回复交给等待它的调用者；StartTransfer 带有 request_id，
+    之后同一 transfer_id 的数据块和 EndTransfer 也交给同一个调用者。
+    不属于任何请求的消息（服务器推送等）交给 on_other。
+    """
+    def __init__(self, sock: Any, recv_one: Callable[[Any], Any], on_other: Callable[[Any], None]):
+        self._sock = sock
+        self._recv_one = recv_one
+        self._on_other = on_other
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, PendingRequest] = {}
+        self._transfers: Dict[str, int] = {}   # transfer_id -> request_id
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "ResponseDemux":
+        self._thread = threading.Thread(target=self._run, name="response-demux", daemon=True)
+        self._thread.start()
+        return self
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def request(self, msg: Any, send: Callable[[Any, Any], None]) -> PendingRequest:
+        """为 msg 分配 request_id、登记等待者并用 send(sock, msg) 发出。"""
+        with self._lock:
+            request_id = next(self._ids)
+            pending = self._pending[request_id] = PendingRequest(self, request_id)
+            if self._closed:
+                pending._queue.put(_CLOSED)
+                return pending
+        msg.request_id = request_id
+        try:
+            send(self._sock, msg)
+        except Exception:
+            self._finish(request_id)
+            raise
+        return pending
+
+    def _finish(self, request_id: int):
+        with self._lock:
+            self._pending.pop(request_id, None)
+            for transfer_id in [t for t, r in self._transfers.items() if r == request_id]:
+                del self._transfers[transfer_id]
+
+    def _route(self, msg: Any):
+        request_id = getattr(msg, 'request_id', 0)
+        transfer_id = getattr(msg, 'transfer_id', None)
+        with self._lock:
+            if isinstance(msg, S.StartTransferMsg) and request_id:
+                self._transfers[transfer_id] = request_id
+            elif not request_id and transfer_id is not None:
+                request_id = self._transfers.get(transfer_id, 0)
+            if isinstance(msg, S.EndTransferMsg):
+                self._transfers.pop(transfer_id, None)
+            pending = self._pending.get(request_id) if request_id else None
+        if pending is not None:
+            pending._queue.put(msg)
+        else:
+            self._on_other(msg)
+
+    def _run(self):
+        try:
+            while True:
+                msg = self._recv_one(self._sock)
+                if msg is None:
+                    break
+                try:
+                    self._route(msg)
+                except Exception as e:
+                    print(f"[请求分发] 处理 {getattr(msg, 'tag', msg)} 时出错: {e}")
+        finally:
+            with self._lock:
+                self._closed = True
+                waiting = list(self._pending.values())
+            for pending in waiting:
+                pending._queue.put(_CLOSED)
+            print("[请求分发] 与服务器的连接已断开，分发线程退出。")
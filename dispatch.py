@@ -0,0 +1,105 @@
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import schema as S
+from framing import batched
+from serializer import request_scope, send_msg
+
+class RequestContext:
+    """传给请求处理函数的连接上下文。"""
+    def __init__(self, sock: Any, user_ip: str, user_port: int):
+        self.sock = sock
+        self.user_ip = user_ip
+        self.user_port = user_port
+
+class HandlerStats:
+    """单个消息类型的调用次数、错误次数与耗时统计。"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, elapsed: float, failed: bool):
+        with self._lock:
+            self.count += 1
+            if failed:
+                self.errors += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "count": self.count,
+                "errors": self.errors,
+                "avg_ms": round(self.total_time / self.count * 1000, 3) if self.count else 0.0,
+                "max_ms": round(self.max_time * 1000, 3),
+                "total_ms": round(self.total_time * 1000, 3),
+            }
+
+Handler = Callable[[Any, RequestContext], Any]
+
+# MsgTag -> 处理函数；处理函数签名为 fn(msg, ctx)
+HANDLERS: Dict[S.MsgTag, Handler] = {}
+_stats: Dict[S.MsgTag, HandlerStats] = {}
+
+# 每条请求在分发前都会调用的钩子 fn(msg, ctx)，例如用普通流量为会话续期
+_request_hooks: List[Callable[[Any, RequestContext], None]] = []
+
+def add_request_hook(hook: Callable[[Any, RequestContext], None]):
+    """注册一个在每条请求分发前调用的钩子。"""
+    if hook not in _request_hooks:
+        _request_hooks.append(hook)
+
+def register_handler(tag: S.MsgTag, handler: Optional[Handler] = None):
+    """
+    注册某个消息类型的处理函数，可直接调用，也可作为装饰器使用：
+
+        @register_handler(S.MsgTag.GetHistory)
+        def handle_get_history(msg, ctx): ...
+
+    处理函数返回的消息对象（如果不是 None）会按该连接的编码序列化后发送给客户端；
+    需要自行发送多条消息（如文件传输）的处理函数返回 None 即可。
+    """
+    def decorator(fn: Handler) -> Handler:
+        HANDLERS[tag] = fn
+        _stats.setdefault(tag, HandlerStats())
+        return fn
+
+    if handler is not None:
+        return decorator(handler)
+    return decorator
+
+def dispatch(received_msg: Any, ctx: RequestContext) -> bool:
+    """按消息类型调用已注册的处理函数，并记录耗时与错误。"""
+    for hook in _request_hooks:
+        hook(received_msg, ctx)
+
+    handler = HANDLERS.get(received_msg.tag)
+    if handler is None:
+        print(f"[服务器日志] 未注册处理函数的消息类型: {received_msg.tag.name}，已忽略。")
+        return True
+
+    failed = False
+    start = time.perf_counter()
+    try:
+        # 处理函数发出的所有帧（回复、登录后的通讯录传输 ...）合并写出，处理结束时刷新；
+        # 回复消息沿用请求的 request_id，客户端据此把回复交给对应的调用者
+        with batched(ctx.sock), request_scope(ctx.sock, getattr(received_msg, 'request_id', 0)):
+            reply_msg = handler(received_msg, ctx)
+            if reply_msg is not None:
+                send_msg(ctx.sock, reply_msg)
+    except Exception:
+        failed = True
+        raise
+    finally:
+        _stats[received_msg.tag].record(time.perf_counter() - start, failed)
+    return True
+
+def get_handler_stats() -> Dict[str, Dict[str, Any]]:
+    """返回每个已被调用过的消息类型的统计，按总耗时从高到低排序。"""
+    stats = {tag.name: s.snapshot() for tag, s in _stats.items() if s.count}
+    return dict(sorted(stats.items(), key=lambda item: item[1]["total_ms"], reverse=True))
@@ -0,0 +1,268 @@
+import socket as skt
+import threading
+import time
+import weakref
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+import schema as S
+
+# 传输的流量控制：发送端在途（已发出、未被确认）的字节数不超过窗口，
+# 接收端每收到 ACK_BYTES 字节（以及收齐全部数据块时）回复一条 TransferAckMsg，
+# 其中有累计确认（之前的数据块都已收到）和选择确认（之后已收到的区间）。
+# 窗口按测得的往返时间和交付速率调整为约 WINDOW_GAIN 倍的带宽时延积：
+# 长肥链路上在途的数据足以填满链路，慢的接收端不会让两端的内核和 TLS 缓冲无限增长。
+
+# 接收端确认的间隔（字节）
+ACK_BYTES = 256 * 1024
+# 窗口的上下限（字节）；下限至少是确认间隔的几倍，否则发送端会在确认到达之前停下来
+MIN_WINDOW = 4 * ACK_BYTES
+MAX_WINDOW = 32 * 1024 * 1024
+INITIAL_WINDOW = MIN_WINDOW
+# 接收端的缓冲：通告的窗口为它减去已写入临时文件、还没有刷到磁盘的字节数（不低于 MIN_WINDOW），
+# 发送端的窗口不超过通告的窗口
+RECEIVE_WINDOW = MAX_WINDOW
+# 窗口 = WINDOW_GAIN x 最大交付速率 x 最小往返时间
+WINDOW_GAIN = 2.0
+# 交付速率取最近这么多次确认中的最大值
+RATE_SAMPLES = 8
+# 一条确认中最多携带的选择确认区间
+MAX_SACK_RANGES = 16
+# 不超过这个大小的传输在初始窗口内就能发完，不使用流量控制（省去等待最后一次确认的往返）
+FLOW_MIN_SIZE = MIN_WINDOW
+# 这么多秒没有收到任何确认时放弃传输（秒）
+ACK_TIMEOUT = 30.0
+
+class SendWindow:
+    """
+    一次传输在发送端的窗口。发送线程在写出每个数据块之前调用 reserve()，窗口满时等待确认；
+    确认由读取该连接的线程通过 deliver_ack() 交给它（P2P、客户端），
+    或者在没有其他线程读取的连接上（服务器的处理线程）由 reserve() 自己调用 pull 读取。
+    """
+    def __init__(self, sock: Any, transfer_id: str, total_bytes: int,
+                 pull: Optional[Callable[[Any, float], Any]] = None,
+                 progress: Optional[Callable[[int, int], None]] = None):
+        self.sock = sock
+        self.transfer_id = transfer_id
+        self.total_bytes = total_bytes
+        self._pull = pull
+        self._progress = progress
+        self._cond = threading.Condition()
+        self._inflight: Dict[int, Any] = {}   # chunk_index -> (字节数, 发出时间, 发出时已确认的字节数)
+        self.inflight_bytes = 0
+        self.acked_bytes = 0
+        self.window = INITIAL_WINDOW
+        self.peer_window = RECEIVE_WINDOW
+        self.min_rtt: Optional[float] = None
+        self.srtt: Optional[float] = None
+        self._rates: Deque[float] = deque(maxlen=RATE_SAMPLES)
+        self._closed: Optional[str] = None
+
+    @property
+    def limit(self) -> int:
+        return min(self.window, self.peer_window)
+
+    def has_room(self, size: int) -> bool:
+        with self._cond:
+            return self.inflight_bytes == 0 or self.inflight_bytes + size <= self.limit
+
+    def reserve(self, size: int):
+        """等到窗口中放得下 size 字节（窗口为空时总能放下一个数据块）。调用前应先刷新已缓冲的帧。"""
+        deadline = time.monotonic() + ACK_TIMEOUT
+        with self._cond:
+            while self.inflight_bytes and self.inflight_bytes + size > self.limit:
+                self._wait_locked(deadline)
+
+    def sent(self, chunk_index: int, size: int):
+        with self._cond:
+            self._inflight[chunk_index] = (size, time.monotonic(), self.acked_bytes)
+            self.inflight_bytes += size
+
+    def wait_all_acked(self):
+        """等待所有已发出的数据块都被确认，之后的 EndTransfer 表示对端已经收到全部数据。"""
+        deadline = time.monotonic() + ACK_TIMEOUT
+        with self._cond:
+            while self._inflight:
+                self._wait_locked(deadline)
+
+    def _wait_locked(self, deadline: float):
+        if self._closed is not None:
+            raise ConnectionError(self._closed)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"对端 {ACK_TIMEOUT:.0f} 秒没有确认传输 {self.transfer_id}")
+        if self._pull is None:
+            self._cond.wait(remaining)
+            return
+        # 本线程就是该连接的读取者：释放锁读取下一条消息，最多等到截止时间
+        self._cond.release()
+        try:
+            msg = self._pull(self.sock, remaining)
+        except (skt.timeout, TimeoutError):
+            raise TimeoutError(f"对端 {ACK_TIMEOUT:.0f} 秒没有确认传输 {self.transfer_id}") from None
+        finally:
+            self._cond.acquire()
+        if msg is None:
+            self._closed = "等待确认时连接已断开"
+        elif isinstance(msg, S.TransferAckMsg) and msg.transfer_id == self.transfer_id:
+            self._on_ack_locked(msg)
+        elif isinstance(msg, S.TransferAckMsg):
+            deliver_ack(self.sock, msg)
+        else:
+            defer_message(self.sock, msg)
+
+    def on_ack(self, msg: S.TransferAckMsg):
+        with self._cond:
+            self._on_ack_locked(msg)
+            self._cond.notify_all()
+
+    def _on_ack_locked(self, msg: S.TransferAckMsg):
+        now = time.monotonic()
+        newly_acked = 0
+        newest = None
+
+        def ack(index: int):
+            nonlocal newly_acked, newest
+            entry = self._inflight.pop(index, None)
+            if entry is not None:
+                newly_acked += entry[0]
+                if newest is None or entry[1] > newest[1]:
+                    newest = entry
+
+        sack = [(start, end) for start, end in msg.sack or []]
+        for index in [i for i in self._inflight
+                      if i < msg.cumulative or any(start <= i < end for start, end in sack)]:
+            ack(index)
+        self.peer_window = max(MIN_WINDOW, msg.window) if msg.window else RECEIVE_WINDOW
+        if not newly_acked:
+            return
+        self.inflight_bytes -= newly_acked
+        self.acked_bytes += newly_acked
+        size, sent_time, acked_at_send = newest
+        rtt = now - sent_time
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        self.srtt = rtt if self.srtt is None else 0.875 * self.srtt + 0.125 * rtt
+        # 交付速率：最新确认的数据块发出之后到现在确认的字节数除以这段时间。
+        # 即使确认是成批读到的（服务器等到窗口满时才读取），也不会把一批确认误当作极高的速率
+        if rtt > 0:
+            self._rates.append((self.acked_bytes - acked_at_send) / rtt)
+        if self._rates and self.min_rtt:
+            bdp = max(self._rates) * self.min_rtt
+            self.window = int(min(MAX_WINDOW, max(MIN_WINDOW, WINDOW_GAIN * bdp)))
+        if self._progress is not None:
+            self._progress(self.acked_bytes, self.total_bytes)
+
+    def close(self, reason: str):
+        with self._cond:
+            self._closed = reason
+            self._cond.notify_all()
+
+    def summary(self) -> str:
+        rtt = f"{self.min_rtt * 1000:.2f} ms" if self.min_rtt is not None else "-"
+        return f"已确认 {self.acked_bytes} 字节, 最小 RTT {rtt}, 窗口 {self.window // 1024} KB"
+
+# --- 每个连接上正在发送的传输 ---
+
+_windows: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_ack_readers: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_deferred: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+def set_ack_reader(sock: Any, read_one: Callable[[Any, float], Any]):
+    """
+    (服务器) 该连接在处理请求时没有其他线程读取：发送端等待确认时用 read_one(sock, timeout) 自己读取，
+    超过 timeout 秒没有读到消息时 read_one 抛出 TimeoutError；
+    读到的其他消息暂存起来，由 take_deferred 交还给连接的主循环。
+    """
+    _ack_readers[sock] = read_one
+
+def timed_reader(read_one: Callable[[Any], Any]) -> Callable[[Any, float], Any]:
+    """把阻塞 socket 上的 read_one(sock) 包装成 set_ack_reader 所需的带超时读取。"""
+    def read(sock: Any, timeout: float) -> Any:
+        old_timeout = sock.gettimeout()
+        sock.settimeout(timeout)
+        try:
+            return read_one(sock)
+        finally:
+            sock.settimeout(old_timeout)
+    return read
+
+def defer_message(sock: Any, msg: Any):
+    with _lock:
+        _deferred.setdefault(sock, deque()).append(msg)
+
+def take_deferred(sock: Any) -> Optional[Any]:
+    """取出一条等待确认期间读到的其他消息；没有时返回 None。"""
+    with _lock:
+        queue = _deferred.get(sock)
+        return queue.popleft() if queue else None
+
+def open_window(sock: Any, transfer_id: str, total_bytes: int,
+                progress: Optional[Callable[[int, int], None]] = None) -> SendWindow:
+    window = SendWindow(sock, transfer_id, total_bytes, _ack_readers.get(sock), progress)
+    with _lock:
+        _windows.setdefault(sock, {})[transfer_id] = window
+    return window
+
+def close_window(window: SendWindow):
+    with _lock:
+        windows = _windows.get(window.sock)
+        if windows is not None and windows.get(window.transfer_id) is window:
+            del windows[window.transfer_id]
+
+def deliver_ack(sock: Any, msg: S.TransferAckMsg) -> bool:
+    """把读取线程收到的确认交给正在发送该传输的窗口；传输已经结束时返回 False。"""
+    with _lock:
+        window = _windows.get(sock, {}).get(msg.transfer_id)
+    if window is None:
+        return False
+    window.on_ack(msg)
+    return True
+
+def close_windows(sock: Any, reason: str = "连接已断开"):
+    """连接断开：唤醒所有正在等待确认的发送线程。"""
+    with _lock:
+        windows = list(_windows.pop(sock, {}).values())
+    for window in windows:
+        window.close(reason)
+
+# --- 接收端 ---
+
+class AckSender:
+    """
+    接收端的确认：StartTransfer 的 ack_bytes 非 0 时，每收到 ack_bytes 字节以及收齐全部数据块时
+    回复一条 TransferAckMsg。累计确认和选择确认都从 ChunkSpool 的位图得出，
+    续传之前已经收到的块也包含在内。通告的窗口是接收端缓冲中还能容纳的字节数（扣除还没有刷到磁盘的数据）。
+    分条传输时每条连接各有一个 AckSender，chunk_range 是该连接负责的数据块区间，区间收齐时也回复确认。
+    """
+    def __init__(self, sock: Any, start_msg: S.StartTransferMsg, spool: Any,
+                 send: Callable[[Any, Any], None], chunk_range: Optional[Tuple[int, int]] = None):
+        self._sock = sock
+        self._transfer_id = start_msg.transfer_id
+        self._ack_bytes = start_msg.ack_bytes
+        self._spool = spool
+        self._send = send
+        self._range = chunk_range
+        self._pending = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._ack_bytes > 0
+
+    def on_chunk(self, size: int):
+        if not self.enabled:
+            return
+        self._pending += size
+        if (self._pending >= self._ack_bytes or self._spool.complete
+                or (self._range is not None and self._spool.range_complete(*self._range))):
+            self.send_ack()
+
+    def send_ack(self):
+        cumulative = self._spool.first_missing()
+        self._send(self._sock, S.TransferAckMsg(
+            transfer_id=self._transfer_id,
+            cumulative=cumulative,
+            sack=self._spool.received_ranges(cumulative, MAX_SACK_RANGES),
+            window=max(MIN_WINDOW, RECEIVE_WINDOW - self._spool.unsynced_bytes),
+        ))
+        self._pending = 0
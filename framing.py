@@ -0,0 +1,283 @@
+import socket as skt
+import ssl
+import struct
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Union
+
+# 每一帧 = [4 字节大端长度前缀] + 负载
+FRAME_HEADER = struct.Struct('>I')
+# 每个连接复用的接收缓冲区大小；更大的帧直接读入按长度分配的缓冲区
+READ_BUFFER_SIZE = 64 * 1024
+# 批量发送时缓冲的上限：攒够这么多字节，或最早的一帧已等待 WRITE_MAX_DELAY 秒，就立即写出
+WRITE_BUFFER_SIZE = 256 * 1024
+WRITE_MAX_DELAY = 0.005
+# 一次 sendmsg 最多携带的片段数 (IOV_MAX)
+SENDMSG_MAX_PARTS = 1024
+
+# --- 帧大小上限 ---
+
+# 按连接角色限制单帧长度，读到长度前缀后、分配任何缓冲区之前检查：
+# 服务器只接收客户端的小请求；客户端和 P2P 对端还要接收通讯录、公钥和文件的数据块
+FRAME_SIZE_LIMITS: Dict[str, int] = {
+    'server': 64 * 1024,
+    'client': 16 * 1024 * 1024,
+    'peer': 16 * 1024 * 1024,
+}
+DEFAULT_FRAME_ROLE = 'client'
+# 按帧类型（负载的第一个字节，见 serializer）进一步限制：
+# 二进制数据块帧 (0x01) 和压缩数据块帧 (0x03) 不会超过协商的最大块 (64KB) 加块头
+FRAME_KIND_LIMITS: Dict[int, int] = {
+    0x01: 64 * 1024 + 64,
+    0x03: 64 * 1024 + 64,
+}
+# 不超过这个长度的大帧按长度一次性分配；更长的帧随数据到达逐步扩大缓冲区，
+# 只发长度前缀却迟迟不发数据的对端占用的内存与实际收到的数据量相当，而不是它声称的长度
+FRAME_PREALLOCATE_SIZE = 1024 * 1024
+
+class FrameTooLargeError(ConnectionError):
+    """对端发来的帧超过了该连接允许的长度。帧的其余部分无法跳过，连接只能关闭。"""
+    def __init__(self, length: int, limit: int, kind: Optional[int] = None):
+        kind_text = f" (帧类型 0x{kind:02x})" if kind is not None else ""
+        super().__init__(f"帧长度 {length} 字节超过上限 {limit} 字节{kind_text}。")
+        self.length = length
+        self.limit = limit
+        self.kind = kind
+
+def frame_limit(role: str) -> int:
+    return FRAME_SIZE_LIMITS.get(role, FRAME_SIZE_LIMITS[DEFAULT_FRAME_ROLE])
+
+def check_frame_length(length: int, limit: int, kind: Optional[int] = None):
+    """帧长度超过连接的上限 limit 或帧类型 kind 的上限时抛出 FrameTooLargeError。"""
+    if kind is not None:
+        limit = min(limit, FRAME_KIND_LIMITS.get(kind, limit))
+    if length > limit:
+        raise FrameTooLargeError(length, limit, kind)
+
+class FrameReader:
+    """
+    带缓冲的帧读取器，客户端、服务器和 P2P 的 recv 都通过它读取长度前缀帧。
+
+    TLS 连接上的 recv(n) 经常只返回一部分数据，直接 recv(4) + recv(length)
+    会把大帧读断并导致后续数据错位。这里用 recv_into 把数据读入一个复用的 bytearray，
+    一次 recv 可能带回多个小帧，多出来的部分留在缓冲区中供下一次读取；
+    超过缓冲区大小的帧按长度一次性分配并原地填充，不再逐块 append 后 join。
+    长度前缀超过 max_frame_size（或该帧类型的上限）时，在读取负载之前抛出 FrameTooLargeError。
+    """
+    def __init__(self, sock, buffer_size: int = READ_BUFFER_SIZE, role: str = DEFAULT_FRAME_ROLE):
+        self._sock = sock
+        self.max_frame_size = frame_limit(role)
+        self._buf = bytearray(buffer_size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+        # 被 unread_frame 退回、下次 read_frame 优先返回的帧
+        self._pending: List[Union[bytes, bytearray]] = []
+
+    def buffered(self) -> int:
+        """缓冲区中尚未读取的字节数（select 之前需要先检查这里）。"""
+        return self._end - self._start + sum(len(p) for p in self._pending)
+
+    def _fill(self, n: int) -> bool:
+        """保证缓冲区中至少有 n 字节。连接在读到任何数据前关闭时返回 False。"""
+        if self._end - self._start >= n:
+            return True
+        if len(self._buf) - self._start < n:
+            # 尾部空间不够，把未读数据移到缓冲区开头
+            remaining = self._end - self._start
+            self._buf[:remaining] = self._buf[self._start:self._end]
+            self._start, self._end = 0, remaining
+        while self._end - self._start < n:
+            received = self._sock.recv_into(self._view[self._end:])
+            if received == 0:
+                if self._end == self._start:
+                    return False
+                raise ConnectionError("对端在传输数据时断开连接。")
+            self._end += received
+        return True
+
+    def _consume(self, n: int) -> memoryview:
+        data = self._view[self._start:self._start + n]
+        self._start += n
+        if self._start == self._end:
+            self._start = self._end = 0
+        return data
+
+    def read_exact(self, n: int) -> Union[bytes, bytearray]:
+        """读取恰好 n 字节；连接关闭时抛出 ConnectionError。"""
+        if n <= len(self._buf):
+            if not self._fill(n):
+                raise ConnectionError("连接已关闭。")
+            return bytes(self._consume(n))
+
+        # 大帧：先取走缓冲区中已有的部分，其余直接读入目标缓冲区
+        got = min(self._end - self._start, n)
+        data = bytearray(min(n, max(FRAME_PREALLOCATE_SIZE, got)))
+        data[:got] = self._consume(got)
+        while got < n:
+            if got == len(data):
+                # 缓冲区已满：按倍数扩大（不超过帧长度）后继续读
+                data.extend(bytes(min(len(data), n - len(data))))
+            with memoryview(data) as target:
+                received = self._sock.recv_into(target[got:])
+            if received == 0:
+                raise ConnectionError("对端在传输数据时断开连接。")
+            got += received
+        return data
+
+    def read_frame(self) -> Optional[Union[bytes, bytearray]]:
+        """
+        读取一帧的负载。连接在帧边界处正常关闭时返回 None，
+        在帧中途关闭时抛出 ConnectionError。
+        """
+        if self._pending:
+            return self._pending.pop(0)
+        if not self._fill(FRAME_HEADER.size):
+            return None
+        (length,) = FRAME_HEADER.unpack(self._consume(FRAME_HEADER.size))
+        check_frame_length(length, self.max_frame_size)
+        if length > 0:
+            # 再看一眼负载的第一个字节（帧类型），按类型的上限检查后才开始缓冲
+            if not self._fill(1):
+                raise ConnectionError("对端在传输数据时断开连接。")
+            check_frame_length(length, self.max_frame_size, self._buf[self._start])
+        return self.read_exact(length)
+
+    def unread_frame(self, payload: Union[bytes, bytearray]):
+        """退回一帧已读取的负载，下一次 read_frame 会先返回它（例如握手时读到的不是 Hello）。"""
+        self._pending.append(payload)
+
+_readers: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_readers_lock = threading.Lock()
+
+def get_frame_reader(sock) -> FrameReader:
+    """返回 sock 专属的 FrameReader（同一连接上的所有读取必须共用它，否则缓冲的数据会丢失）。"""
+    reader = _readers.get(sock)
+    if reader is None:
+        with _readers_lock:
+            reader = _readers.get(sock)
+            if reader is None:
+                reader = _readers[sock] = FrameReader(sock)
+    return reader
+
+def set_frame_role(sock, role: str):
+    """按连接角色 ('server' / 'client' / 'peer') 设置 sock 上允许接收的最大帧长度。"""
+    get_frame_reader(sock).max_frame_size = frame_limit(role)
+
+def read_frame(sock) -> Optional[Union[bytes, bytearray]]:
+    """从 sock 读取一帧的负载，见 FrameReader.read_frame。"""
+    return get_frame_reader(sock).read_frame()
+
+def buffered_bytes(sock) -> int:
+    """sock 的读取器中已缓冲但尚未读取的字节数。"""
+    reader = _readers.get(sock)
+    return reader.buffered() if reader is not None else 0
+
+def unread_frame(sock, payload: Union[bytes, bytearray]):
+    """把读到的一帧退回 sock 的读取器，见 FrameReader.unread_frame。"""
+    get_frame_reader(sock).unread_frame(payload)
+
+# --- 发送 ---
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+class FrameWriter:
+    """
+    合并写出的帧发送器，服务器、客户端和 P2P 的发送都通过它。
+
+    不在批量发送中时，每帧立即写出（与原来的 sendall(serialize(msg)) 行为一致）；
+    在 batch() 中写入的帧先缓冲起来，攒够 max_buffer 字节、最早的一帧已等待 max_delay 秒
+    或 batch() 结束时才一次写出，一个 TLS 写入 / 一次系统调用可以带走多个帧。
+    长度前缀和负载作为独立的片段保存，不再为每帧拼接一次 bytes；
+    普通 socket 用 sendmsg 做向量写，TLS socket 不支持 sendmsg，合并为一个缓冲区后写出。
+    延迟阈值只在写入新帧时检查，批量发送的结束（batch() 退出或 flush()）是显式的刷新点。
+    """
+    def __init__(self, sock, max_buffer: int = WRITE_BUFFER_SIZE, max_delay: float = WRITE_MAX_DELAY):
+        self._sock = sock
+        self._max_buffer = max_buffer
+        self._max_delay = max_delay
+        self._lock = threading.RLock()
+        self._parts: List[Buffer] = []
+        self._size = 0
+        self._first_write = 0.0
+        self._batch_depth = 0
+        self._vectored = isinstance(sock, skt.socket) and not isinstance(sock, ssl.SSLSocket)
+
+    def write_frame(self, *parts: Buffer):
+        """写入一帧，parts 依次拼成该帧的负载（不含长度前缀）。"""
+        length = sum(len(p) for p in parts)
+        with self._lock:
+            if not self._parts:
+                self._first_write = time.monotonic()
+            self._parts.append(FRAME_HEADER.pack(length))
+            self._parts.extend(parts)
+            self._size += FRAME_HEADER.size + length
+            if (self._batch_depth == 0 or self._size >= self._max_buffer
+                    or time.monotonic() - self._first_write >= self._max_delay):
+                self._flush_locked()
+
+    def flush(self):
+        """立即写出所有缓冲的帧。"""
+        with self._lock:
+            self._flush_locked()
+
+    @contextmanager
+    def batch(self) -> Iterator["FrameWriter"]:
+        """在 with 块中写入的帧合并写出，退出时刷新。可以嵌套，最外层退出时才刷新。"""
+        with self._lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self._flush_locked()
+
+    def _flush_locked(self):
+        if not self._parts:
+            return
+        parts, self._parts, self._size = self._parts, [], 0
+        if self._vectored:
+            self._sendmsg_all(parts)
+        elif len(parts) == 1:
+            self._sock.sendall(parts[0])
+        else:
+            self._sock.sendall(b''.join(parts))
+
+    def _sendmsg_all(self, parts: List[Buffer]):
+        """用 sendmsg 向量写出全部片段，处理部分写入。"""
+        views = [memoryview(p).cast('B') for p in parts]
+        i = 0
+        while i < len(views):
+            sent = self._sock.sendmsg(views[i:i + SENDMSG_MAX_PARTS])
+            while sent:
+                if sent >= len(views[i]):
+                    sent -= len(views[i])
+                    i += 1
+                else:
+                    views[i] = views[i][sent:]
+                    sent = 0
+
+_writers: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_writers_lock = threading.Lock()
+
+def get_frame_writer(sock) -> FrameWriter:
+    """返回 sock 专属的 FrameWriter（同一连接上的所有发送必须共用它，否则帧的顺序会被打乱）。"""
+    writer = _writers.get(sock)
+    if writer is None:
+        with _writers_lock:
+            writer = _writers.get(sock)
+            if writer is None:
+                writer = _writers[sock] = FrameWriter(sock)
+    return writer
+
+def write_frame(sock, *parts: Buffer):
+    """向 sock 写入一帧，见 FrameWriter.write_frame。"""
+    get_frame_writer(sock).write_frame(*parts)
+
+def batched(sock):
+    """合并 sock 上接下来写入的帧：with batched(sock): ..."""
+    return get_frame_writer(sock).batch()
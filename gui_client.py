@@ -20,6 +20,9 @@ import uuid
 import datetime as dt
 from serializer import serialize, deserialize
 
+# 登录后空闲超过这么多秒就发送一次 AliveMsg（需小于服务器的 HEARTBEAT_TIMEOUT，与 client.py 相同）
+HEARTBEAT_INTERVAL = 30
+
 class ChatGUI:
     def __init__(self, root):
         self.root = root
@@ -50,6 +53,8 @@ class ChatGUI:
         
         # 定期检查消息队列
         self.root.after(100, self.check_message_queue)
+        # 定期发送心跳，否则服务器会把空闲的界面客户端判定为下线
+        self.root.after(HEARTBEAT_INTERVAL * 1000, self.send_heartbeat)
 
     def create_widgets(self):
         # 主框架
@@ -570,6 +575,18 @@ class ChatGUI:
     def check_message_queue(self):
         self.root.after(100, self.check_message_queue)
 
+    def send_heartbeat(self):
+        self.root.after(HEARTBEAT_INTERVAL * 1000, self.send_heartbeat)
+        if self.current_user and self.ssl_connect_sock and T.heartbeat_due(HEARTBEAT_INTERVAL):
+            # 发送可能阻塞，不在界面线程中进行
+            threading.Thread(target=self._heartbeat_thread, daemon=True).start()
+
+    def _heartbeat_thread(self):
+        try:
+            T.handle_alive(self.ssl_connect_sock, self.user_id)
+        except OSError as e:
+            print(f"[心跳] 发送失败: {e}")
+
     def add_friend(self):
         if not self.current_user:
             messagebox.showerror("错误", "请先登录后再添加好友！")
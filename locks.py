@@ -0,0 +1,55 @@
+import threading
+from contextlib import contextmanager
+from typing import Hashable, Iterator, List
+
+# 锁的条带数量：不同用户大概率落在不同的锁上，内存占用与用户数无关
+LOCK_STRIPES = 256
+
+class StripedLockManager:
+    """
+    按用户（或文件）分条带的锁管理器。
+
+    服务器的处理线程会并发地对同一份数据做“读取-修改-写回”（例如 data/directory/<user>.json），
+    用一把全局锁会让所有用户的请求串行执行；这里把 key 散列到固定数量的可重入锁上，
+    同一用户的操作互斥，不同用户的操作基本可以并行。
+    """
+    def __init__(self, stripes: int = LOCK_STRIPES):
+        if stripes < 1:
+            raise ValueError("stripes 必须大于 0")
+        self._locks: List[threading.RLock] = [threading.RLock() for _ in range(stripes)]
+
+    def _index(self, key: Hashable) -> int:
+        return hash(key) % len(self._locks)
+
+    def lock_for(self, key: Hashable) -> threading.RLock:
+        """返回 key 所在条带的锁。"""
+        return self._locks[self._index(key)]
+
+    @contextmanager
+    def locked(self, *keys: Hashable) -> Iterator[None]:
+        """
+        同时持有多个 key 的锁。按条带编号顺序加锁，
+        两个线程以不同顺序锁定同一组用户时也不会死锁。
+        """
+        indexes = sorted({self._index(key) for key in keys})
+        acquired = []
+        try:
+            for i in indexes:
+                self._locks[i].acquire()
+                acquired.append(i)
+            yield
+        finally:
+            for i in reversed(acquired):
+                self._locks[i].release()
+
+_lock_manager = None
+_lock_manager_lock = threading.Lock()
+
+def get_lock_manager() -> StripedLockManager:
+    """返回进程内共享的条带锁管理器。"""
+    global _lock_manager
+    if _lock_manager is None:
+        with _lock_manager_lock:
+            if _lock_manager is None:
+                _lock_manager = StripedLockManager()
+    return _lock_manager
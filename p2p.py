@@ -6,7 +6,13 @@ import schema as S
 import Transaction_Client as T
 import json
 import datetime as dt
-from serializer import serialize, deserialize
+from serializer import serialize, deserialize, decode_frame, send_msg
+from framing import read_frame, set_frame_role, unread_frame
+from transfer import INLINE_FILE_TYPES, ChunkSpool, chunk_data, inline_file_info, resume_request, resume_transfer, send_file
+from capabilities import client_hello, get_capabilities, server_hello
+import resume
+from flow import AckSender, close_windows, deliver_ack
+from stripe import expect_stripes, forget, serve_stripe
 import threading
 import pprint
 import time
@@ -20,67 +26,100 @@ CA_FILE = "ca.crt"
 CLIENT_CERT_FILE = "client.crt"
 PEER_HOSTNAME = 'CLIENT'
 CLIENT_KEY_FILE = "client_rsa_private.pem.unsecure"
+# 新的 P2P 连接完成 TLS 握手的超时（秒）；握手在单独的线程中进行，不会拖住 accept
+P2P_HANDSHAKE_TIMEOUT = 10
 
 def save_received_file(transfer_info: dict, current_user: str):
+    """保存对端内联发送的小文件（分块传输的文件由 ChunkSpool 直接写入）。"""
     file_name = transfer_info['file_name']
     file_type = transfer_info['file_type']
     full_data = transfer_info['data']
-    save_dir = ""
     try:
-        if file_type == 'image': save_dir = os.path.join('user', current_user, 'image')
-        elif file_type == 'audio': save_dir = os.path.join('user', current_user, 'audio')
-        elif file_type == 'file': save_dir = os.path.join('user', current_user, 'file')
-        else:
-            print(f"[警告] 未知的文件类型 '{file_type}'，将保存到 'downloads' 目录。")
-            save_dir = os.path.join('user', current_user, 'downloads')
-        os.makedirs(save_dir, exist_ok=True)
-        save_path = os.path.join(save_dir, file_name)
+        save_path = T.received_file_path(current_user, file_type, file_name)
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
         with open(save_path, 'wb') as f: f.write(full_data)
         print(f"\n[文件保存] 文件 '{file_name}' 已成功保存至: {save_path}")
     except Exception as e: print(f"\n[文件保存] 保存 '{file_name}' 时出错: {e}")
 
-def handle_p2p_file_reception(p2p_sock: ssl.SSLSocket, start_msg: S.StartTransferMsg, current_user: str):
+def handle_p2p_file_reception(p2p_sock: ssl.SSLSocket, start_msg: S.StartTransferMsg, current_user: str,
+                              peer: str = ''):
+    """
+    接收一次 P2P 文件传输：数据块按编号直接写入预分配的临时文件（可以乱序到达），
+    收到成功的 EndTransfer 且所有数据块到齐后原子地改名为目标文件。
+    StartTransfer 带有内容哈希时，中断后保留已收到的数据块，下次与 peer 聊天时续传。
+    分条传输时本连接只收第 0 段，其余各段由对端新建的连接送到同一个临时文件（见 route_incoming）。
+    """
     transfer_id = start_msg.transfer_id
     file_name = start_msg.file_name
-    print(f"\n[文件接收] 准备接收 '{file_name}' (ID: {transfer_id})...")
-    received_data = bytearray()
-    chunks_received = 0
     total_chunks = start_msg.total_chunks
-    while chunks_received < total_chunks:
-        msg = recv_p2p_msg(p2p_sock)
-        if msg is None:
-            print(f"\n[文件接收] 在接收 '{file_name}' 期间连接中断。传输失败。")
-            return
-        if not hasattr(msg, 'transfer_id') or msg.transfer_id != transfer_id:
-            print(f"\n[文件接收] 错误: 在等待ID为'{transfer_id}'的数据块时，收到了一个无关的消息。")
-            continue
-        if isinstance(msg, S.DataChunkMsg):
-            try:
-                if msg.chunk_index != chunks_received:
-                    print(f"\n[文件接收] 错误: 期望接收块 {chunks_received}，但收到了块 {msg.chunk_index}。")
-                    return
-                decoded_data = base64.b64decode(msg.data)
-                received_data.extend(decoded_data)
+    print(f"\n[文件接收] 准备接收 '{file_name}' (ID: {transfer_id})...")
+    try:
+        spool = ChunkSpool(T.received_file_path(current_user, start_msg.file_type, file_name),
+                           start_msg.total_size, start_msg.chunk_size, total_chunks,
+                           transfer_id, start_msg.content_hash, peer, get_capabilities(p2p_sock).chunk_size)
+    except (OSError, ValueError) as e:
+        print(f"\n[文件接收] 无法创建临时文件: {e}")
+        # 通知发送端放弃这次传输（例如 transfer_id 不是合法的 UUID）
+        try:
+            send_msg(p2p_sock, S.EndTransferMsg(transfer_id=transfer_id, status='cancelled'))
+        except OSError:
+            pass
+        return
+    chunks_received = spool.resumed_chunks
+    if chunks_received:
+        print(f"[文件接收] 续传: 已有 {chunks_received}/{total_chunks} 块。")
+    reception = expect_stripes(start_msg, spool)
+    if reception is not None:
+        print(f"[文件接收] 对端使用 {reception.stripes} 条连接并行发送。")
+    acks = AckSender(p2p_sock, start_msg, spool, send_msg, reception.ranges[0] if reception else None)
+    try:
+        while True:
+            msg = recv_p2p_msg(p2p_sock)
+            if msg is None:
+                print(f"\n[文件接收] 在接收 '{file_name}' 期间连接中断。传输失败。")
+                forget(reception)
+                spool.release()
+                if spool.resumable:
+                    print(f"[文件接收] 已收到的 {chunks_received}/{total_chunks} 块已保留，下次连接时续传。")
+                return
+            if isinstance(msg, S.TransferAckMsg):
+                # 本端同时在向对端发送文件：确认交给发送线程
+                deliver_ack(p2p_sock, msg)
+                continue
+            if not hasattr(msg, 'transfer_id') or msg.transfer_id != transfer_id:
+                print(f"\n[文件接收] 错误: 在等待ID为'{transfer_id}'的数据块时，收到了一个无关的消息。")
+                continue
+            if isinstance(msg, S.DataChunkMsg):
+                data = chunk_data(msg)
+                spool.write_chunk(msg.chunk_index, data)
+                acks.on_chunk(len(data))
                 chunks_received += 1
                 print(f"\r  > 正在接收 '{file_name}': {chunks_received}/{total_chunks} 块...", end="")
-            except Exception as e:
-                print(f"\n[文件接收] 处理数据块 {msg.chunk_index} 时失败: {e}")
-                return
-        elif isinstance(msg, S.EndTransferMsg):
-            print(f"\n[文件接收] 错误: 在所有数据块接收完成前，过早地收到了结束信号。")
-            return
+            elif isinstance(msg, S.EndTransferMsg):
+                break
+    except Exception as e:
+        print(f"\n[文件接收] 处理数据块时失败: {e}")
+        forget(reception)
+        spool.abort()
+        return
     print()
-    final_msg = recv_p2p_msg(p2p_sock)
-    if isinstance(final_msg, S.EndTransferMsg) and final_msg.transfer_id == transfer_id:
-        if final_msg.status == 'success':
-            print(f"[文件接收] '{file_name}' 传输校验成功！")
-            transfer_info = {'file_name': file_name, 'file_type': start_msg.file_type, 'data': received_data}
-            save_received_file(transfer_info, current_user)
-        else:
-            print(f"[文件接收] 对端取消了 '{file_name}' 的传输 (状态: {final_msg.status})。")
-    else: print(f"\n[文件接收] 错误: 未收到有效的结束信号。")
+    # 原连接上的 EndTransfer 之后，其余各段也要收完
+    if msg.status == 'success' and reception is not None and not reception.wait():
+        msg.status = 'cancelled'
+        print(f"[文件接收] '{file_name}' 的部分分段没有收完。")
+    forget(reception)
+    if msg.status != 'success':
+        print(f"[文件接收] 对端取消了 '{file_name}' 的传输 (状态: {msg.status})。")
+        spool.release(msg.status)
+        return
+    try:
+        save_path = spool.commit()
+        print(f"[文件接收] '{file_name}' 传输校验成功！")
+        print(f"\n[文件保存] 文件 '{file_name}' 已成功保存至: {save_path}")
+    except Exception as e: print(f"\n[文件接收] 错误: 保存 '{file_name}' 失败: {e}")
 
-def create_secure_connection(server_ip_port, ca_file, cert_file, key_file, peer_hostname):
+def create_secure_connection(server_ip_port, ca_file, cert_file, key_file, peer_hostname, negotiate=True,
+                             verbose=True):
     try:
         context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
         context.verify_mode = ssl.CERT_REQUIRED
@@ -89,9 +128,21 @@ def create_secure_connection(server_ip_port, ca_file, cert_file, key_file, peer_
         sock = skt.socket(skt.AF_INET, skt.SOCK_STREAM)
         ssl_sock = context.wrap_socket(sock, server_hostname = peer_hostname)
         ssl_sock.connect(server_ip_port)
-        print("--- 成功连接到服务器 ---")
-        pprint.pprint(ssl_sock.getpeercert())
-        print("------------------------\n")
+        if verbose:
+            print("--- 成功连接到服务器 ---")
+            pprint.pprint(ssl_sock.getpeercert())
+            print("------------------------\n")
+        if negotiate:
+            # TLS 握手后立即协商编码、压缩和帧/块大小；对端不认识 Hello 而断开时重连并使用旧协议
+            try:
+                caps = client_hello(ssl_sock)
+            except ConnectionError:
+                ssl_sock.close()
+                print("[能力协商] 对端不支持能力协商，重新连接并使用 JSON。")
+                return create_secure_connection(server_ip_port, ca_file, cert_file, key_file,
+                                                peer_hostname, negotiate=False, verbose=verbose)
+            if verbose:
+                print(f"[能力协商] 编码: {caps.codec}, 数据块: {caps.chunk_size} 字节, 特性: {caps.features}")
         return ssl_sock
     except FileNotFoundError as e: print(f"\n错误: 找不到证书文件 '{e.filename}'。请确保文件存在于正确的位置。"); return None
     except ssl.SSLCertVerificationError as e: print(f"\n错误: 服务器证书验证失败! {e}"); return None
@@ -103,14 +154,10 @@ def create_secure_connection(server_ip_port, ca_file, cert_file, key_file, peer_
 
 def recv_p2p_msg(ssl_connect_sock):
     try:
-        len_bytes = ssl_connect_sock.recv(4)
-        if not len_bytes: return None
-        msg_len = int.from_bytes(len_bytes, byteorder='big')
-        json_bytes = ssl_connect_sock.recv(msg_len)
-        if not json_bytes: return None
-        msg_dict = json.loads(json_bytes.decode("UTF-8"))
-        return deserialize(msg_dict)
-    except (ConnectionResetError, json.JSONDecodeError) as e: print(f"\n[Chat] Error receiving P2P message: {e}"); return None
+        json_bytes = read_frame(ssl_connect_sock)
+        if json_bytes is None: return None
+        return decode_frame(json_bytes)
+    except (ConnectionError, ValueError) as e: print(f"\n[Chat] Error receiving P2P message: {e}"); return None
     except UnicodeDecodeError as e: print(f"\n[Chat] CRITICAL: UnicodeDecodeError during P2P receive: {e}"); return None
 
 def p2p_listener(p2p_server_sock, chat_queue):
@@ -127,18 +174,60 @@ def p2p_listener(p2p_server_sock, chat_queue):
     while True:
         try:
             conn, addr = p2p_server_sock.accept()
-            # --- 修正处: 将之前导致语法错误的换行合并为一行 ---
             print(f"\n[P2P Listener] 接受到来自 {addr} 的TCP连接，正在进行SSL握手...")
-            
-            ssl_conn = p2p_ssl_context.wrap_socket(conn, server_side=True)
-            print(f"[P2P Listener] 与 {addr} 的SSL握手成功！")
-            chat_queue.put(ssl_conn)
-
-        except ssl.SSLError as e:
-            print(f"\n[P2P Listener] 来自 {addr} 的SSL握手失败: {e}")
+            # 握手和能力协商交给单独的线程，慢的或不发送数据的对端不会挡住后面的连接
+            threading.Thread(target=accept_peer, args=(conn, addr, p2p_ssl_context, chat_queue),
+                             name="p2p-accept", daemon=True).start()
         except Exception as e:
             print(f"\n[P2P Listener] 发生错误: {e}")
 
+def accept_peer(conn, addr, p2p_ssl_context, chat_queue):
+    """在 P2P_HANDSHAKE_TIMEOUT 内完成 TLS 握手，再进行能力协商，然后把连接交给聊天会话或分条传输。"""
+    try:
+        conn.settimeout(P2P_HANDSHAKE_TIMEOUT)
+        ssl_conn = p2p_ssl_context.wrap_socket(conn, server_side=True)
+        ssl_conn.settimeout(None)
+    except (ssl.SSLError, OSError) as e:
+        print(f"\n[P2P Listener] 来自 {addr} 的SSL握手失败: {e}")
+        conn.close()
+        return
+    print(f"[P2P Listener] 与 {addr} 的SSL握手成功！")
+    try:
+        set_frame_role(ssl_conn, 'peer')
+        # 等待对端的 Hello；旧版本的对端直接发送聊天消息，该消息会留给会话读取
+        caps = server_hello(ssl_conn)
+    except (OSError, ValueError) as e:
+        print(f"\n[P2P Listener] 与 {addr} 的能力协商失败: {e}")
+        ssl_conn.close()
+        return
+    print(f"[P2P Listener] 能力协商: 编码 {caps.codec}, 数据块 {caps.chunk_size} 字节")
+    if caps.streams > 1:
+        # 可能是对端为分条传输新建的连接，读到第一条消息才知道交给谁
+        route_incoming(ssl_conn, chat_queue)
+    else:
+        chat_queue.put(ssl_conn)
+
+def route_incoming(ssl_conn, chat_queue):
+    """
+    以 StripeJoin 开头的连接在本线程中接收一段分条传输（聊天会话正在接收原连接，不能等主线程处理）；
+    其他连接把第一条消息退回读取器后交给主线程开始聊天会话。
+    """
+    try:
+        payload = read_frame(ssl_conn)
+        msg = decode_frame(payload) if payload is not None else None
+    except (OSError, ValueError) as e:
+        print(f"\n[P2P Listener] 读取新连接的第一条消息失败: {e}")
+        ssl_conn.close()
+        return
+    if msg is None:
+        ssl_conn.close()
+        return
+    if isinstance(msg, S.StripeJoinMsg):
+        serve_stripe(ssl_conn, msg, recv_p2p_msg, send_msg)
+        return
+    unread_frame(ssl_conn, payload)
+    chat_queue.put(ssl_conn)
+
 def run_p2p_chat_session(ssl_connect_sock, friend_name, current_user, user_id, first_message=None):
     global MY_USERNAME
     MY_USERNAME = current_user
@@ -147,6 +236,7 @@ def run_p2p_chat_session(ssl_connect_sock, friend_name, current_user, user_id, f
         print("--- 输入 '/exit' 结束聊天。 ---")
         recv_thread = threading.Thread(target=receiver_thread_func, args=(ssl_connect_sock, friend_name, first_message), daemon=True)
         recv_thread.start()
+        request_resumes(ssl_connect_sock, current_user, friend_name)
         while True:
             msg_content = input("You: ")
             if not recv_thread.is_alive(): break
@@ -159,7 +249,7 @@ def run_p2p_chat_session(ssl_connect_sock, friend_name, current_user, user_id, f
                     continue
                 _, file_type, file_name = parts
                 if file_type.lower() in ['image', 'audio', 'file']:
-                    send_large_data_p2p(ssl_connect_sock, current_user, file_type.lower(), file_name)
+                    send_large_data_p2p(ssl_connect_sock, current_user, file_type.lower(), file_name, friend_name)
                 else:
                     print(f"不支持的文件类型: '{file_type}'。")
             else:
@@ -178,10 +268,44 @@ def run_p2p_chat_session(ssl_connect_sock, friend_name, current_user, user_id, f
                         )
                 else: break
 
+def request_resumes(p2p_sock, current_user, friend_name):
+    """请对端续传上次没有收完的文件（包括程序重启之前的），对端只发送缺少的数据块。"""
+    if not get_capabilities(p2p_sock).supports('resume'):
+        return
+    for state in resume.find_partials(T.partial_directories(current_user), friend_name):
+        print(f"[续传] 请求 {friend_name} 继续发送 '{state.get('file_name')}'...")
+        try:
+            send_msg(p2p_sock, resume_request(state, current_user))
+        except Exception as e:
+            print(f"[续传] 发送续传请求失败: {e}")
+            return
+
+def answer_resume_request(p2p_sock, msg: S.ResumeTransferMsg, friend_name):
+    """
+    (发送端) 对端请求续传：在单独的线程中补发缺少的数据块，
+    接收线程继续读取，双方同时续传时不会因为都不读取而互相阻塞。
+    """
+    def run():
+        try:
+            sent = resume_transfer(p2p_sock, msg, T.outgoing_transfers(MY_USERNAME), friend_name)
+            if sent:
+                print(f"\n[P2P 发送] 续传 (ID: {msg.transfer_id}) 完成，补发 {sent} 块。")
+            else:
+                print(f"\n[P2P 发送] 无法续传 (ID: {msg.transfer_id})，已通知 {friend_name}。")
+        except Exception as e:
+            print(f"\n[P2P 发送错误] 续传 (ID: {msg.transfer_id}) 失败: {e}")
+    threading.Thread(target=run, name="p2p-resume", daemon=True).start()
+
 def handle_incoming_chat_session(incoming_socket, current_user, user_id):
     first_msg = recv_p2p_msg(incoming_socket)
     if isinstance(first_msg, S.MessageMsg):
         friend_name = first_msg.sender_name
+    elif isinstance(first_msg, S.ResumeTransferMsg) and first_msg.requester:
+        # 对端连接后先请求续传，会话照常开始
+        friend_name = first_msg.requester
+    else:
+        friend_name = None
+    if friend_name:
         run_p2p_chat_session(
             ssl_connect_sock=incoming_socket,
             friend_name=friend_name,
@@ -194,6 +318,8 @@ def handle_incoming_chat_session(incoming_socket, current_user, user_id):
         incoming_socket.close()
 
 def receiver_thread_func(ssl_connect_sock, friend_name, first_message=None):
+    if isinstance(first_message, S.ResumeTransferMsg):
+        answer_resume_request(ssl_connect_sock, first_message, friend_name)
     if first_message and isinstance(first_message, S.MessageMsg):
         print(f"\r[{first_message.sender_name} 说]: {first_message.content}      ")
         now = dt.datetime.now()
@@ -208,6 +334,8 @@ def receiver_thread_func(ssl_connect_sock, friend_name, first_message=None):
         msg = recv_p2p_msg(ssl_connect_sock)
         if msg is None:
             print(f"\n[聊天] {friend_name} 已断开连接。按回车键退出聊天。")
+            # 正在等待确认的发送线程不必等到超时
+            close_windows(ssl_connect_sock)
             break
         if isinstance(msg, S.MessageMsg) and msg.sender_name == friend_name:
             print(f"\r[{msg.sender_name} 说]: {msg.content}      ")
@@ -220,7 +348,21 @@ def receiver_thread_func(ssl_connect_sock, friend_name, first_message=None):
                 )
             print("You: ", end="", flush=True)
         elif isinstance(msg, S.StartTransferMsg):
-            handle_p2p_file_reception(ssl_connect_sock, msg, MY_USERNAME)
+            handle_p2p_file_reception(ssl_connect_sock, msg, MY_USERNAME, friend_name)
+            print("You: ", end="", flush=True)
+        elif isinstance(msg, S.ResumeTransferMsg):
+            answer_resume_request(ssl_connect_sock, msg, friend_name)
+        elif isinstance(msg, S.TransferAckMsg):
+            deliver_ack(ssl_connect_sock, msg)
+        elif isinstance(msg, S.EndTransferMsg) and msg.status in resume.DISCARD_STATUSES:
+            # 对我们续传请求的回复：发送端已经无法续传，删除未完成的文件
+            state_path = resume.find_partial(T.partial_directories(MY_USERNAME), msg.transfer_id)
+            if state_path:
+                resume.discard_partial(state_path)
+                print(f"\n[续传] {friend_name} 无法续传 (ID: {msg.transfer_id})，已删除未完成的文件。")
+        elif isinstance(msg, tuple(INLINE_FILE_TYPES)):
+            # 小文件内联在一条消息中，直接保存
+            save_received_file(inline_file_info(msg), MY_USERNAME)
             print("You: ", end="", flush=True)
 
 def start_p2p_chat(friend_name, ip, port, current_user, user_id):
@@ -235,7 +377,25 @@ def start_p2p_chat(friend_name, ip, port, current_user, user_id):
         return
     run_p2p_chat_session(ssl_connect_sock, friend_name, current_user, user_id)
 
-def send_large_data_p2p(p2p_sock, current_user, file_type, file_name):
+def stripe_connector(friend_name):
+    """返回新建一条到 friend_name 的连接的函数（分条传输用）；通讯录中没有对端的监听地址时返回 None。"""
+    address = contacts_map.get(friend_name, {}).get("address")
+    if not address:
+        return None
+    try:
+        ip, port_str = address.rsplit(':', 1)
+        port = int(port_str)
+    except ValueError:
+        return None
+    def connect():
+        return create_secure_connection(
+            server_ip_port=(ip, port), ca_file=CA_FILE,
+            cert_file=CLIENT_CERT_FILE, key_file=CLIENT_KEY_FILE,
+            peer_hostname=PEER_HOSTNAME, verbose=False
+        )
+    return connect
+
+def send_large_data_p2p(p2p_sock, current_user, file_type, file_name, receiver_name=''):
     filepath = ""
     try:
         base_dir = os.path.join('user', current_user)
@@ -243,27 +403,16 @@ def send_large_data_p2p(p2p_sock, current_user, file_type, file_name):
         elif file_type == 'audio': filepath = os.path.join(base_dir, 'audio', file_name)
         elif file_type == 'file': filepath = os.path.join(base_dir, 'file', file_name)
         else: print(f"[P2P 发送错误] 不支持的文件类型: {file_type}"); return False
-        with open(filepath, 'rb') as f: data_bytes = f.read()
+        # 只检查文件是否存在，内容在发送时流式读取
+        if not os.path.isfile(filepath): raise FileNotFoundError(filepath)
     except FileNotFoundError: print(f"[P2P 发送错误] 文件未找到: {filepath}"); return False
     except Exception as e: print(f"[P2P 发送错误] 读取文件时出错: {e}"); return False
     transfer_id = str(uuid.uuid4())
     try:
-        total_size = len(data_bytes)
-        total_chunks = (total_size + 4096 - 1) // 4096
-        start_msg = S.StartTransferMsg(
-            transfer_id=transfer_id, file_type=file_type, file_name=file_name,
-            total_size=total_size, total_chunks=total_chunks, chunk_size=4096
-        )
-        p2p_sock.sendall(serialize(start_msg))
         print(f"[P2P 发送] 开始传输 '{file_name}'...")
-        for i in range(total_chunks):
-            start, end = i * 4096, (i + 1) * 4096
-            data_chunk = data_bytes[start:end]
-            encoded_chunk_str = base64.b64encode(data_chunk).decode('ascii')
-            chunk_msg = S.DataChunkMsg(transfer_id=transfer_id, chunk_index=i, data=encoded_chunk_str)
-            p2p_sock.sendall(serialize(chunk_msg))
-        end_msg = S.EndTransferMsg(transfer_id=transfer_id, status='success')
-        p2p_sock.sendall(serialize(end_msg))
+        send_file(p2p_sock, transfer_id, file_type, file_name, filepath, sender_name=current_user,
+                  receiver_name=receiver_name, outgoing=T.outgoing_transfers(current_user),
+                  progress=T.print_send_progress(file_name), connect=stripe_connector(receiver_name))
         print(f"[P2P 发送] 传输 '{file_name}' 完成。")
         return True
     except (BrokenPipeError, ConnectionResetError): print(f"\n[P2P 发送错误] 连接中断，传输 '{file_name}' 失败。"); return False
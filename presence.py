@@ -0,0 +1,92 @@
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Set
+
+# 可选的在线状态审计日志；为 None 时登录/注销不会产生任何磁盘写入
+# 例如: PRESENCE_AUDIT_LOG = os.path.join('data', 'presence_audit.log')
+PRESENCE_AUDIT_LOG: Optional[str] = None
+
+class PresenceTable:
+    """
+    常驻内存的在线状态表：username -> {status, address, last_seen}。
+
+    在线状态和 ip:port 都是临时数据，不再写入 users.json 或好友的通讯录文件，
+    而是在发送通讯录时（见 ContactManager.get_contacts_with_status）实时合并进去。
+    """
+    def __init__(self, audit_log_path: Optional[str] = PRESENCE_AUDIT_LOG):
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._audit_log_path = audit_log_path
+
+    def _audit(self, username: str, status: str, address: str):
+        if not self._audit_log_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self._audit_log_path) or '.', exist_ok=True)
+            with open(self._audit_log_path, 'a', encoding='utf-8') as f:
+                f.write(f"{int(time.time())}\t{username}\t{status}\t{address}\n")
+        except OSError as e:
+            print(f"[在线状态] 写入审计日志失败: {e}")
+
+    def set_online(self, username: str, address: str):
+        with self._lock:
+            self._entries[username] = {
+                "status": "online",
+                "address": address,
+                "last_seen": time.time(),
+            }
+        self._audit(username, "online", address)
+
+    def set_offline(self, username: str):
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None or entry["status"] == "offline":
+                return
+            self._entries[username] = {
+                "status": "offline",
+                "address": "",
+                "last_seen": time.time(),
+            }
+        self._audit(username, "offline", "")
+
+    def touch(self, username: str):
+        """刷新用户的 last_seen（收到该用户的任何消息时调用）。"""
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None:
+                entry["last_seen"] = time.time()
+
+    def get(self, username: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(username)
+            return dict(entry) if entry is not None else None
+
+    def is_online(self, username: str) -> bool:
+        entry = self._entries.get(username)
+        return entry is not None and entry["status"] == "online"
+
+    def address_of(self, username: str) -> str:
+        entry = self._entries.get(username)
+        if entry is None or entry["status"] != "online":
+            return ""
+        return entry["address"]
+
+    def __contains__(self, username: str) -> bool:
+        return self.is_online(username)
+
+    def online_users(self) -> Set[str]:
+        with self._lock:
+            return {name for name, entry in self._entries.items() if entry["status"] == "online"}
+
+_presence_table = None
+_presence_table_lock = threading.Lock()
+
+def get_presence_table() -> PresenceTable:
+    """返回进程内共享的在线状态表。"""
+    global _presence_table
+    if _presence_table is None:
+        with _presence_table_lock:
+            if _presence_table is None:
+                _presence_table = PresenceTable()
+    return _presence_table
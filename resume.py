@@ -0,0 +1,254 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# 续传：接收端把已收到的数据块位图保存在临时文件旁边（见 transfer.ChunkSpool），
+# 重新连接（包括程序重启）后发送 ResumeTransferMsg 列出缺少的块区间，
+# 发送端在自己的登记表中找到原来的文件，只发送这些区间。
+
+# 不超过这个大小的传输不登记续传（与 transfer.STREAM_THRESHOLD 相同，小文件重新发送的代价很小）
+RESUME_MIN_SIZE = 256 * 1024
+# 接收端两次保存位图之间的最短间隔（秒）；保存前先把已写入的数据刷到磁盘
+CHECKPOINT_INTERVAL = 1.0
+# 超过这个时间的未完成传输和发送登记不再续传（秒）
+RESUME_TTL = 7 * 24 * 3600
+# 发送端登记表最多保留的条目数，超出时删除最早的
+MAX_OUTGOING = 256
+
+# 位图文件紧挨着临时文件: .<文件名>.<transfer_id>.part + .json
+PARTIAL_SUFFIX = '.part'
+STATE_SUFFIX = '.part.json'
+
+# 发送端无法续传（登记已过期、文件已被修改）时 EndTransfer 的状态；接收端收到后删除未完成的文件
+STATUS_RESUME_UNAVAILABLE = 'cancelled_resume'
+# 收到这些状态时未完成的文件没有再续传的可能，其余的取消（连接中断、发送端出错）保留位图
+DISCARD_STATUSES = (STATUS_RESUME_UNAVAILABLE, 'cancelled_not_found')
+
+HASH_BLOCK = 1024 * 1024
+
+Range = Tuple[int, int]
+
+# --- 位图与区间 ---
+
+def pack_bitmap(received: Any) -> str:
+    """把每块一个字节的接收标记压缩为每块一位，返回十六进制文本。"""
+    packed = bytearray((len(received) + 7) // 8)
+    for i, flag in enumerate(received):
+        if flag:
+            packed[i >> 3] |= 1 << (i & 7)
+    return packed.hex()
+
+def unpack_bitmap(text: str, total_chunks: int) -> bytearray:
+    packed = bytes.fromhex(text)
+    if len(packed) != (total_chunks + 7) // 8:
+        raise ValueError("位图长度与数据块数不一致")
+    return bytearray((packed[i >> 3] >> (i & 7)) & 1 for i in range(total_chunks))
+
+def missing_ranges(received: Any) -> List[List[int]]:
+    """返回还没有收到的数据块区间 [[start, end), ...]。"""
+    ranges: List[List[int]] = []
+    start = None
+    for i, flag in enumerate(received):
+        if not flag and start is None:
+            start = i
+        elif flag and start is not None:
+            ranges.append([start, i])
+            start = None
+    if start is not None:
+        ranges.append([start, len(received)])
+    return ranges
+
+def normalize_ranges(ranges: Iterable[Any], total_chunks: int) -> List[Range]:
+    """把对端发来的区间截到 [0, total_chunks) 内，排序并合并重叠的区间；格式不对时抛出 ValueError。"""
+    clipped = []
+    for item in ranges:
+        start, end = (int(v) for v in item)
+        start, end = max(0, start), min(total_chunks, end)
+        if start < end:
+            clipped.append((start, end))
+    merged: List[Range] = []
+    for start, end in sorted(clipped):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def file_content_hash(path: str) -> str:
+    """文件内容的 SHA-256（十六进制）。"""
+    digest = hashlib.sha256()
+    buf = bytearray(HASH_BLOCK)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+def _write_json_atomic(path: str, data: Any):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+# --- 发送端登记表 ---
+
+class OutgoingTransfers:
+    """
+    发送端登记的可续传传输: transfer_id -> 文件路径、大小、修改时间、内容哈希、块大小和接收者。
+    保存在 JSON 文件中，程序重启后仍然可以响应对端的 ResumeTransfer。
+    同一个文件（路径、大小和修改时间都没变）再次发送时复用已计算的哈希。
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self._entries = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+    def _save_locked(self):
+        now = time.time()
+        live = [(tid, e) for tid, e in self._entries.items() if now - e.get('created', 0) < RESUME_TTL]
+        live.sort(key=lambda item: item[1].get('created', 0))
+        self._entries = dict(live[-MAX_OUTGOING:])
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        _write_json_atomic(self.path, self._entries)
+
+    def _cached_hash(self, path: str, stat: os.stat_result) -> Optional[str]:
+        for entry in self._entries.values():
+            if (entry['path'] == path and entry['size'] == stat.st_size
+                    and entry['mtime_ns'] == stat.st_mtime_ns):
+                return entry['content_hash']
+        return None
+
+    def register(self, transfer_id: str, file_type: str, file_name: str, path: str,
+                 chunk_size: int, receiver: str) -> str:
+        """登记一次文件传输，返回文件的内容哈希。"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self._lock:
+            content_hash = self._cached_hash(path, stat)
+        if content_hash is None:
+            content_hash = file_content_hash(path)
+        with self._lock:
+            self._entries[transfer_id] = {
+                'path': path,
+                'file_type': file_type,
+                'file_name': file_name,
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'content_hash': content_hash,
+                'chunk_size': chunk_size,
+                'receiver': receiver,
+                'created': time.time(),
+            }
+            self._save_locked()
+        return content_hash
+
+    def lookup(self, transfer_id: str, content_hash: str, receiver: str) -> Optional[Dict[str, Any]]:
+        """
+        返回可以续传的登记；transfer_id 未登记、接收者或哈希不符、已过期，
+        或者文件在登记之后被修改过（大小或修改时间变了）时返回 None。
+        """
+        with self._lock:
+            entry = self._entries.get(transfer_id)
+        if (entry is None or entry['receiver'] != receiver or entry['content_hash'] != content_hash
+                or time.time() - entry['created'] >= RESUME_TTL):
+            return None
+        try:
+            stat = os.stat(entry['path'])
+        except OSError:
+            return None
+        if stat.st_size != entry['size'] or stat.st_mtime_ns != entry['mtime_ns']:
+            return None
+        return dict(entry)
+
+_outgoing: Dict[str, OutgoingTransfers] = {}
+_outgoing_lock = threading.Lock()
+
+def get_outgoing_transfers(path: str) -> OutgoingTransfers:
+    """返回保存在 path 的发送端登记表（每个文件一个实例）。"""
+    with _outgoing_lock:
+        registry = _outgoing.get(path)
+        if registry is None:
+            registry = _outgoing[path] = OutgoingTransfers(path)
+        return registry
+
+# --- 接收端未完成的传输 ---
+
+def canonical_transfer_id(transfer_id: str) -> str:
+    """
+    对端发来的 transfer_id 规范化为标准的 UUID 文本；它会成为临时文件名的一部分，
+    不是合法的 UUID（例如含有 '/' 或 '..'）时抛出 ValueError。
+    """
+    try:
+        return str(uuid.UUID(transfer_id))
+    except (TypeError, ValueError, AttributeError):
+        raise ValueError(f"无效的 transfer_id: {transfer_id!r}") from None
+
+def partial_paths(final_path: str, transfer_id: str) -> Tuple[str, str]:
+    """可续传传输的临时文件和位图文件的路径（与目标文件在同一目录下）；transfer_id 无效时抛出 ValueError。"""
+    directory = os.path.dirname(final_path) or '.'
+    base = os.path.join(directory, f".{os.path.basename(final_path)}.{canonical_transfer_id(transfer_id)}")
+    return base + PARTIAL_SUFFIX, base + STATE_SUFFIX
+
+def load_state(state_path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return state if isinstance(state, dict) else None
+
+def save_state(state_path: str, state: Dict[str, Any]):
+    _write_json_atomic(state_path, state)
+
+def discard_partial(state_path: str):
+    """删除一个未完成的传输（位图文件和临时文件）。"""
+    for path in (state_path[:-len(STATE_SUFFIX)] + PARTIAL_SUFFIX, state_path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+def find_partials(directories: Iterable[str], peer: str) -> List[Dict[str, Any]]:
+    """
+    找出 directories 中来自 peer 的未完成传输，返回它们的位图状态（附带 'state_path'）。
+    过期的和临时文件已经不在的顺便删除。
+    """
+    found = []
+    now = time.time()
+    for directory in directories:
+        for state_path in glob.glob(os.path.join(glob.escape(directory), '.*' + STATE_SUFFIX)):
+            state = load_state(state_path)
+            partial = state_path[:-len(STATE_SUFFIX)] + PARTIAL_SUFFIX
+            if (state is None or not os.path.exists(partial)
+                    or now - state.get('updated', 0) >= RESUME_TTL):
+                discard_partial(state_path)
+                continue
+            if state.get('peer') == peer:
+                state['state_path'] = state_path
+                found.append(state)
+    return found
+
+def find_partial(directories: Iterable[str], transfer_id: str) -> Optional[str]:
+    """按 transfer_id 找到未完成传输的位图文件路径。"""
+    try:
+        transfer_id = canonical_transfer_id(transfer_id)
+    except ValueError:
+        return None
+    for directory in directories:
+        matches = glob.glob(os.path.join(glob.escape(directory), f".*.{glob.escape(transfer_id)}{STATE_SUFFIX}"))
+        if matches:
+            return matches[0]
+    return None
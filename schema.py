@@ -20,6 +20,7 @@ class MsgTag(Enum):
     GetPublicKey = 6
     Alive = 7
     BackUp = 8
+    Subscribe = 9
 
     # --- Peer to Peer ---
     Message = 11
@@ -42,69 +43,90 @@ class MsgTag(Enum):
     StartTransfer = 31
     DataChunk = 32
     EndTransfer = 33
+    ResumeTransfer = 34
+    TransferAck = 35
+    StripeJoin = 36
+
+    # --- Server Push ---
+    PresenceEvent = 41
+    ContactEvent = 42
+
+    # --- Handshake ---
+    Hello = 51
+    HelloAck = 52
 
 # =================================================================
 #               DATACLASSES BASED ON Message.py
 # =================================================================
 
+# 请求与回复消息带有 request_id：客户端为每个请求分配编号，服务器的回复（包括随后的
+# StartTransfer / EndTransfer）沿用同一编号，客户端据此把回复交给等待它的调用者，
+# 同一连接上可以同时进行多个请求。0 表示未使用，此时 JSON 中不包含该字段，与旧版本完全相同。
+
 # --- Client to Server Messages ---
 
-@dataclass
+@dataclass(slots=True)
 class RegisterMsg:
     """C->S 注册请求 (Tag: 1)"""
     username: str
     secret: str
     email: str
     time: int = field(default_factory=get_timestamp)
+    request_id: int = 0
     tag: MsgTag = field(default=MsgTag.Register, init=False)
 
-@dataclass
+@dataclass(slots=True)
 class LoginMsg:
     """C->S 登录请求 (Tag: 2)"""
     username: str
     secret: str
     port: str
     time: int = field(default_factory=get_timestamp)
+    request_id: int = 0
     tag: MsgTag = field(default=MsgTag.Login, init=False)
 
 
-@dataclass
+@dataclass(slots=True)
 class LogoutMsg:
     """C->S 注销请求 (Tag: 3)"""
     username: str
     time: int = field(default_factory=get_timestamp)
+    request_id: int = 0
     tag: MsgTag = field(default=MsgTag.Logout, init=False)
 
-@dataclass
+@dataclass(slots=True)
 class GetDirectoryMsg:
     """C->S 获取通信录请求 (Tag: 4)"""
     username: str
     time: int = field(default_factory=get_timestamp)
+    request_id: int = 0
     tag: MsgTag = field(default=MsgTag.GetDirectory, init=False)
 
-@dataclass
+@dataclass(slots=True)
 class GetHistoryMsg:
     """C->S 获取聊天记录请求 (Tag: 5)"""
     chat_id: Union[str, int]
     time: int = field(default_factory=get_timestamp)
+    request_id: int = 0
     tag: MsgTag = field(default=MsgTag.GetHistory, init=False)
 
-@dataclass
+@dataclass(slots=True)
 class GetPublicKeyMsg:
     """C->S 获取好友公钥请求 (Tag: 6)"""
     request_name: str
     target_name: str
     time: int = field(default_factory=get_timestamp)
+    request_id: int = 0
     tag: MsgTag = field(default=MsgTag.GetPublicKey, init=False)
 
-@dataclass
+@dataclass(slots=True)
 class AliveMsg:
     """C->S 在线心跳包 (Tag: 7)"""
     user_id: Union[str, int]
     time: int = field(default_factory=get_timestamp)
     tag: MsgTag = field(default=MsgTag.Alive, init=False)
 
-@dataclass
+@dataclass(slots=True)
 class BackupMsg:
     """C->S 备份聊天记录请求 (Tag: 8)"""
     user_id: Union[str, int]
@@ -112,12 +134,20 @@ class BackupMsg:
     # 'data' represents the history content, could be a JSON string or bytes
     data: Union[str, bytes] 
     time: int = field(default_factory=get_timestamp)
+    request_id: int = 0
     tag: MsgTag = field(default=MsgTag.BackUp, init=False)
 
+@dataclass(slots=True)
+class SubscribeMsg:
+    """C->S 订阅好友在线状态与通讯录变化的推送 (Tag: 9)"""
+    username: str
+    time: int = field(default_factory=get_timestamp)
+    tag: MsgTag = field(default=MsgTag.Subscribe, init=False)
+
 
 # --- Peer to Peer Messages ---
 
-@dataclass
+@dataclass(slots=True)
 class MessageMsg:
     """P2P 普通消息 (Tag: 11)"""
     message_id: str
@@ -129,7 +159,7 @@ class MessageMsg:
     time: int = field(default_factory=get_timestamp)
     tag: MsgTag = field(default=MsgTag.Message, init=False)
 
-@dataclass
+@dataclass(slots=True)
 class VoiceMsg: # 后面需要加入分包功能
     """P2P 语音消息 (Tag: 12)"""
     voice_id: str
@@ -138,10 +168,11 @@ class VoiceMsg: # 后面需要加入分包功能
     sender_name: str
     receiver_name: str
     data: bytes  # Voice data is binary
+    file_name: str = ''  # 内联发送时接收方保存使用的文件名
     time: int = field(default_factory=get_timestamp)
     tag: MsgTag = field(default=MsgTag.Voice, init=False)
 
-@dataclass
+@dataclass(slots=True)
 class FileMsg:
     """P2P 文件消息 (Tag: 13)"""
     file_id: str
@@ -154,7 +185,7 @@ class FileMsg:
     time: int = field(default_factory=get_timestamp)
     tag: MsgTag = field(default=MsgTag.File, init=False)
     
-@dataclass
+@dataclass(slots=True)
 class ImageMsg:
     """P2P 图片消息 (Tag: 14)"""
     picture_id: str
@@ -163,55 +194,61 @@ class ImageMsg:
     sender_name: str
     receiver_name: str
     data: bytes  # Picture data is binary
+    file_name: str = ''  # 内联发送时接收方保存使用的文件名
     time: int = field(default_factory=get_timestamp)
     tag: MsgTag = field(default=MsgTag.Image, init=False)
 
 
 # --- Server to Client Messages ---
 
-@dataclass
+@dataclass(slots=True)
 class SuccessRegisterMsg:
     """S->C 注册成功 (Tag: 21)"""
     username: str
     user_id: Union[str, int]
     time: int = field(default_factory=get_timestamp)
+    request_id: int = 0
     tag: MsgTag = field(default=MsgTag.SuccessRegister, init=False)
 
-@dataclass
+@dataclass(slots=True)
 class SuccessLoginMsg:
     """S->C 登录成功 (Tag: 22)"""
     username: str
-    transfer_id: str  # 唯一标识本次传输，使用UUID
+    transfer_id: str  # 唯一标识本次传输，使用UUID；为空表示通讯录已内联在 directory 中，不再单独传输
     user_id: Union[str, int]
     directory: str
     time: int = field(default_factory=get_timestamp)
+    request_id: int = 0
     tag: MsgTag = field(default=MsgTag.SuccessLogin, init=False)
 
-@dataclass
+@dataclass(slots=True)
 class SuccessLogoutMsg:
     """S->C 注销成功 (Tag: 23)"""
     username: str
     user_id: Union[str, int]
     time: int = field(default_factory=get_timestamp)
+    request_id: int = 0
     tag: MsgTag = field(default=MsgTag.SuccessLogout, init=False)
 
-@dataclass
+@dataclass(slots=True)
 class SuccessBackUpMsg:
     """S->C 备份成功 (Tag: 24)"""
     user_id: Union[str, int]
     username: str
     time: int = field(default_factory=get_timestamp)
+    request_id: int = 0
     tag: MsgTag = field(default=MsgTag.SuccessBackUp, init=False)
     
-@dataclass
+@dataclass(slots=True)
 class HistoryMsg:
     """S->C 返回聊天记录 (Tag: 25)"""
     # 'data' would typically be a JSON string of a list of messages
     data: str
     time: int = field(default_factory=get_timestamp)
+    request_id: int = 0
     tag: MsgTag = field(default=MsgTag.History, init=False)
 
-@dataclass
+@dataclass(slots=True)
 class DirectoryMsg:
     """S->C 返回通信录 (Tag: 26)"""
     # 'data' would typically be a JSON string of a list of contacts
@@ -219,9 +256,10 @@ class DirectoryMsg:
     data: str
     username: str
     time: int = field(default_factory=get_timestamp)
+    request_id: int = 0
     tag: MsgTag = field(default=MsgTag.Directory, init=False)
 
-@dataclass
+@dataclass(slots=True)
 class PublicKeyMsg:
     """S->C 返回公钥 (Tag: 27)"""
     request_name: str
@@ -229,25 +267,28 @@ class PublicKeyMsg:
     transfer_id: str
     public_key: str # The public key itself
     time: int = field(default_factory=get_timestamp)
+    request_id: int = 0
     tag: MsgTag = field(default=MsgTag.PublicKey, init=False)
 
-@dataclass
+@dataclass(slots=True)
 class FailRegisterMsg:
     """S->C 注册失败 (Tag: 28)"""
     username: str
     error_type: str
     time: int = field(default_factory=get_timestamp)
+    request_id: int = 0
     tag: MsgTag = field(default=MsgTag.FailRegister, init=False)
 
-@dataclass
+@dataclass(slots=True)
 class FailLoginMsg:
     """S->C 登录失败 (Tag: 29)"""
     error_type: str
     username: str
     time: int = field(default_factory=get_timestamp)
+    request_id: int = 0
     tag: MsgTag = field(default=MsgTag.FailLogin, init=False)
 
-@dataclass
+@dataclass(slots=True)
 class StartTransferMsg:
     """
     通用大文件/数据传输开始的信令 (Tag: 31)
@@ -260,20 +301,29 @@ class StartTransferMsg:
     total_chunks: int # 总分块数
     chunk_size: int   # 每个分块的大小
     time: int = field(default_factory=get_timestamp)
+    request_id: int = 0
+    # 文件内容的 SHA-256；非空表示接收端可以保存位图、断开后用 ResumeTransferMsg 续传（为空时不写入 JSON）
+    content_hash: str = ''
+    # 非 0 时接收端每收到这么多字节回复一条 TransferAckMsg（流量控制，为 0 时不写入 JSON）
+    ack_bytes: int = 0
+    # 大于 1 时文件分成这么多段，除本连接外的各段由发送端新建的连接并行发送（见 StripeJoinMsg，为 0 时不写入 JSON）
+    stripes: int = 0
+    # 分条传输的新连接加入时出示的随机口令（为空时不写入 JSON）
+    stripe_token: str = ''
     tag: MsgTag = field(default=MsgTag.StartTransfer, init=False)
 
-@dataclass
+@dataclass(slots=True)
 class DataChunkMsg:
     """
     数据块消息 (Tag: 32)
     """
     transfer_id: str  # 关联到哪次传输
     chunk_index: int  # 当前是第几个块 (从0开始)
-    data: str         # 数据块的二进制内容
+    data: Union[str, bytes]  # 二进制块帧中为原始字节；JSON 中为 base64 字符串（兼容旧版本）
     time: int = field(default_factory=get_timestamp)
     tag: MsgTag = field(default=MsgTag.DataChunk, init=False)
 
-@dataclass
+@dataclass(slots=True)
 class EndTransferMsg:
     """
     数据传输结束的信令 (Tag: 33)
@@ -281,4 +331,102 @@ class EndTransferMsg:
     transfer_id: str
     status: str       # 'success' or 'cancelled'
     time: int = field(default_factory=get_timestamp)
-    tag: MsgTag = field(default=MsgTag.EndTransfer, init=False)
\ No newline at end of file
+    request_id: int = 0
+    tag: MsgTag = field(default=MsgTag.EndTransfer, init=False)
+
+@dataclass(slots=True)
+class ResumeTransferMsg:
+    """
+    续传请求 (Tag: 34)，由接收端发给原来的发送端。
+    发送端核对 transfer_id 与 content_hash 后用同一个 transfer_id 重新发送 StartTransfer、
+    missing 中的数据块和 EndTransfer；无法续传时只回复 status 为 'cancelled_resume' 的 EndTransfer。
+    """
+    transfer_id: str
+    content_hash: str
+    missing: List[List[int]]  # 还缺少的数据块区间 [[start, end), ...]
+    requester: str = ''       # 发出请求的用户名（P2P 会话的第一条消息可以是续传请求）
+    time: int = field(default_factory=get_timestamp)
+    request_id: int = 0
+    tag: MsgTag = field(default=MsgTag.ResumeTransfer, init=False)
+
+@dataclass(slots=True)
+class TransferAckMsg:
+    """
+    传输确认 (Tag: 35)，由接收端发给发送端（StartTransfer 的 ack_bytes 非 0 时）。
+    cumulative 之前的数据块都已收到；sack 是 cumulative 之后已收到的区间 [[start, end), ...]；
+    window 是接收端愿意缓冲的在途字节数。
+    """
+    transfer_id: str
+    cumulative: int
+    sack: List[List[int]]
+    window: int
+    time: int = field(default_factory=get_timestamp)
+    tag: MsgTag = field(default=MsgTag.TransferAck, init=False)
+
+@dataclass(slots=True)
+class StripeJoinMsg:
+    """
+    加入分条传输 (Tag: 36)，发送端为 StartTransfer 中 stripes > 1 的传输新建的连接上的第一条消息。
+    此后该连接上只有第 stripe 段的数据块和一条 EndTransfer，接收端按编号把数据块写入同一个临时文件。
+    """
+    transfer_id: str
+    token: str        # 与 StartTransfer 的 stripe_token 相同
+    stripe: int       # 段号，1 .. stripes - 1（第 0 段由原连接发送）
+    time: int = field(default_factory=get_timestamp)
+    tag: MsgTag = field(default=MsgTag.StripeJoin, init=False)
+
+# --- Server Push Messages ---
+
+@dataclass(slots=True)
+class PresenceEventMsg:
+    """S->C 推送：好友上线/下线 (Tag: 41)"""
+    username: str     # 状态发生变化的好友
+    status: str       # 'online' or 'offline'
+    address: str      # 好友的 P2P 地址 "ip:port"，下线时为空字符串
+    time: int = field(default_factory=get_timestamp)
+    tag: MsgTag = field(default=MsgTag.PresenceEvent, init=False)
+
+@dataclass(slots=True)
+class ContactEventMsg:
+    """S->C 推送：通讯录发生变化 (Tag: 42)"""
+    owner: str        # 通讯录的所有者（即接收推送的用户）
+    contact_name: str # 发生变化的联系人
+    action: str       # 目前只有 'added'
+    status: str       # 该联系人当前的在线状态
+    address: str
+    time: int = field(default_factory=get_timestamp)
+    tag: MsgTag = field(default=MsgTag.ContactEvent, init=False)
+
+# --- Handshake Messages ---
+
+@dataclass(slots=True)
+class HelloMsg:
+    """
+    能力协商 (Tag: 51)
+    TLS 握手后由发起连接的一方发送（C->S 或 P2P），列出本端支持的能力，按优先级排列
+    """
+    version: int             # 协议版本
+    codecs: List[str]        # 支持的消息编码，如 ['binary', 'json']
+    compression: List[str]   # 支持的压缩算法，空列表表示不压缩
+    features: List[str]      # 其他可选特性，如 'binary_chunks'
+    max_frame_size: int      # 本端愿意接收的最大帧（字节）
+    max_chunk_size: int      # 本端愿意接收的最大数据块（字节）
+    time: int = field(default_factory=get_timestamp)
+    max_streams: int = 1     # 本端一次传输最多使用的并行连接数（为 1 时不写入 JSON）
+    tag: MsgTag = field(default=MsgTag.Hello, init=False)
+
+@dataclass(slots=True)
+class HelloAckMsg:
+    """
+    能力协商的结果 (Tag: 52)
+    由接受连接的一方回复，双方此后都按这里选定的参数通信
+    """
+    version: int
+    codec: str               # 双方都支持的最优编码
+    compression: List[str]   # 双方都支持的压缩算法
+    features: List[str]      # 双方都支持的特性
+    max_frame_size: int      # 双方上限中较小的一个
+    chunk_size: int          # 文件传输使用的数据块大小
+    time: int = field(default_factory=get_timestamp)
+    streams: int = 1         # 一次传输最多使用的并行连接数（为 1 时不写入 JSON）
+    tag: MsgTag = field(default=MsgTag.HelloAck, init=False)
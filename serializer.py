@@ -1,15 +1,27 @@
+import base64
 import json
-from dataclasses import asdict, is_dataclass
-from typing import Any
-import inspect # 导入 inspect 模块
+import struct
+import threading
+import uuid
+import weakref
+from contextlib import contextmanager
+from dataclasses import asdict, fields, is_dataclass
+from typing import Any, Callable, Dict, Iterator, Tuple, Union
 import schema as S # 你的协议文件
+import binary_codec
+import compression
+from framing import write_frame
 
 # 这个 Encoder 让 json.dumps 可以正确处理 dataclass 和 Enum
 class CustomEncoder(json.JSONEncoder):
     def default(self, o: Any) -> Any:
-        # 确保 o 是一个 dataclass 实例，而不是 dataclass 类
-        # inspect.isclass(o) 检查 o 是否是一个类
-        if is_dataclass(o) and not inspect.isclass(o):
+        # schema 中的消息类使用导入时生成的编码函数，不再经过 asdict 的递归深拷贝
+        encoder = _ENCODERS.get(type(o))
+        if encoder is not None:
+            return encoder(o)
+
+        # 其他 dataclass 实例（不是 dataclass 类本身）仍然使用 asdict
+        if is_dataclass(o) and not isinstance(o, type):
             return asdict(o)
         
         # 对 Enum 的处理保持不变
@@ -18,22 +30,142 @@ class CustomEncoder(json.JSONEncoder):
             
         return super().default(o)
 
-def serialize(msg_obj: Any) -> bytes:
-    """将 dataclass 对象序列化为[长度前缀 + JSON字节串]"""
-    # 1. 将 dataclass 对象转换为 JSON 字符串
-    json_str = json.dumps(msg_obj, cls=CustomEncoder)
-    
-    # 2. 将 JSON 字符串编码为 UTF-8 字节串
-    json_bytes = json_str.encode('utf-8')
-    
-    # 3. 获取字节串的长度
-    data_length = len(json_bytes)
-    
-    # 4. 将长度打包成一个4字节的大端序整数（长度前缀）
-    length_prefix = data_length.to_bytes(4, 'big')
-    
-    # 5. 返回 [长度前缀] + [数据]
-    return length_prefix + json_bytes
+_json_encoder = CustomEncoder()
+
+def to_dict(msg_obj: Any) -> dict:
+    """把消息对象转换为可直接 json 编码的字典（tag 已转换为整数）。"""
+    encoder = _ENCODERS.get(type(msg_obj))
+    if encoder is not None:
+        return encoder(msg_obj)
+    return asdict(msg_obj)
+
+def encode_payload(msg_obj: Any, codec: str = 'json') -> Union[bytes, bytearray]:
+    """
+    将 dataclass 对象编码为一帧的负载（不含长度前缀）。
+    codec 为 'binary' 时使用 binary_codec 的紧凑编码；字段值与声明的类型不符时退回 JSON。
+    """
+    if codec == 'binary':
+        try:
+            return binary_codec.encode(msg_obj)
+        except (TypeError, AttributeError, KeyError):
+            pass
+
+    # 用预先生成的编码函数转换为字典，再编码为 UTF-8 的 JSON 字节串
+    return _json_encoder.encode(to_dict(msg_obj)).encode('utf-8')
+
+def serialize(msg_obj: Any, codec: str = 'json') -> bytes:
+    """将 dataclass 对象序列化为[4字节大端序长度前缀 + 负载]。"""
+    payload = encode_payload(msg_obj, codec)
+    return len(payload).to_bytes(4, 'big') + payload
+
+# --- 每个连接使用的编码 ---
+
+CODECS = ('json', 'binary')
+_connection_codecs: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+def set_codec(sock: Any, codec: str):
+    """设置此后在 sock 上发送消息时使用的编码 ('json' 或 'binary')。"""
+    if codec not in CODECS:
+        raise ValueError(f"未知的编码: {codec}")
+    _connection_codecs[sock] = codec
+
+def get_codec(sock: Any) -> str:
+    """返回 sock 上发送消息使用的编码，默认为 'json'。"""
+    return _connection_codecs.get(sock, 'json')
+
+def note_peer_codec(sock: Any, payload: Union[bytes, bytearray]):
+    """对端用二进制编码发来消息，说明它支持二进制编码，此后的回复也使用二进制编码。"""
+    if payload and payload[0] == binary_codec.BINARY_FRAME_MARKER and sock not in _connection_codecs:
+        _connection_codecs[sock] = 'binary'
+
+# --- 请求编号 ---
+
+_request_scope = threading.local()
+
+@contextmanager
+def request_scope(sock: Any, request_id: int) -> Iterator[None]:
+    """
+    (服务器) 在处理某个请求期间，当前线程发往 sock 的、带 request_id 字段的消息
+    自动沿用该请求的编号。其他线程（例如推送）或发往其他连接的消息不受影响。
+    """
+    previous = getattr(_request_scope, 'current', None)
+    _request_scope.current = (sock, request_id) if request_id else None
+    try:
+        yield
+    finally:
+        _request_scope.current = previous
+
+def send_msg(sock: Any, msg_obj: Any):
+    """
+    按 sock 的编码序列化并发送一条消息。
+    经过该连接的 FrameWriter：在 framing.batched(sock) 中时与其他帧合并写出，否则立即写出。
+    """
+    scope = getattr(_request_scope, 'current', None)
+    if scope is not None and scope[0] is sock and getattr(msg_obj, 'request_id', None) == 0:
+        msg_obj.request_id = scope[1]
+    write_frame(sock, encode_payload(msg_obj, _connection_codecs.get(sock, 'json')))
+
+# --- 二进制数据块帧 ---
+
+# JSON 负载总是以 '{' 开头；以 CHUNK_FRAME_MARKER 开头的负载是二进制数据块：
+# [1字节标记][16字节 transfer_id (UUID)][4字节块序号][4字节数据长度][原始数据]
+# 文件内容不再经过 base64 + dataclass + json.dumps，线上字节数约为原来的 3/4
+CHUNK_FRAME_MARKER = 0x01
+CHUNK_HEADER = struct.Struct('>B16sII')
+
+def chunk_parts(transfer_id: str, chunk_index: int, data: Union[bytes, memoryview]) -> Tuple[Any, ...]:
+    """
+    一个数据块帧的负载片段 (二进制块头, 原始数据)，数据不会被复制，交给 FrameWriter 合并写出。
+    transfer_id 不是 UUID 时退回 base64 编码的 JSON 消息。
+    """
+    try:
+        id_bytes = uuid.UUID(transfer_id).bytes
+    except (ValueError, AttributeError, TypeError):
+        return (encode_payload(S.DataChunkMsg(transfer_id=transfer_id, chunk_index=chunk_index,
+                                              data=base64.b64encode(data).decode('ascii'))),)
+    return CHUNK_HEADER.pack(CHUNK_FRAME_MARKER, id_bytes, chunk_index, len(data)), data
+
+def serialize_chunk(transfer_id: str, chunk_index: int, data: Union[bytes, memoryview]) -> bytes:
+    """把一个数据块编码为[长度前缀 + 二进制块头 + 原始数据]。"""
+    payload = b''.join(chunk_parts(transfer_id, chunk_index, data))
+    return len(payload).to_bytes(4, 'big') + payload
+
+# 压缩的数据块：[1字节标记][16字节 transfer_id][4字节块序号][4字节原始长度][1字节算法编号][压缩数据]
+# 只在能力协商出共同的压缩算法后发送；接收端在 decode_frame 中解压，处理函数拿到的仍是原始字节
+COMPRESSED_CHUNK_FRAME_MARKER = 0x03
+COMPRESSED_CHUNK_HEADER = struct.Struct('>B16sIIB')
+# 本端愿意接收的最大数据块（capabilities 协商的块大小不会超过它）。
+# 压缩块头中的原始长度来自对端，超过它的帧在解压之前就拒绝，几十 KB 的压缩数据不能让接收端分配数 GB 内存
+MAX_CHUNK_SIZE = 64 * 1024
+
+def compressed_chunk_parts(transfer_id: str, chunk_index: int, raw: Union[bytes, memoryview],
+                           packed: bytes, algorithm_id: int) -> Tuple[Any, ...]:
+    """压缩过的数据块帧的负载片段；transfer_id 不是 UUID 时按 chunk_parts 发送原始数据。"""
+    try:
+        id_bytes = uuid.UUID(transfer_id).bytes
+    except (ValueError, AttributeError, TypeError):
+        return chunk_parts(transfer_id, chunk_index, raw)
+    header = COMPRESSED_CHUNK_HEADER.pack(COMPRESSED_CHUNK_FRAME_MARKER, id_bytes, chunk_index,
+                                          len(raw), algorithm_id)
+    return header, packed
+
+def decode_frame(payload: Union[bytes, bytearray]) -> Any:
+    """把一帧的负载（不含长度前缀）解码为消息对象：二进制数据块（可能经过压缩）、二进制消息或 JSON 消息。"""
+    if payload and payload[0] == binary_codec.BINARY_FRAME_MARKER:
+        return binary_codec.decode(payload)
+    if payload and payload[0] == CHUNK_FRAME_MARKER:
+        _, id_bytes, chunk_index, length = CHUNK_HEADER.unpack_from(payload)
+        data = bytes(memoryview(payload)[CHUNK_HEADER.size:CHUNK_HEADER.size + length])
+        if len(data) != length:
+            raise ValueError("数据块长度与块头不一致")
+        return S.DataChunkMsg(transfer_id=str(uuid.UUID(bytes=id_bytes)), chunk_index=chunk_index, data=data)
+    if payload and payload[0] == COMPRESSED_CHUNK_FRAME_MARKER:
+        _, id_bytes, chunk_index, raw_length, algorithm_id = COMPRESSED_CHUNK_HEADER.unpack_from(payload)
+        if raw_length > MAX_CHUNK_SIZE:
+            raise ValueError(f"压缩数据块的原始长度 {raw_length} 超过上限 {MAX_CHUNK_SIZE} 字节")
+        data = compression.decompress(algorithm_id, memoryview(payload)[COMPRESSED_CHUNK_HEADER.size:], raw_length)
+        return S.DataChunkMsg(transfer_id=str(uuid.UUID(bytes=id_bytes)), chunk_index=chunk_index, data=data)
+    return deserialize(json.loads(payload.decode("UTF-8")))
 
 # --- 反序列化 ---
 
@@ -47,6 +179,7 @@ MESSAGE_CLASSES = {
     S.MsgTag.GetPublicKey: S.GetPublicKeyMsg,
     S.MsgTag.Alive: S.AliveMsg,
     S.MsgTag.BackUp: S.BackupMsg,
+    S.MsgTag.Subscribe: S.SubscribeMsg,
 
     S.MsgTag.Message: S.MessageMsg,
     S.MsgTag.Voice: S.VoiceMsg,
@@ -67,6 +200,54 @@ MESSAGE_CLASSES = {
     S.MsgTag.StartTransfer: S.StartTransferMsg,
     S.MsgTag.DataChunk: S.DataChunkMsg,
     S.MsgTag.EndTransfer: S.EndTransferMsg,
+    S.MsgTag.ResumeTransfer: S.ResumeTransferMsg,
+    S.MsgTag.TransferAck: S.TransferAckMsg,
+    S.MsgTag.StripeJoin: S.StripeJoinMsg,
+
+    S.MsgTag.PresenceEvent: S.PresenceEventMsg,
+    S.MsgTag.ContactEvent: S.ContactEventMsg,
+
+    S.MsgTag.Hello: S.HelloMsg,
+    S.MsgTag.HelloAck: S.HelloAckMsg,
+}
+
+# --- 预生成的编码函数 ---
+
+# 后来加入的字段：取默认值时不写入 JSON，不使用这些功能的连接上的消息与旧版本逐字节相同
+# （旧版本反序列化时不接受未知字段）
+OMITTED_DEFAULTS = {'request_id': 0, 'content_hash': '', 'ack_bytes': 0, 'stripes': 0, 'stripe_token': '',
+                    'max_streams': 1, 'streams': 1, 'file_name': ''}
+
+def _compile_encoder(msg_class: type) -> Callable[[Any], dict]:
+    """
+    为一个消息类生成直接读取各字段的编码函数，例如 LoginMsg 生成：
+        def encode_LoginMsg(o): return {'username': o.username, ..., 'tag': o.tag.value}
+    字段顺序与 asdict 相同，因此 JSON 输出与原来完全一致。
+    OMITTED_DEFAULTS 中的字段（request_id、content_hash、ack_bytes 等）取默认值时不写入 JSON；
+    只对该类中默认值相同的字段生效（FileMsg / StartTransfer 的 file_name 是必填字段，总是写入）。
+    """
+    def omitted(f) -> bool:
+        return f.name in OMITTED_DEFAULTS and f.default == OMITTED_DEFAULTS[f.name]
+    msg_fields = [f for f in fields(msg_class) if not omitted(f)]
+    optional = [f.name for f in fields(msg_class) if omitted(f)]
+    items = ", ".join(f"{f.name!r}: o.{f.name}.value" if f.name == 'tag' else f"{f.name!r}: o.{f.name}"
+                      for f in msg_fields)
+    name = f"encode_{msg_class.__name__}"
+    if not optional:
+        source = f"def {name}(o):\n    return {{{items}}}\n"
+    else:
+        source = f"def {name}(o):\n    d = {{{items}}}\n"
+        for field_name in optional:
+            source += (f"    if o.{field_name} != {OMITTED_DEFAULTS[field_name]!r}:\n"
+                       f"        d[{field_name!r}] = o.{field_name}\n")
+        source += "    return d\n"
+    namespace: dict = {}
+    exec(source, namespace)
+    return namespace[name]
+
+# 消息类 -> 编码函数，导入时生成一次
+_ENCODERS: Dict[type, Callable[[Any], dict]] = {
+    msg_class: _compile_encoder(msg_class) for msg_class in MESSAGE_CLASSES.values()
 }
 
 def deserialize(msg_dict: dict) -> Any:
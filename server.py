@@ -8,6 +8,10 @@ import ssl
 import uuid
 import Transaction_Server as T
 from serializer import serialize, deserialize
+from sessions import ClientSession
+from dispatch import dispatch, RequestContext
+from flow import set_ack_reader, take_deferred, timed_reader
+from framing import set_frame_role
 
 ip_port = ("", 47474)
 # ip_port = ("10.122.192.1", 47474)
@@ -17,41 +21,13 @@ def msg_process(ssl_connect_sock):
         user_ip, user_port = ssl_connect_sock.getpeername()
         print("user_ip", user_ip)
         print("user_port", user_port)
-        received_msg = T.recv_msg(ssl_connect_sock)
+        # 上一次传输等待确认时读到的其他请求先处理
+        received_msg = take_deferred(ssl_connect_sock) or T.recv_msg(ssl_connect_sock)
         if received_msg is None:
             print("客户端已断开连接。")
             return None
 
-        if received_msg.tag.name == "Login":
-            T.handle_login(received_msg, user_ip, user_port, ssl_connect_sock)        
-        
-        elif received_msg.tag.name == "Register":
-            reply_msg = T.handle_register(received_msg, ssl_connect_sock)           
-            ssl_connect_sock.sendall(serialize(reply_msg))
-
-        elif received_msg.tag.name == "Logout":
-            reply_msg = T.handle_logout(received_msg)   
-            ssl_connect_sock.sendall(serialize(reply_msg))
-
-        elif received_msg.tag.name == "GetDirectory":
-            T.handle_send_directory(received_msg, ssl_connect_sock)
-
-        # elif received_msg.tag.name == "GetHistory":
-        #     reply_msg = T.handle_get_history(received_msg)
-        #     ssl_connect_sock.sendall(serialize(reply_msg))
-
-        elif received_msg.tag.name == "GetPublicKey":
-            T.handle_get_public_key(received_msg, ssl_connect_sock)
-
-        # elif received_msg.tag.name == "Alive":
-        #     reply_msg = T.handle_alive(received_msg)
-        #     ssl_connect_sock.sendall(serialize(reply_msg))
-
-        # elif received_msg.tag.name == "BackUp":
-        #     reply_msg = T.handle_backup(received_msg)
-        #     ssl_connect_sock.sendall(serialize(reply_msg))
-
-        return True
+        return dispatch(received_msg, RequestContext(ssl_connect_sock, user_ip, user_port))
 
     except ConnectionResetError:
         print("客户端连接被重置。")
@@ -60,31 +36,50 @@ def msg_process(ssl_connect_sock):
         print(f"发生错误: {e}")
         return None                 
 
-try:
-    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-    context.minimum_version = ssl.TLSVersion.TLSv1_2
-    context.maximum_version = ssl.TLSVersion.TLSv1_2
-
-    context.load_cert_chain(certfile="server.crt", keyfile="server_rsa_private.pem.unsecure")
-    context.load_verify_locations("ca.crt")
-    context.verify_mode = ssl.CERT_REQUIRED
-
-    with skt.socket(skt.AF_INET, skt.SOCK_STREAM) as sk:
-        sk.bind(ip_port)
-        sk.listen(5)
-        print('服务器已启动，等待客户端连接...')
-
-        connect_sock, address = sk.accept()
-        print(f"接受来自 {address} 的连接") # 得到了客户端socket的ip和port
-
-        with context.wrap_socket(connect_sock, server_side=True) as ssl_connect_sock:
-            while True:
-                if msg_process(ssl_connect_sock) is None:
-                    break
+def open_session(ssl_connect_sock) -> ClientSession:
+    """
+    包装刚完成握手的连接：按服务器角色限制接收的帧长度（与 MTserver 相同），
+    处理请求时没有其他线程读取这个连接，传输等待确认时由处理线程自己读取。
+    """
+    session = ClientSession(ssl_connect_sock)
+    set_frame_role(session, 'server')
+    set_ack_reader(session, timed_reader(T.recv_msg))
+    return session
+
+def main():
+    """单连接服务器：接受一个客户端，处理它的请求直到断开。"""
+    try:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        context.maximum_version = ssl.TLSVersion.TLSv1_2
+
+        context.load_cert_chain(certfile="server.crt", keyfile="server_rsa_private.pem.unsecure")
+        context.load_verify_locations("ca.crt")
+        context.verify_mode = ssl.CERT_REQUIRED
+
+        with skt.socket(skt.AF_INET, skt.SOCK_STREAM) as sk:
+            sk.bind(ip_port)
+            sk.listen(5)
+            print('服务器已启动，等待客户端连接...')
+
+            connect_sock, address = sk.accept()
+            print(f"接受来自 {address} 的连接") # 得到了客户端socket的ip和port
+
+            with context.wrap_socket(connect_sock, server_side=True) as ssl_connect_sock:
+                session = open_session(ssl_connect_sock)
+                try:
+                    while True:
+                        if msg_process(session) is None:
+                            break
+                finally:
+                    T.handle_disconnect(session)
+
+    except FileNotFoundError:
+        print("\n错误: 找不到证书文件 'server.crt' 或 'server.key'。")
+    except Exception as e:
+        print(f"服务器启动失败: {e}")
 
-except FileNotFoundError:
-    print("\n错误: 找不到证书文件 'server.crt' 或 'server.key'。")
-except Exception as e:
-    print(f"服务器启动失败: {e}")
+    print("服务器已关闭。")
 
-print("服务器已关闭。")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
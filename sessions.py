@@ -0,0 +1,153 @@
+import queue
+import socket as skt
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from timing_wheel import TimingWheel
+
+# 超过这么多秒没有收到某个已登录用户的任何消息（包括 AliveMsg），就判定其会话过期
+HEARTBEAT_TIMEOUT = 90
+# 每个会话积压的推送条数上限；超过时说明对端长时间不读取，丢弃推送并关闭该连接
+PUSH_QUEUE_SIZE = 256
+
+class ClientSession:
+    """
+    服务器端的一个客户端连接。
+
+    包装底层的 SSL socket（或 asyncio 模式下的适配器），记录该连接上登录的用户，
+    并用一把发送锁保证处理线程的回复与其他线程的推送不会在同一连接上交错写入。
+    推送经 push() 放入该会话自己的有界队列，由按需启动的推送线程发送，
+    一个卡住的连接不会阻塞为其他用户处理登录 / 注销的线程。
+    其余属性（recv / getpeercert / getpeername ...）直接转发给底层 socket。
+    """
+    def __init__(self, sock: Any):
+        self._sock = sock
+        self._send_lock = threading.Lock()
+        self.username: Optional[str] = None
+        self.subscribed = False
+        self._pushes: "queue.Queue[Any]" = queue.Queue(PUSH_QUEUE_SIZE)
+        self._pusher_lock = threading.Lock()
+        self._pusher_running = False
+
+    def sendall(self, data: bytes):
+        with self._send_lock:
+            self._sock.sendall(data)
+
+    def push(self, msg: Any, send: Callable[[Any, Any], None]) -> bool:
+        """
+        把一条推送交给该会话的推送线程用 send(session, msg) 发送，不等待发送完成。
+        积压超过 PUSH_QUEUE_SIZE 条时丢弃推送并关闭连接（客户端重连后会重新拉取通讯录），返回 False。
+        """
+        try:
+            self._pushes.put_nowait((msg, send))
+        except queue.Full:
+            self.close_connection()
+            return False
+        with self._pusher_lock:
+            if not self._pusher_running:
+                self._pusher_running = True
+                threading.Thread(target=self._drain_pushes, name="session-push", daemon=True).start()
+        return True
+
+    def _drain_pushes(self):
+        """推送线程：队列发完后退出，下一次 push() 时再启动。"""
+        while True:
+            with self._pusher_lock:
+                try:
+                    msg, send = self._pushes.get_nowait()
+                except queue.Empty:
+                    self._pusher_running = False
+                    return
+            try:
+                send(self, msg)
+            except Exception as e:
+                print(f"[推送] 向 '{self.username}' 推送 {msg.tag.name} 失败: {e}")
+
+    def close_connection(self):
+        """从其他线程关闭连接，使阻塞在 recv 上的处理线程/协程退出。"""
+        try:
+            self._sock.shutdown(skt.SHUT_RDWR)
+        except (OSError, AttributeError):
+            pass
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._sock, name)
+
+class SessionRegistry:
+    """username -> 当前登录的 ClientSession。"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, ClientSession] = {}
+
+    def register(self, username: str, session: ClientSession):
+        """登记登录会话；同一用户再次登录时替换旧会话。"""
+        with self._lock:
+            self._sessions[username] = session
+
+    def unregister(self, username: str, session: ClientSession) -> bool:
+        """注销会话。只有 session 仍是该用户的当前会话时才会移除并返回 True。"""
+        with self._lock:
+            if self._sessions.get(username) is session:
+                del self._sessions[username]
+                return True
+            return False
+
+    def get(self, username: str) -> Optional[ClientSession]:
+        return self._sessions.get(username)
+
+    def usernames(self) -> List[str]:
+        with self._lock:
+            return list(self._sessions)
+
+class SessionMonitor:
+    """
+    用时间轮跟踪每个已登录用户的心跳截止时间。
+
+    收到该用户的任何消息都会调用 touch() 续期（心跳搭载在普通流量上），
+    空闲的客户端只需偶尔发送 AliveMsg。续期只是一次字典更新，
+    后台线程每个 tick 推进一次时间轮，对过期的用户调用 on_expire(username)。
+    """
+    def __init__(self, on_expire: Callable[[str], None], timeout: float = HEARTBEAT_TIMEOUT,
+                 tick: float = 1.0):
+        self.timeout = timeout
+        self.tick = tick
+        self._on_expire = on_expire
+        self._lock = threading.Lock()
+        self._wheel = TimingWheel(tick=tick, start=time.monotonic())
+        self._thread = threading.Thread(target=self._run, name="session-monitor", daemon=True)
+        self._thread.start()
+
+    def touch(self, username: str):
+        with self._lock:
+            self._wheel.schedule(username, time.monotonic() + self.timeout)
+
+    def remove(self, username: str):
+        with self._lock:
+            self._wheel.cancel(username)
+
+    def __len__(self) -> int:
+        return len(self._wheel)
+
+    def _run(self):
+        while True:
+            time.sleep(self.tick)
+            with self._lock:
+                expired = self._wheel.advance(time.monotonic())
+            for username in expired:
+                try:
+                    self._on_expire(username)
+                except Exception as e:
+                    print(f"[心跳] 处理用户 '{username}' 的会话过期时出错: {e}")
+
+_session_registry = None
+_session_registry_lock = threading.Lock()
+
+def get_session_registry() -> SessionRegistry:
+    """返回进程内共享的会话表。"""
+    global _session_registry
+    if _session_registry is None:
+        with _session_registry_lock:
+            if _session_registry is None:
+                _session_registry = SessionRegistry()
+    return _session_registry
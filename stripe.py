@@ -0,0 +1,148 @@
+import hmac
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+import schema as S
+from flow import AckSender
+from transfer import ChunkSpool, chunk_data, stripe_ranges
+
+# 分条传输的接收端（发送端见 transfer._send_striped）：原连接收到 stripes > 1 的 StartTransfer 后
+# 登记这次传输，发送端新建的连接以 StripeJoinMsg 开头、出示 stripe_token 加入，
+# 各连接上的数据块由各自的线程按编号写入同一个 ChunkSpool。
+
+# 新连接等待原连接登记传输、原连接收到 EndTransfer 后等待其余各段收完的时间（秒）
+STRIPE_TIMEOUT = 30.0
+
+class StripedReception:
+    """接收端一次分条传输的状态：各段由哪条连接加入、是否已经完整收到。"""
+    def __init__(self, start_msg: S.StartTransferMsg, spool: ChunkSpool):
+        self.start_msg = start_msg
+        self.transfer_id = start_msg.transfer_id
+        self.stripes = start_msg.stripes
+        self.spool = spool
+        self.ranges = stripe_ranges(start_msg.total_chunks, start_msg.stripes)
+        self._cond = threading.Condition()
+        self._joined: set = set()
+        self._finished: Dict[int, bool] = {}
+        self._writers = 0
+        self._closed = False
+
+    def admit(self, msg: S.StripeJoinMsg) -> bool:
+        """口令正确、段号有效且该段还没有连接加入时接受新连接。"""
+        if not hmac.compare_digest(msg.token, self.start_msg.stripe_token):
+            return False
+        with self._cond:
+            if self._closed or not 0 < msg.stripe < self.stripes or msg.stripe in self._joined:
+                return False
+            self._joined.add(msg.stripe)
+            return True
+
+    def _begin_write(self) -> bool:
+        with self._cond:
+            if self._closed:
+                return False
+            self._writers += 1
+            return True
+
+    def _end_write(self):
+        with self._cond:
+            self._writers -= 1
+            if not self._writers:
+                self._cond.notify_all()
+
+    def receive(self, sock: Any, stripe: int, recv: Callable[[Any], Any],
+                send: Callable[[Any, Any], None]) -> bool:
+        """在加入的连接上接收第 stripe 段，直到该连接上的 EndTransfer；返回该段是否完整收到。"""
+        start, end = self.ranges[stripe]
+        acks = AckSender(sock, self.start_msg, self.spool, send, (start, end))
+        complete = False
+        try:
+            while True:
+                msg = recv(sock)
+                if msg is None:
+                    break
+                if isinstance(msg, S.EndTransferMsg) and msg.transfer_id == self.transfer_id:
+                    complete = msg.status == 'success' and self.spool.range_complete(start, end)
+                    break
+                if not isinstance(msg, S.DataChunkMsg) or msg.transfer_id != self.transfer_id:
+                    continue
+                if not start <= msg.chunk_index < end:
+                    raise ValueError(f"数据块 {msg.chunk_index} 不属于第 {stripe} 段 [{start}, {end})")
+                data = chunk_data(msg)
+                # 传输已经结束时临时文件可能已经关闭，不能再写入
+                if not self._begin_write():
+                    break
+                try:
+                    self.spool.write_chunk(msg.chunk_index, data)
+                finally:
+                    self._end_write()
+                acks.on_chunk(len(data))
+        except (OSError, ValueError) as e:
+            print(f"\n[分条传输] 接收 '{self.start_msg.file_name}' 第 {stripe} 段失败: {e}")
+        finally:
+            with self._cond:
+                self._finished[stripe] = complete
+                self._cond.notify_all()
+        return complete
+
+    def wait(self, timeout: float = STRIPE_TIMEOUT) -> bool:
+        """(原连接收到 EndTransfer 后) 等待其余各段结束；全部完整收到时返回 True。"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while len(self._finished) < self.stripes - 1:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return all(self._finished.values())
+
+    def close(self):
+        """传输结束（或失败）：等正在进行的写入完成，之后各段的数据块不再写入临时文件。"""
+        with self._cond:
+            self._closed = True
+            while self._writers:
+                self._cond.wait()
+
+_receptions: Dict[str, StripedReception] = {}
+_registry = threading.Condition()
+
+def expect_stripes(start_msg: S.StartTransferMsg, spool: ChunkSpool) -> Optional[StripedReception]:
+    """(原连接) StartTransfer 的 stripes > 1 时登记这次传输，返回它的状态；否则返回 None。"""
+    if start_msg.stripes <= 1 or not start_msg.stripe_token:
+        return None
+    reception = StripedReception(start_msg, spool)
+    with _registry:
+        _receptions[reception.transfer_id] = reception
+        _registry.notify_all()
+    return reception
+
+def forget(reception: Optional[StripedReception]):
+    """传输结束：注销登记，之后到达的新连接和数据块都被拒绝。临时文件改名或删除之前调用。"""
+    if reception is None:
+        return
+    reception.close()
+    with _registry:
+        if _receptions.get(reception.transfer_id) is reception:
+            del _receptions[reception.transfer_id]
+
+def serve_stripe(sock: Any, msg: S.StripeJoinMsg, recv: Callable[[Any], Any],
+                 send: Callable[[Any, Any], None]) -> bool:
+    """
+    (接收端) 新连接的第一条消息是 StripeJoin：找到对应的传输后在调用者线程中接收这一段，
+    结束后关闭连接。传输不存在或口令不对时直接关闭连接，返回 False。
+    """
+    deadline = time.monotonic() + STRIPE_TIMEOUT
+    with _registry:
+        # 新连接可能比原连接上的 StartTransfer 先被处理
+        reception = _receptions.get(msg.transfer_id)
+        while reception is None and time.monotonic() < deadline:
+            _registry.wait(deadline - time.monotonic())
+            reception = _receptions.get(msg.transfer_id)
+    try:
+        if reception is None or not reception.admit(msg):
+            print(f"\n[分条传输] 拒绝了传输 {msg.transfer_id} 的第 {msg.stripe} 段连接。")
+            return False
+        return reception.receive(sock, msg.stripe, recv, send)
+    finally:
+        sock.close()
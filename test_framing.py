@@ -0,0 +1,148 @@
+"""
+帧大小上限与内存测试：对端发来伪造的长度前缀时，FrameReader 在分配缓冲区之前拒绝超长的帧，
+声称很长却不发送数据的帧也不会让单个连接的内存峰值随声称的长度增长。
+
+运行: python -m pytest -q -s test_framing.py
+"""
+
+import socket
+import struct
+import threading
+import tracemalloc
+
+import pytest
+
+import framing
+import server
+from framing import FrameReader, FrameTooLargeError, FRAME_HEADER
+
+CONNECTIONS = 20
+# 每个连接的内存峰值上限：复用的接收缓冲区 + 一次性预分配的大小 + 一些余量
+PER_CONNECTION_BOUND = framing.READ_BUFFER_SIZE + framing.FRAME_PREALLOCATE_SIZE + 256 * 1024
+
+def send_and_close(sock, data: bytes):
+    """在后台线程中发送 data 后关闭写端（数据可能超过 socket 缓冲区）。"""
+    def run():
+        try:
+            sock.sendall(data)
+        except OSError:
+            pass
+        finally:
+            sock.close()
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+def read_one(role: str, data: bytes):
+    """用 role 对应的上限读取 data 中的第一帧，返回 (结果或异常, 内存峰值)。"""
+    receiver, sender = socket.socketpair()
+    thread = send_and_close(sender, data)
+    tracemalloc.start()
+    try:
+        reader = FrameReader(receiver, role=role)
+        try:
+            result = reader.read_frame()
+        except ConnectionError as e:
+            result = e
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        receiver.close()
+        thread.join()
+    return result, peak
+
+def test_normal_frames_still_read():
+    payload = b'{"tag": 1}' * 1000
+    result, _ = read_one('server', FRAME_HEADER.pack(len(payload)) + payload)
+    assert result == payload
+
+def test_oversized_header_rejected_before_buffering():
+    """服务器连接上声称 4GB 的帧：只读到长度前缀就拒绝，不分配负载缓冲区。"""
+    result, peak = read_one('server', FRAME_HEADER.pack(0xFFFFFFFF) + b'{' * 1024)
+    assert isinstance(result, FrameTooLargeError)
+    assert result.limit == framing.FRAME_SIZE_LIMITS['server']
+    assert peak < 2 * framing.READ_BUFFER_SIZE
+
+def test_limit_by_frame_kind():
+    """客户端连接允许较大的消息帧，但数据块帧 (0x01) 不能超过最大块加块头。"""
+    length = 1024 * 1024
+    result, _ = read_one('client', FRAME_HEADER.pack(length) + b'\x01' + bytes(1024))
+    assert isinstance(result, FrameTooLargeError)
+    assert result.kind == 0x01
+
+    payload = b'{' + bytes(length - 1)
+    result, _ = read_one('client', FRAME_HEADER.pack(length) + payload)
+    assert result == payload
+
+@pytest.mark.parametrize("claimed", [framing.FRAME_SIZE_LIMITS['client'], 8 * 1024 * 1024])
+def test_peak_memory_bounded_for_lying_headers(claimed):
+    """声称接近上限的长度却只发送少量数据后断开：内存峰值与声称的长度无关。"""
+    result, peak = read_one('client', FRAME_HEADER.pack(claimed) + b'{' + bytes(16 * 1024))
+    assert isinstance(result, ConnectionError)
+    assert peak < PER_CONNECTION_BOUND < claimed
+
+def test_many_adversarial_connections_bounded():
+    """
+    多个连接同时只发送长度前缀和一小部分负载并保持连接：
+    总的内存峰值按每个连接的固定上限增长，而不是按它们声称的长度 (CONNECTIONS x 16MB)。
+    """
+    claimed = framing.FRAME_SIZE_LIMITS['client']
+    pairs = [socket.socketpair() for _ in range(CONNECTIONS)]
+    errors = []
+    tracemalloc.start()
+    try:
+        readers = []
+        for receiver, sender in pairs:
+            sender.sendall(FRAME_HEADER.pack(claimed) + b'{' + bytes(4096))
+
+            def read(receiver=receiver):
+                try:
+                    FrameReader(receiver, role='client').read_frame()
+                except ConnectionError as e:
+                    errors.append(e)
+            thread = threading.Thread(target=read)
+            thread.start()
+            readers.append(thread)
+        # 对端最终断开，所有读取都应以 ConnectionError 结束
+        for _, sender in pairs:
+            sender.close()
+        for thread in readers:
+            thread.join(10)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        for receiver, _ in pairs:
+            receiver.close()
+    assert len(errors) == CONNECTIONS
+    assert peak < CONNECTIONS * PER_CONNECTION_BOUND
+    assert peak < CONNECTIONS * claimed / 8
+
+def test_large_frame_grows_with_received_data():
+    """超过预分配大小的合法大帧仍能完整读取。"""
+    payload = b'{' + bytes(range(256)) * (12 * 1024)
+    result, _ = read_one('client', FRAME_HEADER.pack(len(payload)) + payload)
+    assert result == payload
+
+def test_set_frame_role():
+    receiver, sender = socket.socketpair()
+    try:
+        framing.set_frame_role(receiver, 'server')
+        sender.sendall(struct.pack('>I', framing.FRAME_SIZE_LIMITS['server'] + 1))
+        with pytest.raises(FrameTooLargeError):
+            framing.read_frame(receiver)
+    finally:
+        receiver.close()
+        sender.close()
+
+def test_single_connection_server_uses_server_limit():
+    """server.py 的单连接入口与 MTserver 一样按服务器角色限制帧长度 (64 KiB)。"""
+    receiver, sender = socket.socketpair()
+    try:
+        session = server.open_session(receiver)
+        assert framing.get_frame_reader(session).max_frame_size == framing.FRAME_SIZE_LIMITS['server'] == 64 * 1024
+        sender.sendall(struct.pack('>I', 64 * 1024 + 1))
+        with pytest.raises(FrameTooLargeError):
+            framing.read_frame(session)
+    finally:
+        receiver.close()
+        sender.close()
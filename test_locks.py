@@ -0,0 +1,134 @@
+"""
+条带锁压力测试：并发读取-修改-写回同一用户的通讯录不丢失更新，
+不同用户的操作可以并行，吞吐量随并发客户端数增长。
+
+运行: python -m pytest -q -s test_locks.py
+"""
+
+import os
+import threading
+import time
+
+import pytest
+
+import contact_index
+import locks
+import Contacts as C
+
+THREADS = 8
+UPDATES_PER_THREAD = 25
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """在临时目录中运行，避免改动仓库里的 data/ 目录。"""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.join('data', 'directory'))
+    monkeypatch.setattr(contact_index, '_contact_index', contact_index.ReverseContactIndex(
+        path=os.path.join('data', 'contact_index.jsonl'),
+        directory_path=os.path.join('data', 'directory')))
+    monkeypatch.setattr(locks, '_lock_manager', locks.StripedLockManager())
+    return tmp_path
+
+def run_threads(count, target):
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(count)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+def test_concurrent_updates_are_not_lost(data_dir):
+    """多个线程各自创建 ContactManager 并修改同一用户的通讯录，所有修改都应保留。"""
+    def worker(i):
+        for j in range(UPDATES_PER_THREAD):
+            manager = C.ContactManager('alice')
+            manager.update_or_add_contact(f'friend-{i}-{j}', '', 'hi')
+            manager.add_message(f'friend-{i}', 'user', f'msg {j}')
+
+    run_threads(THREADS, worker)
+
+    manager = C.ContactManager('alice')
+    assert len(manager.contacts) == THREADS * UPDATES_PER_THREAD
+    assert sorted(c['id'] for c in manager.contacts) == list(range(1, THREADS * UPDATES_PER_THREAD + 1))
+    for i in range(THREADS):
+        assert len(manager.messages[f'friend-{i}']) == UPDATES_PER_THREAD
+    assert contact_index.get_contact_index().followers('friend-0-0') == ['alice']
+
+def test_different_users_do_not_block_each_other():
+    manager = locks.StripedLockManager(stripes=64)
+    # 找两个落在不同条带上的用户
+    other = next(f'user-{i}' for i in range(1000)
+                 if manager.lock_for(f'user-{i}') is not manager.lock_for('alice'))
+    holding = threading.Event()
+    release = threading.Event()
+
+    def hold_alice():
+        with manager.locked('alice'):
+            holding.set()
+            release.wait(5)
+
+    t = threading.Thread(target=hold_alice)
+    t.start()
+    try:
+        assert holding.wait(5)
+        assert manager.lock_for(other).acquire(timeout=1)
+        manager.lock_for(other).release()
+        assert not manager.lock_for('alice').acquire(timeout=0.1)
+    finally:
+        release.set()
+        t.join()
+
+def test_locking_multiple_users_does_not_deadlock():
+    manager = locks.StripedLockManager(stripes=8)
+    users = [f'user-{i}' for i in range(16)]
+
+    def worker(i):
+        for j in range(200):
+            a, b = users[(i + j) % 16], users[(i * 7 + j) % 16]
+            with manager.locked(a, b) if i % 2 else manager.locked(b, a):
+                pass
+
+    elapsed = run_threads(THREADS, worker)
+    assert elapsed < 10
+
+def measure_throughput(manager, clients, ops_per_client, hold_time):
+    """每个客户端操作自己的用户，临界区内等待 hold_time 秒模拟磁盘写入。"""
+    def worker(i):
+        for _ in range(ops_per_client):
+            with manager.locked(f'user-{i}'):
+                time.sleep(hold_time)
+
+    elapsed = run_threads(clients, worker)
+    return clients * ops_per_client / elapsed
+
+def test_throughput_scales_with_clients():
+    ops, hold = 20, 0.002
+    results = {}
+    for clients in (1, 2, 4, THREADS):
+        results[clients] = (
+            measure_throughput(locks.StripedLockManager(stripes=1), clients, ops, hold),
+            measure_throughput(locks.StripedLockManager(), clients, ops, hold),
+        )
+        print(f"\n[条带锁] {clients} 个客户端: 全局锁 {results[clients][0]:.0f} ops/s, "
+              f"条带锁 {results[clients][1]:.0f} ops/s", end="")
+    print()
+
+    global_single, striped_single = results[1]
+    global_many, striped_many = results[THREADS]
+    # 全局锁的吞吐量不随客户端数增长；条带锁应明显增长
+    assert global_many < global_single * 2
+    assert striped_many > striped_single * 3
+    assert striped_many > global_many * 2
+
+def test_real_contact_updates_throughput(data_dir):
+    """真实的通讯录读写吞吐量（只打印结果，磁盘速度差异太大不做断言）。"""
+    ops = 20
+    for clients in (1, THREADS):
+        def worker(i):
+            for j in range(ops):
+                C.ContactManager(f'user-{i}').update_or_add_contact(f'friend-{j}', '', 'hi')
+
+        elapsed = run_threads(clients, worker)
+        print(f"\n[通讯录] {clients} 个客户端: {clients * ops / elapsed:.0f} 次更新/秒", end="")
+    print()
@@ -0,0 +1,50 @@
+"""
+续传临时文件的路径测试：对端发来的 transfer_id 会成为文件名的一部分，不能借此写到接收目录之外。
+
+运行: python -m pytest -q test_resume.py
+"""
+
+import os
+import socket
+import uuid
+
+import pytest
+
+import resume
+import schema as S
+from framing import read_frame
+from serializer import decode_frame
+from transfer import ChunkSpool, resume_transfer
+
+EVIL_ID = '/../../../../tmp/evil'
+
+def test_partial_paths_canonicalize_transfer_id(tmp_path):
+    transfer_id = uuid.uuid4()
+    final_path = os.path.join(tmp_path, 'a.txt')
+    temp_path, state_path = resume.partial_paths(final_path, str(transfer_id).upper())
+    assert temp_path == os.path.join(tmp_path, f'.a.txt.{transfer_id}{resume.PARTIAL_SUFFIX}')
+    assert state_path == os.path.join(tmp_path, f'.a.txt.{transfer_id}{resume.STATE_SUFFIX}')
+
+@pytest.mark.parametrize('transfer_id', [EVIL_ID, '../x', 'a/b', ''])
+def test_partial_paths_reject_invalid_transfer_id(tmp_path, transfer_id):
+    with pytest.raises(ValueError):
+        resume.partial_paths(os.path.join(tmp_path, 'a.txt'), transfer_id)
+    assert resume.find_partial([str(tmp_path)], transfer_id) is None
+
+def test_spool_rejects_traversal_transfer_id(tmp_path):
+    """带 '../' 的 transfer_id 在创建任何文件之前被拒绝。"""
+    directory = tmp_path / 'user' / 'bob' / 'file'
+    with pytest.raises(ValueError):
+        ChunkSpool(str(directory / 'a.txt'), 10, 4096, 1, EVIL_ID, 'hash', 'alice',
+                   negotiated_chunk_size=4096)
+    assert not directory.exists() or not os.listdir(directory)
+
+def test_resume_request_with_invalid_transfer_id_cancelled(tmp_path):
+    """续传请求中的 transfer_id 无效时回复 'cancelled' 的 EndTransfer，不发送任何数据。"""
+    a, b = socket.socketpair()
+    with a, b:
+        outgoing = resume.OutgoingTransfers(str(tmp_path / 'outgoing.json'))
+        request = S.ResumeTransferMsg(transfer_id=EVIL_ID, content_hash='hash', missing=[[0, 1]], requester='bob')
+        assert resume_transfer(a, request, outgoing, 'bob') == 0
+        reply = decode_frame(read_frame(b))
+    assert isinstance(reply, S.EndTransferMsg) and reply.status == 'cancelled'
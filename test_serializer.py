@@ -0,0 +1,60 @@
+"""
+消息与数据块帧的编解码测试：对端构造的块头不能让接收端分配超出协商上限的内存；
+取默认值的新增字段不写入 JSON，旧版本的对端仍能解码。
+
+运行: python -m pytest -q test_serializer.py
+"""
+
+import json
+import uuid
+import zlib
+
+import pytest
+
+import compression
+import schema as S
+from serializer import (COMPRESSED_CHUNK_FRAME_MARKER, COMPRESSED_CHUNK_HEADER, MAX_CHUNK_SIZE,
+                        compressed_chunk_parts, decode_frame, encode_payload)
+
+TRANSFER_ID = str(uuid.uuid4())
+
+def compressed_frame(raw_length: int, packed: bytes) -> bytes:
+    header = COMPRESSED_CHUNK_HEADER.pack(COMPRESSED_CHUNK_FRAME_MARKER, uuid.UUID(TRANSFER_ID).bytes, 0,
+                                          raw_length, compression.ALGORITHM_IDS['zlib'])
+    return header + packed
+
+def test_compressed_chunk_round_trip():
+    raw = b'hello chunk ' * 1000
+    payload = b''.join(compressed_chunk_parts(TRANSFER_ID, 7, raw, zlib.compress(raw),
+                                              compression.ALGORITHM_IDS['zlib']))
+    msg = decode_frame(payload)
+    assert (msg.transfer_id, msg.chunk_index, msg.data) == (TRANSFER_ID, 7, raw)
+
+def test_oversized_raw_length_rejected_before_decompressing(monkeypatch):
+    """64KB 的 zlib 数据可以解压出几十 MB：块头声称的原始长度超过上限时不调用解压。"""
+    bomb = zlib.compress(bytes(64 * 1024 * 1024), 9)
+    called = []
+    monkeypatch.setattr(compression, 'decompress', lambda *args: called.append(args))
+    with pytest.raises(ValueError):
+        decode_frame(compressed_frame(0xFFFFFFFF, bomb))
+    with pytest.raises(ValueError):
+        decode_frame(compressed_frame(MAX_CHUNK_SIZE + 1, bomb))
+    assert not called
+
+@pytest.mark.parametrize('msg_class', [S.ImageMsg, S.VoiceMsg])
+def test_empty_file_name_omitted(msg_class):
+    """JSON 编码时 file_name 为空不写入（与加入该字段之前的消息相同），不为空时照常写入。"""
+    msg = msg_class('id-1', 'alice', 'bob', 'aGVsbG8=', time=1)
+    payload = encode_payload(msg)
+    assert 'file_name' not in json.loads(payload)
+    assert decode_frame(payload) == msg
+    named = msg_class('id-1', 'alice', 'bob', 'aGVsbG8=', file_name='a.png', time=1)
+    assert json.loads(encode_payload(named))['file_name'] == 'a.png'
+    assert decode_frame(encode_payload(named)) == named
+
+def test_required_file_name_always_written():
+    """StartTransfer 的 file_name 是必填字段，为空时也要写入，否则对端无法构造消息。"""
+    msg = S.StartTransferMsg(transfer_id=TRANSFER_ID, file_type='file', file_name='',
+                             total_size=0, total_chunks=0, chunk_size=4096)
+    assert json.loads(encode_payload(msg))['file_name'] == ''
+    assert decode_frame(encode_payload(msg)) == msg
@@ -0,0 +1,43 @@
+"""
+用户表的日志与快照测试：重叠的压缩（后台压缩与 close() / 启动时的补做）不能让旧快照覆盖新快照、
+也不能删掉还没有写进快照的日志，否则两次快照之间的注册和更新会在重启后丢失。
+
+运行: python -m pytest -q test_user_registry.py
+"""
+
+import os
+import threading
+import time
+
+import user_registry
+from user_registry import UserRegistry
+
+def test_overlapping_compactions_lose_nothing(tmp_path, monkeypatch):
+    snapshot = os.path.join(tmp_path, 'users.json')
+    registry = UserRegistry(snapshot)
+    registry.add({'username': 'alice', 'user_id': '1'})
+
+    # 第一次压缩写快照很慢，第二次压缩在它写完之前开始
+    save = user_registry.save_users_to_json
+    calls = []
+    def slow_save(filename, users):
+        calls.append(len(users))
+        if len(calls) == 1:
+            time.sleep(0.3)
+        save(filename, users)
+    monkeypatch.setattr(user_registry, 'save_users_to_json', slow_save)
+
+    first = threading.Thread(target=registry.compact)
+    first.start()
+    time.sleep(0.05)
+    registry.add({'username': 'bob', 'user_id': '2'})
+    registry.update('alice', last_login=42)
+    registry.compact()
+    first.join()
+
+    # 不调用 close()，模拟进程在此时退出：只靠磁盘上的快照和日志恢复
+    reloaded = UserRegistry(snapshot)
+    assert reloaded.get_by_name('bob') is not None
+    assert reloaded.get_by_name('alice')['last_login'] == 42
+    reloaded.close()
+    registry.close()
@@ -0,0 +1,117 @@
+import math
+from typing import Dict, Hashable, List, Sequence, Set, Tuple
+
+class TimingWheel:
+    """
+    分层时间轮，用于以 O(1) 的代价管理大量定时截止时间（例如会话心跳超时）。
+
+    - schedule(key, deadline) 把 key 放入与截止时间相距最近的那一层槽位；
+    - 把截止时间向后推迟（心跳续期）只更新字典中的截止时间，不移动槽位，
+      等旧槽位到期时再按新的截止时间重新放置；
+    - advance(now) 逐格推进指针，低层转满一圈时把上一层对应槽位中的 key 降级重新放置，
+      返回所有已经到期的 key。
+    """
+    def __init__(self, tick: float = 1.0, wheel_sizes: Sequence[int] = (64, 64, 64), start: float = 0.0):
+        if tick <= 0:
+            raise ValueError("tick 必须大于 0")
+        self.tick = tick
+        self.wheel_sizes = tuple(wheel_sizes)
+        self._wheels: List[List[Set[Hashable]]] = [[set() for _ in range(size)] for size in self.wheel_sizes]
+        # 每一层一个槽位所覆盖的 tick 数：1, 64, 64*64 ...
+        self._spans: List[int] = []
+        span = 1
+        for size in self.wheel_sizes:
+            self._spans.append(span)
+            span *= size
+        self._max_span = span
+        self._current = self._to_tick(start)
+        self._deadlines: Dict[Hashable, int] = {}
+        self._slot_of: Dict[Hashable, Tuple[int, int]] = {}
+
+    def _to_tick(self, t: float) -> int:
+        return math.ceil(t / self.tick)
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._deadlines
+
+    def _place(self, key: Hashable, deadline_tick: int, earliest: int = None):
+        # 当前格已经处理过，已到期的 key 放到下一格，下一次 advance 时立即返回；
+        # 降级时当前格尚未处理，可以直接放入当前格
+        if earliest is None:
+            earliest = self._current + 1
+        deadline_tick = max(deadline_tick, earliest)
+        delta = deadline_tick - self._current
+        if delta >= self._max_span:
+            # 超出时间轮的覆盖范围，先放在最高层最远的槽位，之后再降级
+            deadline_tick = self._current + self._max_span - 1
+            delta = self._max_span - 1
+        for level, size in enumerate(self.wheel_sizes):
+            if delta < self._spans[level] * size:
+                slot = (deadline_tick // self._spans[level]) % size
+                self._wheels[level][slot].add(key)
+                self._slot_of[key] = (level, slot)
+                return
+
+    def _unplace(self, key: Hashable):
+        position = self._slot_of.pop(key, None)
+        if position is not None:
+            level, slot = position
+            self._wheels[level][slot].discard(key)
+
+    def schedule(self, key: Hashable, deadline: float):
+        """设置（或更新）key 的截止时间。"""
+        deadline_tick = self._to_tick(deadline)
+        old = self._deadlines.get(key)
+        self._deadlines[key] = deadline_tick
+        if old is not None and deadline_tick >= old:
+            # 截止时间推迟：保持原槽位不动，到期时再重新放置
+            return
+        self._unplace(key)
+        self._place(key, deadline_tick)
+
+    def cancel(self, key: Hashable):
+        """取消 key 的定时。"""
+        if self._deadlines.pop(key, None) is not None:
+            self._unplace(key)
+
+    def _cascade(self, level: int):
+        """把第 level 层当前槽位中的 key 重新放置到更低的层。"""
+        size = self.wheel_sizes[level]
+        slot = (self._current // self._spans[level]) % size
+        keys = self._wheels[level][slot]
+        self._wheels[level][slot] = set()
+        for key in keys:
+            self._slot_of.pop(key, None)
+            if key in self._deadlines:
+                self._place(key, self._deadlines[key], earliest=self._current)
+
+    def advance(self, now: float) -> List[Hashable]:
+        """把时间轮推进到 now，返回所有已到期（并已移除）的 key。"""
+        target = self._to_tick(now)
+        expired: List[Hashable] = []
+        while self._current < target:
+            self._current += 1
+            # 低层转满一圈时，从高层降级（先处理最高层，降下来的 key 才能继续下沉）
+            top = 0
+            while top + 1 < len(self.wheel_sizes) and self._current % self._spans[top + 1] == 0:
+                top += 1
+            for level in range(top, 0, -1):
+                self._cascade(level)
+
+            slot = self._current % self.wheel_sizes[0]
+            keys = self._wheels[0][slot]
+            self._wheels[0][slot] = set()
+            for key in keys:
+                self._slot_of.pop(key, None)
+                deadline_tick = self._deadlines.get(key)
+                if deadline_tick is None:
+                    continue
+                if deadline_tick <= self._current:
+                    del self._deadlines[key]
+                    expired.append(key)
+                else:
+                    self._place(key, deadline_tick)
+        return expired
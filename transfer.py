@@ -0,0 +1,826 @@
+import base64
+import os
+import queue
+import errno
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import flow
+import resume
+import schema as S
+from capabilities import LEGACY_CHUNK_SIZE, Capabilities, get_capabilities
+from compression import ChunkCompressor, choose_compression, record_transfer
+from framing import FrameWriter, batched, get_frame_writer, read_frame, write_frame
+from serializer import MAX_CHUNK_SIZE, chunk_parts, compressed_chunk_parts, decode_frame, encode_payload, send_msg
+
+# 没有进行能力协商的连接上每个数据块的大小
+CHUNK_SIZE = LEGACY_CHUNK_SIZE
+
+# 流式发送：每次从磁盘读入的块大小与复用缓冲区的个数，单次传输的峰值内存约为二者之积
+READ_AHEAD_BLOCK = 256 * 1024
+READ_AHEAD_DEPTH = 4
+# 不超过这个大小的文件整体读入后发送，流水线的线程开销不值得
+STREAM_THRESHOLD = READ_AHEAD_BLOCK
+
+# 分条传输：每段至少这么大，不足 2 x STRIPE_MIN_BYTES 的文件只用原连接（新建连接和 TLS 握手的开销不值得）
+STRIPE_MIN_BYTES = 8 * 1024 * 1024
+
+# 接收端接受的单个文件大小与数据块数上限（位图每块占 1 字节），超过的 StartTransfer 直接拒绝
+MAX_TRANSFER_SIZE = 4 * 1024 * 1024 * 1024
+MAX_TRANSFER_CHUNKS = MAX_TRANSFER_SIZE // LEGACY_CHUNK_SIZE
+# 预分配临时文件后磁盘上至少还要留出的空间
+MIN_FREE_SPACE = 64 * 1024 * 1024
+# 写入临时文件、还没有刷到磁盘的数据超过这么多字节时在后台 fdatasync；
+# 接收端通告的窗口扣除未刷盘的字节数（见 flow.AckSender），磁盘跟不上时发送端随之放慢
+SYNC_BYTES = 8 * 1024 * 1024
+
+FrameParts = Tuple[Any, ...]
+Progress = Callable[[int, int], None]
+# 新建一条到同一对端、已完成能力协商的连接；无法建立时返回 None
+Connector = Callable[[], Any]
+
+_transfer_locks: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_transfer_locks_guard = threading.Lock()
+
+def transfer_lock(sock) -> "threading.RLock":
+    """
+    sock 上的传输锁：同一连接上的两次传输（例如用户发送文件时对端的续传请求到达）
+    一次只进行一个，接收端不会收到交错的数据块。
+    """
+    with _transfer_locks_guard:
+        lock = _transfer_locks.get(sock)
+        if lock is None:
+            lock = _transfer_locks[sock] = threading.RLock()
+        return lock
+
+def _choose_compressor(caps: Capabilities, file_type: str, file_name: str, head: bytes) -> Optional[ChunkCompressor]:
+    if not (caps.supports('binary_chunks') and caps.compression):
+        return None
+    choice = choose_compression(file_type, file_name, head, caps.compression)
+    return ChunkCompressor(*choice) if choice is not None else None
+
+def _chunk_encoder(caps: Capabilities, transfer_id: str,
+                   compressor: Optional[ChunkCompressor]) -> Callable[[int, memoryview], FrameParts]:
+    """返回 encode(chunk_index, chunk) -> 该数据块一帧的负载片段（见 framing.write_frame）。"""
+    binary_chunks = caps.supports('binary_chunks')
+
+    def encode(index: int, chunk: memoryview) -> FrameParts:
+        packed = compressor.compress(chunk) if compressor is not None else None
+        if packed is not None:
+            return compressed_chunk_parts(transfer_id, index, chunk, packed, compressor.algorithm_id)
+        if binary_chunks:
+            return chunk_parts(transfer_id, index, chunk)
+        return (encode_payload(S.DataChunkMsg(
+            transfer_id=transfer_id, chunk_index=index, data=base64.b64encode(chunk).decode('ascii'))),)
+    return encode
+
+def _record_compression(caps: Capabilities, transfer_id: str, file_type: str,
+                        compressor: Optional[ChunkCompressor], total_size: int):
+    if compressor is not None:
+        record_transfer(transfer_id, file_type, compressor.algorithm, compressor.raw_bytes,
+                        compressor.wire_bytes, compressor.cpu_time)
+    elif caps.supports('binary_chunks') and caps.compression:
+        record_transfer(transfer_id, file_type, 'none', total_size, total_size, 0.0)
+
+def _start_msg(transfer_id: str, file_type: str, file_name: str, total_size: int,
+               chunk_size: int, content_hash: str = '') -> S.StartTransferMsg:
+    return S.StartTransferMsg(
+        transfer_id = transfer_id,
+        file_type = file_type,
+        file_name = file_name,
+        total_size = total_size,
+        total_chunks = (total_size + chunk_size - 1) // chunk_size,
+        chunk_size = chunk_size,
+        content_hash = content_hash
+    )
+
+def _open_window(caps: Capabilities, sock, start_msg: S.StartTransferMsg, send_bytes: int,
+                 progress: Optional[Progress]) -> Optional[flow.SendWindow]:
+    """对端支持 'flow_control' 且要发送的数据超过 FLOW_MIN_SIZE 时为本次传输打开窗口，并让接收端回复确认。"""
+    if not caps.supports('flow_control') or send_bytes <= flow.FLOW_MIN_SIZE:
+        return None
+    start_msg.ack_bytes = flow.ACK_BYTES
+    return flow.open_window(sock, start_msg.transfer_id, send_bytes, progress)
+
+def _write_chunk(writer: FrameWriter, window: Optional[flow.SendWindow], index: int, size: int, parts: FrameParts):
+    """写出一个数据块；窗口已满时先把缓冲的帧发出去（确认只会针对已经发出的数据），再等待确认。"""
+    if window is not None:
+        if not window.has_room(size):
+            writer.flush()
+            window.reserve(size)
+        window.sent(index, size)
+    writer.write_frame(*parts)
+
+def _finish_window(writer: FrameWriter, window: Optional[flow.SendWindow], file_name: str):
+    """所有数据块写出后等待对端确认全部收到，EndTransfer 之后的“完成”即表示已经送达。"""
+    if window is None:
+        return
+    writer.flush()
+    window.wait_all_acked()
+    print(f"[流量控制] '{file_name}': {window.summary()}")
+
+def send_transfer(sock, transfer_id: str, file_type: str, file_name: str, data_bytes: bytes,
+                  chunk_size: Optional[int] = None, progress: Optional[Progress] = None) -> int:
+    """
+    按 Start -> Chunks -> End 的流程发送一段数据，返回发送的块数。
+    服务器和 P2P 的发送函数共用它。块大小与数据块的格式取决于该连接的能力协商结果：
+    对端支持 'binary_chunks' 时数据块用二进制帧（见 serializer.chunk_parts），
+    否则与旧版本一样用 base64 编码的 JSON 消息。
+    双方协商出共同的压缩算法时，按 file_type 选择算法和级别逐块压缩（已压缩的格式直接跳过），
+    并记录本次传输的压缩率和 CPU 时间（见 compression.get_compression_stats）。
+    所有帧在一次批量发送中写出（见 framing.FrameWriter），多个数据块合并为一次 TLS 写入。
+    对端支持 'flow_control' 时在途的数据不超过按往返时间调整的窗口（见 flow.SendWindow），
+    progress(已确认字节数, 总字节数) 在每次收到确认时调用。
+    磁盘上的大文件用 send_file_transfer 流式发送。
+    """
+    caps = get_capabilities(sock)
+    if chunk_size is None:
+        chunk_size = caps.chunk_size
+    compressor = _choose_compressor(caps, file_type, file_name, bytes(data_bytes[:64]))
+    encode = _chunk_encoder(caps, transfer_id, compressor)
+    start_msg = _start_msg(transfer_id, file_type, file_name, len(data_bytes), chunk_size)
+
+    view = memoryview(data_bytes)
+    writer = get_frame_writer(sock)
+    window = _open_window(caps, sock, start_msg, len(data_bytes), progress)
+    try:
+        with transfer_lock(sock), batched(sock):
+            send_msg(sock, start_msg)
+            for i in range(start_msg.total_chunks):
+                chunk = view[i * chunk_size:(i + 1) * chunk_size]
+                _write_chunk(writer, window, i, len(chunk), encode(i, chunk))
+            _finish_window(writer, window, file_name)
+
+            end_msg = S.EndTransferMsg(transfer_id = transfer_id, status = 'success')
+            send_msg(sock, end_msg)
+    finally:
+        if window is not None:
+            flow.close_window(window)
+    _record_compression(caps, transfer_id, file_type, compressor, len(data_bytes))
+    return start_msg.total_chunks
+
+# --- 流式发送 ---
+
+_STOP = object()
+
+def _readinto_full(f, view: memoryview) -> int:
+    """尽量读满 view，返回读到的字节数（小于 len(view) 说明到了文件末尾）。"""
+    got = 0
+    while got < len(view):
+        n = f.readinto(view[got:])
+        if not n:
+            break
+        got += n
+    return got
+
+class _FilePipeline:
+    """
+    大文件的发送流水线：读盘、编码、写出三个阶段同时进行。
+
+    读线程用 readinto 把文件依次读入 depth 个复用的缓冲区（不再 f.read() 整个文件）；
+    编码线程按 chunk_size 用 memoryview 切分缓冲区（不复制），压缩 / 编码成每帧的负载片段；
+    调用者线程写出一个缓冲区的所有帧并刷新 FrameWriter 后，该缓冲区才回到空闲队列被再次读入，
+    因此写出之前帧片段引用的内存不会被覆盖。zlib / lzma、文件读取和 TLS 写入都会释放 GIL，
+    三个阶段可以真正重叠。单次传输的峰值内存约为 depth x block_size，与文件大小无关。
+    ranges 给出要发送的数据块区间 [(start, end), ...]（续传时只发送缺少的块），默认发送整个文件。
+    """
+    def __init__(self, path: str, size: int, block_size: int, depth: int,
+                 encode: Callable[[int, memoryview], FrameParts], chunk_size: int,
+                 ranges: Optional[Sequence[resume.Range]] = None):
+        self._path = path
+        self._size = size
+        self._encode = encode
+        self._chunk_size = chunk_size
+        total_chunks = (size + chunk_size - 1) // chunk_size
+        # 每个区间对应的文件字节范围，只读到开始传输时的文件大小
+        self._spans = [(start * chunk_size, min(end * chunk_size, size))
+                       for start, end in (ranges if ranges is not None else [(0, total_chunks)])]
+        self._spans = [(begin, end) for begin, end in self._spans if begin < end]
+        self.expected = sum(end - begin for begin, end in self._spans)
+        self._free: "queue.Queue[Any]" = queue.Queue()
+        self._filled: "queue.Queue[Any]" = queue.Queue()
+        self._encoded: "queue.Queue[Any]" = queue.Queue()
+        for _ in range(depth):
+            self._free.put(bytearray(block_size))
+        self._threads = [
+            threading.Thread(target=self._read, name="transfer-read", daemon=True),
+            threading.Thread(target=self._encode_blocks, name="transfer-encode", daemon=True),
+        ]
+
+    def _read(self):
+        try:
+            if not self._spans:
+                self._filled.put((None, 0, 0, True))
+                return
+            with open(self._path, 'rb', buffering=0) as f:
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                for i, (begin, end) in enumerate(self._spans):
+                    f.seek(begin)
+                    pos = begin
+                    while pos < end:
+                        buf = self._free.get()
+                        if buf is _STOP:
+                            return
+                        wanted = min(len(buf), end - pos)
+                        n = _readinto_full(f, memoryview(buf)[:wanted])
+                        # 区间的起点和缓冲区的长度都是块大小的整数倍，数据块不会跨越两个缓冲区
+                        first_index = pos // self._chunk_size
+                        pos += n
+                        # 读不满说明文件在发送过程中变短了，由调用者按字节数报错
+                        last = n < wanted or (pos == end and i == len(self._spans) - 1)
+                        self._filled.put((buf, n, first_index, last))
+                        if last:
+                            return
+        except Exception as e:
+            self._filled.put(e)
+
+    def _encode_blocks(self):
+        while True:
+            item = self._filled.get()
+            if item is _STOP or isinstance(item, Exception):
+                self._encoded.put(item)
+                return
+            buf, n, index, last = item
+            try:
+                frames: List[FrameParts] = []
+                if buf is not None:
+                    view = memoryview(buf)[:n]
+                    for offset in range(0, n, self._chunk_size):
+                        chunk = view[offset:offset + self._chunk_size]
+                        frames.append((index, len(chunk), self._encode(index, chunk)))
+                        index += 1
+            except Exception as e:
+                self._encoded.put(e)
+                return
+            self._encoded.put((buf, n, last, frames))
+            if last:
+                return
+
+    def run(self, sock, window: Optional[flow.SendWindow] = None) -> int:
+        """在调用者线程中写出所有数据块（有窗口时受流量控制），返回写出的字节数。"""
+        writer = get_frame_writer(sock)
+        sent = 0
+        for thread in self._threads:
+            thread.start()
+        try:
+            while True:
+                item = self._encoded.get()
+                if isinstance(item, Exception):
+                    raise item
+                buf, n, last, frames = item
+                for index, size, parts in frames:
+                    _write_chunk(writer, window, index, size, parts)
+                # 缓冲区回到空闲队列之前，引用它的帧必须已经写出
+                writer.flush()
+                sent += n
+                del frames
+                if buf is not None:
+                    self._free.put(buf)
+                if last:
+                    return sent
+        finally:
+            self._free.put(_STOP)
+            self._filled.put(_STOP)
+
+def send_file_transfer(sock, transfer_id: str, file_type: str, file_name: str, path: str,
+                       chunk_size: Optional[int] = None, content_hash: str = '',
+                       ranges: Optional[Sequence[resume.Range]] = None,
+                       progress: Optional[Progress] = None, connect: Optional[Connector] = None) -> int:
+    """
+    按 Start -> Chunks -> End 的流程发送磁盘上的文件，返回发送的块数。
+    小文件整体读入后交给 send_transfer；大文件经 _FilePipeline 流式发送，
+    数据块的格式、压缩与 send_transfer 相同。文件在发送过程中变短时抛出 OSError。
+    content_hash 非空时写入 StartTransfer，接收端据此保存位图以便续传；
+    续传时 ranges 给出要发送的数据块区间，StartTransfer 仍描述整个文件。
+    传入 connect 且双方协商的并行连接数大于 1 时，大文件分段经多条连接并行发送（见 _send_striped）。
+    """
+    size = os.path.getsize(path)
+    if size <= STREAM_THRESHOLD and ranges is None and not content_hash:
+        with open(path, 'rb') as f:
+            return send_transfer(sock, transfer_id, file_type, file_name, f.read(), chunk_size, progress)
+
+    caps = get_capabilities(sock)
+    if chunk_size is None:
+        chunk_size = caps.chunk_size
+    if connect is not None and ranges is None:
+        extra = _open_stripes(connect, choose_stripes(caps, size) - 1, chunk_size)
+        if extra:
+            return _send_striped(sock, extra, transfer_id, file_type, file_name, path, size,
+                                 chunk_size, content_hash, progress)
+    with open(path, 'rb') as f:
+        head = f.read(64)
+    compressor = _choose_compressor(caps, file_type, file_name, head)
+    start_msg = _start_msg(transfer_id, file_type, file_name, size, chunk_size, content_hash)
+    # 每个读入块包含整数个数据块，数据块不会跨越两个缓冲区
+    block_size = chunk_size * max(1, READ_AHEAD_BLOCK // chunk_size)
+    pipeline = _FilePipeline(path, size, block_size, READ_AHEAD_DEPTH,
+                             _chunk_encoder(caps, transfer_id, compressor), chunk_size, ranges)
+
+    window = _open_window(caps, sock, start_msg, pipeline.expected, progress)
+    try:
+        with transfer_lock(sock), batched(sock):
+            send_msg(sock, start_msg)
+            sent = pipeline.run(sock, window)
+            if sent != pipeline.expected:
+                raise OSError(f"文件 '{file_name}' 在发送过程中被修改（应为 {pipeline.expected} 字节，读到 {sent} 字节）。")
+            _finish_window(get_frame_writer(sock), window, file_name)
+            send_msg(sock, S.EndTransferMsg(transfer_id = transfer_id, status = 'success'))
+    finally:
+        if window is not None:
+            flow.close_window(window)
+    _record_compression(caps, transfer_id, file_type, compressor, sent)
+    return (sent + chunk_size - 1) // chunk_size if ranges is not None else start_msg.total_chunks
+
+# --- 分条传输 ---
+
+def stripe_ranges(total_chunks: int, stripes: int) -> List[resume.Range]:
+    """把 [0, total_chunks) 平均分成 stripes 段连续的数据块区间，第 i 段由第 i 条连接发送（第 0 段是原连接）。"""
+    bounds = [total_chunks * i // stripes for i in range(stripes + 1)]
+    return [(bounds[i], bounds[i + 1]) for i in range(stripes)]
+
+def choose_stripes(caps: Capabilities, size: int) -> int:
+    """size 字节的文件分成几段：不超过协商的并行连接数，每段至少 STRIPE_MIN_BYTES。"""
+    return max(1, min(caps.streams, size // STRIPE_MIN_BYTES))
+
+def _read_msg(sock) -> Any:
+    payload = read_frame(sock)
+    return decode_frame(payload) if payload is not None else None
+
+def _open_stripes(connect: Connector, count: int, chunk_size: int) -> List[Any]:
+    """新建最多 count 条连接；建立失败或协商的块比 chunk_size 小的不用，分段数相应减少。"""
+    conns: List[Any] = []
+    for _ in range(count):
+        try:
+            conn = connect()
+        except OSError as e:
+            print(f"[分条传输] 无法建立新连接: {e}")
+            conn = None
+        if conn is None:
+            break
+        if get_capabilities(conn).chunk_size < chunk_size:
+            conn.close()
+            break
+        # 新连接上只有本端在发送，等待确认时由发送线程自己读取
+        flow.set_ack_reader(conn, flow.timed_reader(_read_msg))
+        conns.append(conn)
+    return conns
+
+def _send_striped(sock, conns: List[Any], transfer_id: str, file_type: str, file_name: str, path: str,
+                  size: int, chunk_size: int, content_hash: str, progress: Optional[Progress]) -> int:
+    """
+    分条发送：文件按 stripe_ranges 分成 len(conns) + 1 段。原连接先发送带 stripes 和 stripe_token 的
+    StartTransfer，每条新连接发送 StripeJoin 后用各自的流水线和窗口发送一段并以 EndTransfer 结束，
+    原连接同时发送第 0 段。读盘、压缩、TLS 加密和确认都按连接并行，接收端按编号写入同一个临时文件。
+    所有段都发完（有流量控制时都已被确认）后原连接才发送 EndTransfer；任何一段失败时发送 'cancelled'，
+    可续传的传输由接收端之后按位图请求补发，然后抛出该段的异常。
+    """
+    caps = get_capabilities(sock)
+    stripes = len(conns) + 1
+    start_msg = _start_msg(transfer_id, file_type, file_name, size, chunk_size, content_hash)
+    start_msg.stripes = stripes
+    start_msg.stripe_token = secrets.token_hex(16)
+    if caps.supports('flow_control'):
+        start_msg.ack_bytes = flow.ACK_BYTES
+    ranges = stripe_ranges(start_msg.total_chunks, stripes)
+    block_size = chunk_size * max(1, READ_AHEAD_BLOCK // chunk_size)
+    with open(path, 'rb') as f:
+        head = f.read(64)
+    acked = [0] * stripes
+    compressors: List[Optional[ChunkCompressor]] = [None] * stripes
+    errors: List[Optional[Exception]] = [None] * stripes
+
+    def report(stripe: int) -> Optional[Progress]:
+        if progress is None:
+            return None
+        def update(done: int, _total: int):
+            acked[stripe] = done
+            progress(sum(acked), size)
+        return update
+
+    def send_stripe(stripe: int, conn):
+        conn_caps = get_capabilities(conn)
+        compressor = compressors[stripe] = _choose_compressor(conn_caps, file_type, file_name, head)
+        pipeline = _FilePipeline(path, size, block_size, READ_AHEAD_DEPTH,
+                                 _chunk_encoder(conn_caps, transfer_id, compressor), chunk_size, [ranges[stripe]])
+        window = (flow.open_window(conn, transfer_id, pipeline.expected, report(stripe))
+                  if start_msg.ack_bytes else None)
+        try:
+            with batched(conn):
+                if stripe:
+                    send_msg(conn, S.StripeJoinMsg(transfer_id=transfer_id, token=start_msg.stripe_token,
+                                                   stripe=stripe))
+                sent = pipeline.run(conn, window)
+                if sent != pipeline.expected:
+                    raise OSError(f"文件 '{file_name}' 在发送过程中被修改（第 {stripe} 段应为 "
+                                  f"{pipeline.expected} 字节，读到 {sent} 字节）。")
+                _finish_window(get_frame_writer(conn), window, f"{file_name} #{stripe}")
+                if stripe:
+                    send_msg(conn, S.EndTransferMsg(transfer_id=transfer_id, status='success'))
+        except Exception as e:
+            errors[stripe] = e
+        finally:
+            if window is not None:
+                flow.close_window(window)
+
+    threads = [threading.Thread(target=send_stripe, args=(i + 1, conn), name="transfer-stripe", daemon=True)
+               for i, conn in enumerate(conns)]
+    try:
+        with transfer_lock(sock):
+            # StartTransfer 先单独发出去，接收端登记这次传输之后新连接才能加入
+            send_msg(sock, start_msg)
+            for thread in threads:
+                thread.start()
+            send_stripe(0, sock)
+            for thread in threads:
+                thread.join()
+            failed = [e for e in errors if e is not None]
+            if failed:
+                try:
+                    send_msg(sock, S.EndTransferMsg(transfer_id=transfer_id, status='cancelled'))
+                except OSError:
+                    pass
+                raise failed[0]
+            send_msg(sock, S.EndTransferMsg(transfer_id=transfer_id, status='success'))
+    finally:
+        for conn in conns:
+            conn.close()
+    used = [c for c in compressors if c is not None]
+    if used:
+        record_transfer(transfer_id, file_type, used[0].algorithm, sum(c.raw_bytes for c in used),
+                        sum(c.wire_bytes for c in used), sum(c.cpu_time for c in used))
+    else:
+        _record_compression(caps, transfer_id, file_type, None, size)
+    print(f"[分条传输] '{file_name}' 经 {stripes} 条连接发送完成。")
+    return start_msg.total_chunks
+
+# --- 续传 ---
+
+def register_outgoing(sock, outgoing: Optional[resume.OutgoingTransfers], transfer_id: str, file_type: str,
+                      file_name: str, path: str, receiver: str) -> str:
+    """
+    对端支持 'resume' 且文件足够大时把本次传输登记到 outgoing，返回写入 StartTransfer 的内容哈希；
+    不登记时返回空字符串（与旧版本一样，中断后只能重新发送）。
+    """
+    caps = get_capabilities(sock)
+    if outgoing is None or not caps.supports('resume') or os.path.getsize(path) <= resume.RESUME_MIN_SIZE:
+        return ''
+    return outgoing.register(transfer_id, file_type, file_name, path, caps.chunk_size, receiver)
+
+def resume_transfer(sock, msg: S.ResumeTransferMsg, outgoing: resume.OutgoingTransfers, requester: str) -> int:
+    """
+    (发送端) 响应对端的 ResumeTransfer：登记仍然有效、文件没有被修改时用原来的 transfer_id
+    只发送 msg.missing 中的数据块，返回发送的块数；否则回复 'cancelled_resume'，返回 0。
+    transfer_id 不是合法的 UUID 时回复 'cancelled'。
+    """
+    try:
+        resume.canonical_transfer_id(msg.transfer_id)
+    except ValueError:
+        send_msg(sock, S.EndTransferMsg(transfer_id = msg.transfer_id, status = 'cancelled'))
+        return 0
+    entry = outgoing.lookup(msg.transfer_id, msg.content_hash, requester)
+    if entry is not None and entry['chunk_size'] > get_capabilities(sock).chunk_size:
+        # 新连接协商出的块更小，原来的数据块放不进一帧，只能重新发送
+        entry = None
+    if entry is None:
+        send_msg(sock, S.EndTransferMsg(transfer_id = msg.transfer_id, status = resume.STATUS_RESUME_UNAVAILABLE))
+        return 0
+    chunk_size = entry['chunk_size']
+    total_chunks = (entry['size'] + chunk_size - 1) // chunk_size
+    ranges = resume.normalize_ranges(msg.missing or [], total_chunks)
+    return send_file_transfer(sock, msg.transfer_id, entry['file_type'], entry['file_name'], entry['path'],
+                              chunk_size, entry['content_hash'], ranges)
+
+def resume_request(state: Dict[str, Any], requester: str = '') -> S.ResumeTransferMsg:
+    """(接收端) 为 resume.find_partials 找到的一个未完成传输生成续传请求。"""
+    received = resume.unpack_bitmap(state['bitmap'], state['total_chunks'])
+    return S.ResumeTransferMsg(transfer_id=state['transfer_id'], content_hash=state['content_hash'],
+                               missing=resume.missing_ranges(received), requester=requester)
+
+# --- 内联发送 ---
+
+# P2P 小文件内联发送时使用的消息类型
+INLINE_FILE_TYPES = {S.ImageMsg: 'image', S.VoiceMsg: 'audio', S.FileMsg: 'file'}
+
+def fits_inline(sock, size: int, binary: bool = False) -> bool:
+    """
+    size 字节的负载能否放在一条消息中直接发送：对端支持 'inline_payloads' 且不超过协商的内联上限。
+    binary=True 表示负载放在 bytes 字段中，JSON 编码无法携带，只在二进制编码的连接上内联。
+    """
+    caps = get_capabilities(sock)
+    if binary and caps.codec != 'binary':
+        return False
+    return caps.inline_limit > 0 and size <= caps.inline_limit
+
+def send_file(sock, transfer_id: str, file_type: str, file_name: str, path: str,
+              sender_name: str = '', receiver_name: str = '',
+              outgoing: Optional[resume.OutgoingTransfers] = None, progress: Optional[Progress] = None,
+              connect: Optional[Connector] = None) -> int:
+    """
+    (P2P) 发送磁盘上的一个文件，返回发送的数据帧数。小文件作为一条 ImageMsg / VoiceMsg / FileMsg 内联发送，
+    省去 Start / End 两帧和一次分块；其余文件（或对端不支持内联时）按 send_file_transfer 分块流式传输。
+    传入 outgoing 时大文件登记为可续传（见 register_outgoing）；传入 connect 时大文件可以分条并行发送。
+    """
+    if file_type in ('image', 'audio', 'file') and fits_inline(sock, os.path.getsize(path), binary=True):
+        with open(path, 'rb') as f:
+            data_bytes = f.read()
+        if file_type == 'image':
+            msg: Any = S.ImageMsg(picture_id=transfer_id, sender_name=sender_name, receiver_name=receiver_name,
+                                  data=bytes(data_bytes), file_name=file_name)
+        elif file_type == 'audio':
+            msg = S.VoiceMsg(voice_id=transfer_id, sender_name=sender_name, receiver_name=receiver_name,
+                             data=bytes(data_bytes), file_name=file_name)
+        else:
+            msg = S.FileMsg(file_id=transfer_id, sender_name=sender_name, receiver_name=receiver_name,
+                            file_name=file_name, data=bytes(data_bytes))
+        send_msg(sock, msg)
+        return 1
+    content_hash = register_outgoing(sock, outgoing, transfer_id, file_type, file_name, path, receiver_name)
+    return send_file_transfer(sock, transfer_id, file_type, file_name, path, content_hash=content_hash,
+                              progress=progress, connect=connect)
+
+def inline_file_info(msg: Any) -> Dict[str, Any]:
+    """把内联的 ImageMsg / VoiceMsg / FileMsg 转成与分块传输相同的 {'file_name', 'file_type', 'data'}。"""
+    file_type = INLINE_FILE_TYPES[type(msg)]
+    file_name = msg.file_name or f"{uuid.uuid4()}.{file_type}"
+    return {'file_name': file_name, 'file_type': file_type, 'data': msg.data}
+
+def chunk_data(msg: S.DataChunkMsg) -> bytes:
+    """取出数据块的原始字节：二进制块帧直接返回，旧版 JSON 块做 base64 解码。"""
+    data: Union[str, bytes] = msg.data
+    if isinstance(data, (bytes, bytearray)):
+        return data
+    return base64.b64decode(data)
+
+# --- 接收 ---
+
+def _sync_fd(fd: int):
+    if hasattr(os, 'fdatasync'):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+def _pwrite_all(fd: int, data: Any, offset: int):
+    """把 data 完整写到文件的 offset 处（没有 os.pwrite 的平台用 lseek + write）。"""
+    view = memoryview(data).cast('B')
+    while len(view):
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, view, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+class ChunkSpool:
+    """
+    接收端的临时文件：数据块到达后直接按 chunk_index * chunk_size 写到文件中的对应位置，
+    不再把整个文件攒在内存里的 bytearray 中，数据块也可以以任意顺序到达（重复的块会被忽略）。
+    临时文件与目标文件在同一目录下，开始时按 total_size 预分配（posix_fallocate），
+    全部数据块到齐后 commit() 用 os.replace 原子地改名为目标文件；中途失败时 abort() 删除临时文件。
+
+    分条传输时几条连接的接收线程同时调用 write_chunk，各自的 pwrite 并行进行，位图的更新加锁。
+    unsynced_bytes 是已写入但还没有刷到磁盘的字节数，超过 SYNC_BYTES 时由后台线程 fdatasync。
+
+    StartTransfer 带有 content_hash 时传输可以续传：临时文件的名字由 transfer_id 决定，
+    已收到的数据块位图每隔 CHECKPOINT_INTERVAL 秒（先把数据刷到磁盘）保存在旁边的 .part.json 中。
+    同一 transfer_id 与 content_hash 的传输再次开始时接着已有的临时文件和位图写入；
+    连接中断时 release() 保留它们，commit() 在改名前核对整个文件的哈希。
+
+    negotiated_chunk_size 是这条连接协商的数据块大小：StartTransfer 的 chunk_size 必须与它相同
+    （续传沿用最初登记的块大小，只要求不超过它）；文件大小与块数超过 MAX_TRANSFER_SIZE /
+    MAX_TRANSFER_CHUNKS、或者磁盘空间不够时同样拒绝，不预分配。
+    """
+    def __init__(self, final_path: str, total_size: int, chunk_size: int, total_chunks: int,
+                 transfer_id: str = '', content_hash: str = '', peer: str = '',
+                 negotiated_chunk_size: int = MAX_CHUNK_SIZE):
+        if total_size < 0 or chunk_size <= 0 or total_chunks != (total_size + chunk_size - 1) // chunk_size:
+            raise ValueError(f"无效的传输参数: {total_size} 字节, {total_chunks} 块, 每块 {chunk_size} 字节")
+        if chunk_size > min(negotiated_chunk_size, MAX_CHUNK_SIZE) or \
+                (chunk_size != negotiated_chunk_size and not (transfer_id and content_hash)):
+            raise ValueError(f"数据块大小 {chunk_size} 字节与协商的 {negotiated_chunk_size} 字节不符")
+        if total_size > MAX_TRANSFER_SIZE or total_chunks > MAX_TRANSFER_CHUNKS:
+            raise ValueError(f"文件过大: {total_size} 字节, {total_chunks} 块 "
+                             f"(上限 {MAX_TRANSFER_SIZE} 字节, {MAX_TRANSFER_CHUNKS} 块)")
+        # transfer_id 来自对端，续传时会成为临时文件名的一部分：只接受合法的 UUID
+        transfer_id = resume.canonical_transfer_id(transfer_id) if transfer_id else ''
+        self.final_path = final_path
+        self.total_size = total_size
+        self.chunk_size = chunk_size
+        self.total_chunks = total_chunks
+        self.transfer_id = transfer_id
+        self.content_hash = content_hash
+        self.peer = peer
+        self.resumable = bool(transfer_id and content_hash)
+        self.resumed_chunks = 0
+        self.state_path = ''
+        self._received = bytearray(total_chunks)
+        self._missing = total_chunks
+        self._cursor = 0
+        self._lock = threading.Lock()
+        self._synced = threading.Condition(self._lock)
+        self.unsynced_bytes = 0
+        self._syncing_bytes = 0
+        self._last_checkpoint = time.monotonic()
+        self._fd = -1
+        directory = os.path.dirname(final_path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        if self.resumable:
+            self.temp_path, self.state_path = resume.partial_paths(final_path, transfer_id)
+            if self._reopen():
+                return
+            self._check_free_space(directory)
+            self._fd = os.open(self.temp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        else:
+            self._check_free_space(directory)
+            self._fd, self.temp_path = tempfile.mkstemp(
+                dir=directory, prefix=f".{os.path.basename(final_path)}.", suffix=".part")
+        try:
+            if hasattr(os, 'fchmod'):
+                # mkstemp 创建的文件只有所有者可读写，改为与 open() 新建的文件一致
+                os.fchmod(self._fd, 0o644)
+            if total_size > 0:
+                try:
+                    os.posix_fallocate(self._fd, 0, total_size)
+                except (AttributeError, OSError):
+                    # 不支持预分配的平台或文件系统：只设置文件长度
+                    os.ftruncate(self._fd, total_size)
+            if self.resumable:
+                self.checkpoint()
+        except BaseException:
+            self.abort()
+            raise
+
+    def _check_free_space(self, directory: str):
+        """预分配之前确认磁盘放得下整个文件，否则抛出 OSError(ENOSPC)。"""
+        free = shutil.disk_usage(directory).free
+        if self.total_size + MIN_FREE_SPACE > free:
+            raise OSError(errno.ENOSPC, f"磁盘空间不足: 需要 {self.total_size} 字节, 剩余 {free} 字节")
+
+    def _reopen(self) -> bool:
+        """接着同一传输留下的临时文件和位图写入；没有可用的未完成传输时返回 False。"""
+        state = resume.load_state(self.state_path)
+        if state is None or not os.path.exists(self.temp_path):
+            return False
+        if (state.get('content_hash'), state.get('total_size'), state.get('chunk_size')) != \
+                (self.content_hash, self.total_size, self.chunk_size):
+            # 同一个 transfer_id 的内容变了，之前收到的数据块不能再用
+            return False
+        try:
+            received = resume.unpack_bitmap(state.get('bitmap', ''), self.total_chunks)
+        except ValueError:
+            return False
+        self._fd = os.open(self.temp_path, os.O_RDWR)
+        self._received = received
+        self._missing = received.count(0)
+        self.resumed_chunks = self.total_chunks - self._missing
+        return True
+
+    @property
+    def complete(self) -> bool:
+        return self._missing == 0
+
+    def first_missing(self) -> int:
+        """第一个还没有收到的数据块编号（全部收到时为 total_chunks），即累计确认的位置。"""
+        index = self._cursor
+        while index < self.total_chunks and self._received[index]:
+            index += 1
+        self._cursor = index
+        return index
+
+    def received_ranges(self, start: int, limit: int) -> List[List[int]]:
+        """start 之后已收到的数据块区间 [[start, end), ...]，最多 limit 个。"""
+        ranges: List[List[int]] = []
+        index = start
+        while index < self.total_chunks and len(ranges) < limit:
+            begin = self._received.find(1, index)
+            if begin < 0:
+                break
+            end = self._received.find(0, begin)
+            end = self.total_chunks if end < 0 else end
+            ranges.append([begin, end])
+            index = end
+        return ranges
+
+    def range_complete(self, start: int, end: int) -> bool:
+        """数据块区间 [start, end) 是否都已收到。"""
+        return self._received.find(0, start, end) < 0
+
+    def write_chunk(self, chunk_index: int, data: Any):
+        """把一个数据块写到它在文件中的位置；编号或长度与 StartTransfer 不符时抛出 ValueError。"""
+        if not 0 <= chunk_index < self.total_chunks:
+            raise ValueError(f"数据块编号 {chunk_index} 超出范围 (共 {self.total_chunks} 块)")
+        offset = chunk_index * self.chunk_size
+        expected = min(self.chunk_size, self.total_size - offset)
+        if len(data) != expected:
+            raise ValueError(f"数据块 {chunk_index} 长度为 {len(data)} 字节，应为 {expected} 字节")
+        if self._received[chunk_index]:
+            return
+        # 先写数据再标记：保存的位图中不会有还没写入的块（重复写入同一块的内容相同，没有影响）
+        _pwrite_all(self._fd, data, offset)
+        with self._lock:
+            if self._received[chunk_index]:
+                return
+            self._received[chunk_index] = 1
+            self._missing -= 1
+            self.unsynced_bytes += len(data)
+            if self.resumable and time.monotonic() - self._last_checkpoint >= resume.CHECKPOINT_INTERVAL:
+                self.checkpoint()
+            elif not self._syncing_bytes and self.unsynced_bytes >= SYNC_BYTES:
+                self._syncing_bytes = self.unsynced_bytes
+                threading.Thread(target=self._background_sync, args=(self._fd,),
+                                 name="spool-sync", daemon=True).start()
+
+    def _background_sync(self, fd: int):
+        """后台刷盘：完成后从 unsynced_bytes 中扣除开始时已写入的字节数。"""
+        try:
+            _sync_fd(fd)
+        except OSError as e:
+            print(f"\n[文件接收] 刷新临时文件到磁盘失败: {e}")
+        with self._synced:
+            self.unsynced_bytes = max(0, self.unsynced_bytes - self._syncing_bytes)
+            self._syncing_bytes = 0
+            self._synced.notify_all()
+
+    def _wait_sync(self):
+        """关闭文件之前等后台刷盘结束。"""
+        with self._synced:
+            while self._syncing_bytes:
+                self._synced.wait()
+
+    def checkpoint(self):
+        """把已写入的数据刷到磁盘后保存位图，位图中标记的块在程序崩溃或断电后仍然有效。"""
+        _sync_fd(self._fd)
+        self.unsynced_bytes = 0
+        resume.save_state(self.state_path, {
+            'transfer_id': self.transfer_id,
+            'content_hash': self.content_hash,
+            'peer': self.peer,
+            'file_name': os.path.basename(self.final_path),
+            'total_size': self.total_size,
+            'chunk_size': self.chunk_size,
+            'total_chunks': self.total_chunks,
+            'bitmap': resume.pack_bitmap(self._received),
+            'updated': time.time(),
+        })
+        self._last_checkpoint = time.monotonic()
+
+    def release(self, status: str = 'cancelled'):
+        """
+        传输没有完成（连接中断或对端取消）：可以续传时保存位图并保留临时文件，
+        否则（或者 status 表示发送端已经无法续传）删除临时文件。
+        """
+        if not self.resumable or status in resume.DISCARD_STATUSES:
+            self.abort()
+            return
+        try:
+            self.checkpoint()
+        except OSError:
+            self.abort()
+            return
+        self._wait_sync()
+        os.close(self._fd)
+        self._fd = -1
+
+    def commit(self, validate: Optional[Callable[[str], None]] = None) -> str:
+        """
+        所有数据块到齐后把临时文件改名为目标文件并返回目标路径。
+        validate(temp_path) 可以在改名前检查内容（例如通讯录必须是合法的 JSON），抛出异常时放弃本次传输。
+        """
+        if not self.complete:
+            self.abort()
+            raise ValueError(f"传输不完整: 还缺少 {self._missing} / {self.total_chunks} 个数据块")
+        try:
+            self._wait_sync()
+            os.close(self._fd)
+            self._fd = -1
+            if self.content_hash and resume.file_content_hash(self.temp_path) != self.content_hash:
+                raise ValueError("接收到的文件与发送端的内容哈希不一致")
+            if validate is not None:
+                validate(self.temp_path)
+            os.replace(self.temp_path, self.final_path)
+        except BaseException:
+            self.abort()
+            raise
+        if self.state_path:
+            resume.discard_partial(self.state_path)
+        return self.final_path
+
+    def abort(self):
+        """放弃本次传输，删除临时文件（以及续传用的位图）。"""
+        if self._fd >= 0:
+            self._wait_sync()
+            os.close(self._fd)
+            self._fd = -1
+        try:
+            os.unlink(self.temp_path)
+        except FileNotFoundError:
+            pass
+        if self.state_path:
+            resume.discard_partial(self.state_path)
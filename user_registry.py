@@ -0,0 +1,218 @@
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+# 日志条目累计到这个数量后，在后台把内存中的用户表压缩写成一份新的快照
+COMPACT_EVERY = 10000
+
+def load_users_from_json(filename: str) -> List[Dict[str, Any]]:
+    """
+    从JSON文件加载用户列表。
+    如果文件不存在，则返回一个空列表。
+    """
+    try:
+        # 确保目录存在
+        db_dir = os.path.dirname(filename)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+
+        with open(filename, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        # 更新：如果文件不存在或为空返回空列表
+        print(f"[服务器日志] 未找到或无法解析 {filename}。将使用空的用户列表启动。")
+        return []
+
+def _fsync_directory(path: str):
+    """把目录项（改名）刷到磁盘；不支持打开目录的平台（Windows）上跳过。"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def save_users_to_json(filename: str, users: List[Dict[str, Any]]) -> None:
+    """
+    将用户列表保存到JSON文件（先写临时文件再原子替换，避免写到一半时损坏快照）。
+    替换前把临时文件刷到磁盘、替换后同步所在目录，返回时新快照在断电后也完整可用。
+    """
+    tmp_path = filename + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(users, f, indent=4, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, filename)
+    _fsync_directory(os.path.dirname(filename) or '.')
+    print(f"[服务器日志] 用户数据已保存到 {filename}。")
+
+class UserRegistry:
+    """
+    常驻内存的用户表，按 username 和 user_id 建立索引。
+
+    持久化方式：
+    - 快照：data/users.json，格式与原来的用户列表完全相同；
+    - 日志：data/users.json.journal，每次注册/更新只追加一行 JSON。
+    启动时先加载快照再重放日志；日志条目达到 compact_every 条后，
+    在后台线程中把当前用户表写成新快照并清空日志。
+
+    记录采用写时复制：update() 会生成新的字典替换旧记录，
+    因此压缩线程可以在不持有锁的情况下安全地序列化旧记录。
+    同一时刻只有一次压缩（_compact_lock 从轮换日志一直持有到删除 .old 日志），
+    后台压缩进行中时 close() 等它结束再做最后一次压缩。
+    """
+    def __init__(self, snapshot_path: str = "data/users.json",
+                 journal_path: Optional[str] = None, compact_every: int = COMPACT_EVERY):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path or snapshot_path + ".journal"
+        self._rotated_path = self.journal_path + ".old"
+        self.compact_every = compact_every
+        self._lock = threading.RLock()
+        self._compact_lock = threading.Lock()
+        self._compacting = False
+        self._by_name: Dict[str, Dict[str, Any]] = {}
+        self._by_id: Dict[str, Dict[str, Any]] = {}
+        self._journal_entries = 0
+
+        self._load()
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        # 上次压缩中途退出时会留下 .old 日志，启动后立即补做一次压缩
+        if os.path.exists(self._rotated_path):
+            self.compact()
+
+    # --- 加载与重放 ---
+
+    def _put(self, record: Dict[str, Any]):
+        username = record.get('username')
+        if not username:
+            return
+        old = self._by_name.get(username)
+        if old is not None and old.get('user_id') != record.get('user_id'):
+            self._by_id.pop(str(old.get('user_id')), None)
+        self._by_name[username] = record
+        if record.get('user_id') is not None:
+            self._by_id[str(record['user_id'])] = record
+
+    def _apply(self, entry: Dict[str, Any]):
+        op = entry.get('op')
+        if op == 'add':
+            self._put(entry['record'])
+        elif op == 'update':
+            old = self._by_name.get(entry.get('username'))
+            if old is not None:
+                self._put({**old, **entry.get('fields', {})})
+
+    def _replay(self, path: str) -> int:
+        count = 0
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        self._apply(json.loads(line))
+                        count += 1
+                    except (json.JSONDecodeError, KeyError, TypeError):
+                        # 崩溃时可能留下写了一半的最后一行，跳过即可
+                        print(f"[用户表] 跳过 {path} 中无法解析的日志行。")
+        except FileNotFoundError:
+            pass
+        return count
+
+    def _load(self):
+        for record in load_users_from_json(self.snapshot_path):
+            self._put(record)
+        self._replay(self._rotated_path)
+        self._journal_entries = self._replay(self.journal_path)
+        print(f"[用户表] 已加载 {len(self._by_name)} 个用户 (日志条目 {self._journal_entries})。")
+
+    # --- 查询 ---
+
+    def get_by_name(self, username: str) -> Optional[Dict[str, Any]]:
+        return self._by_name.get(username)
+
+    def get_by_id(self, user_id: Any) -> Optional[Dict[str, Any]]:
+        return self._by_id.get(str(user_id))
+
+    def __len__(self) -> int:
+        return len(self._by_name)
+
+    def __contains__(self, username: str) -> bool:
+        return username in self._by_name
+
+    # --- 修改 ---
+
+    def _append(self, entry: Dict[str, Any]):
+        self._journal.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._journal.flush()
+        self._journal_entries += 1
+        if self._journal_entries >= self.compact_every and not self._compacting:
+            self._compacting = True
+            threading.Thread(target=self.compact, name="user-registry-compact", daemon=True).start()
+
+    def add(self, record: Dict[str, Any]) -> bool:
+        """注册新用户。用户名已存在时返回 False。"""
+        with self._lock:
+            if record['username'] in self._by_name:
+                return False
+            self._put(record)
+            self._append({"op": "add", "record": record})
+            return True
+
+    def update(self, username: str, **fields) -> Optional[Dict[str, Any]]:
+        """更新用户记录中的若干字段，返回新的记录；用户不存在时返回 None。"""
+        with self._lock:
+            old = self._by_name.get(username)
+            if old is None:
+                return None
+            record = {**old, **fields}
+            self._put(record)
+            self._append({"op": "update", "username": username, "fields": fields})
+            return record
+
+    def compact(self):
+        """把当前用户表写成新快照，并丢弃已经包含在快照中的日志。"""
+        with self._compact_lock:
+            self._compact_locked()
+
+    def _compact_locked(self):
+        with self._lock:
+            self._compacting = True
+            # 轮换日志：此后的修改写入新日志，即使快照写入失败也不会丢失
+            self._journal.close()
+            if os.path.exists(self._rotated_path):
+                # 上一次压缩未完成，把当前日志接在旧日志之后
+                with open(self.journal_path, 'r', encoding='utf-8') as src, \
+                        open(self._rotated_path, 'a', encoding='utf-8') as dst:
+                    dst.write(src.read())
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.remove(self.journal_path)
+            elif os.path.exists(self.journal_path):
+                os.replace(self.journal_path, self._rotated_path)
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+            self._journal_entries = 0
+            records = list(self._by_name.values())
+
+        try:
+            save_users_to_json(self.snapshot_path, records)
+            os.remove(self._rotated_path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"[用户表] 压缩快照失败，将在下次压缩时重试: {e}")
+        finally:
+            with self._lock:
+                self._compacting = False
+
+    def close(self):
+        """压缩并关闭日志文件（服务器正常退出时调用）。"""
+        self.compact()
+        with self._lock:
+            self._journal.close()
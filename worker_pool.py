@@ -0,0 +1,156 @@
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+# 默认的处理线程数量与接入队列容量（可通过 MTserver 的命令行参数覆盖）
+WORKER_COUNT = 200
+ACCEPT_QUEUE_SIZE = 100
+# 连接在接入队列中最多等待的时间（秒）；处理线程被长时间的会话占满时，超时的连接被拒绝而不是一直挂起
+ACCEPT_MAX_WAIT = 5.0
+
+class WorkerPool:
+    """
+    固定大小的连接处理线程池，带有有界的接入队列。
+
+    accept 线程调用 submit() 把新连接放入队列；队列已满时 submit() 立即返回 False，
+    由调用者负责快速拒绝该连接，而不是无限制地创建新线程。
+    给出 max_wait 时，在队列中等待超过 max_wait 秒仍没有处理线程空出来的任务被取出，
+    交给 on_expire(*args)（例如拒绝该连接）。
+    每个连接在队列中等待的时间会被统计，便于根据真实数据调整线程池大小。
+    """
+    def __init__(self, handler: Callable[..., Any], workers: int = WORKER_COUNT,
+                 queue_size: int = ACCEPT_QUEUE_SIZE, max_wait: Optional[float] = None,
+                 on_expire: Optional[Callable[..., Any]] = None):
+        if workers < 1:
+            raise ValueError("workers 必须大于 0")
+        if queue_size < 1:
+            raise ValueError("queue_size 必须大于 0")
+        if max_wait is not None and (max_wait <= 0 or on_expire is None):
+            raise ValueError("max_wait 必须大于 0，并且需要同时给出 on_expire")
+        self._handler = handler
+        self._workers = workers
+        self._queue_size = queue_size
+        self._max_wait = max_wait
+        self._on_expire = on_expire
+        self._tasks: Deque[Tuple[float, Any]] = deque()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._threads = []
+        self._stats_lock = threading.Lock()
+        self._busy = 0
+        self._submitted = 0
+        self._rejected = 0
+        self._expired = 0
+        self._completed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def start(self):
+        """启动全部处理线程（以及给出 max_wait 时检查等待超时的线程）。"""
+        for i in range(self._workers):
+            t = threading.Thread(target=self._worker_loop, name=f"worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        if self._max_wait is not None:
+            threading.Thread(target=self._expire_loop, name="worker-expire", daemon=True).start()
+
+    def submit(self, *args) -> bool:
+        """把一个任务放入接入队列。队列已满时返回 False（不阻塞）。"""
+        with self._cond:
+            if self._stopped or len(self._tasks) >= self._queue_size:
+                full = True
+            else:
+                full = False
+                self._tasks.append((time.monotonic(), args))
+                self._cond.notify()
+        with self._stats_lock:
+            if full:
+                self._rejected += 1
+            else:
+                self._submitted += 1
+        return not full
+
+    def shutdown(self, wait: bool = False):
+        """通知全部处理线程在处理完当前任务后退出。"""
+        with self._cond:
+            self._stopped = True
+            for _ in self._threads:
+                self._tasks.append((0.0, None))
+            self._cond.notify_all()
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                while not self._tasks:
+                    self._cond.wait()
+                enqueued_at, args = self._tasks.popleft()
+            if args is None:
+                return
+            waited = time.monotonic() - enqueued_at
+            with self._stats_lock:
+                self._busy += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+            try:
+                self._handler(*args)
+            except Exception as e:
+                print(f"[线程池] 处理任务时发生未捕获的错误: {e}")
+            finally:
+                with self._stats_lock:
+                    self._busy -= 1
+                    self._completed += 1
+
+    def _expire_loop(self):
+        """定期取出在队列中等待超过 max_wait 秒的任务（队列按到达顺序排列，只需检查队首）。"""
+        interval = min(1.0, self._max_wait / 4)
+        while True:
+            time.sleep(interval)
+            deadline = time.monotonic() - self._max_wait
+            expired = []
+            with self._cond:
+                if self._stopped:
+                    return
+                while self._tasks and self._tasks[0][0] < deadline:
+                    expired.append(self._tasks.popleft()[1])
+            if not expired:
+                continue
+            with self._stats_lock:
+                self._expired += len(expired)
+            for args in expired:
+                try:
+                    self._on_expire(*args)
+                except Exception as e:
+                    print(f"[线程池] 处理等待超时的任务时发生错误: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        """返回线程池当前的运行统计（队列深度、等待时间等）。"""
+        with self._stats_lock:
+            started = self._completed + self._busy
+            return {
+                "workers": self._workers,
+                "busy": self._busy,
+                "queue_depth": len(self._tasks),
+                "queue_capacity": self._queue_size,
+                "submitted": self._submitted,
+                "rejected": self._rejected,
+                "expired": self._expired,
+                "completed": self._completed,
+                "wait_avg_ms": round(self._wait_total / started * 1000, 3) if started else 0.0,
+                "wait_max_ms": round(self._wait_max * 1000, 3),
+            }
+
+def start_stats_reporter(interval: float, providers: Dict[str, Callable[[], Any]]) -> threading.Thread:
+    """启动一个后台线程，每隔 interval 秒打印一次各项统计（providers: 名称 -> 取统计的函数）。"""
+    def report():
+        while True:
+            time.sleep(interval)
+            for name, provider in providers.items():
+                print(f"[{name}统计] {provider()}")
+
+    t = threading.Thread(target=report, name="stats-reporter", daemon=True)
+    t.start()
+    return t